@@ -0,0 +1,233 @@
+"""
+bm25_index.py
+=============
+Incremental BM25 keyword index used by rag_store for the lexical half of
+hybrid search.
+
+Why not rank_bm25's BM25Okapi: it is built once from the full tokenized
+corpus and has no add/remove, so rag_store had to re-tokenize every chunk
+and rebuild it from scratch on every upload/delete (O(corpus) per write,
+all of it under rag_store's lock), and its get_scores() walks a dense
+array over EVERY chunk for every query. This keeps a per-term posting list
+instead:
+
+- add()/remove() touch only the postings of the chunk being added/removed,
+  with document-length stats (N, total length) maintained in place, so an
+  upload costs O(new chunks) rather than O(corpus).
+- score()/top() only visit the postings of the query's own terms, so a
+  keyword search costs O(postings for those terms), not O(all chunks).
+- score_many() scores a batch of queries at once: each posting's term
+  weight is computed once (as arrays) however many queries share the
+  term, and the per-query sums are one matrix product.
+
+Scoring is standard Okapi BM25 (same k1/b defaults as rank_bm25). The only
+deliberate difference is the IDF form: log(1 + (N - n + 0.5) / (n + 0.5))
+(the Lucene variant), which is always positive. BM25Okapi's
+log((N - n + 0.5) / (n + 0.5)) goes negative for terms in more than half
+the chunks and then needs a corpus-wide "average IDF" floor - a global
+statistic that can't be kept up to date incrementally. With a positive IDF,
+"score > 0" still means exactly "shares at least one term with the query",
+which is what rag_store's relevance filter relies on.
+
+rag_store keeps one BM25Index per file (a "segment") so a file's postings
+can be swapped in or dropped as a unit when a new immutable store version
+is published. IDF and average document length are still corpus-wide:
+corpus_stats() sums them over every segment and score() takes the result,
+so scoring a subset of files ranks exactly as one big index would.
+
+Not thread-safe on its own: add/remove must not race with score/top.
+rag_store only ever mutates a segment before publishing it, and never
+after.
+"""
+
+import heapq
+import math
+from collections import namedtuple
+
+import numpy as np
+
+# Corpus-wide statistics for scoring across several segments.
+CorpusStats = namedtuple("CorpusStats", ["n_docs", "total_len", "df"])
+
+
+def tokenize(text: str):
+    """Same tokenization rag_store has always used for BM25 (lowercase +
+    whitespace split), kept in one place so indexing and querying can't
+    drift apart."""
+    return text.lower().split()
+
+
+class BM25Index:
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self._postings = {}     # {term: {doc_id: term_frequency}}
+        self._doc_terms = {}    # {doc_id: tuple(unique terms)} - needed to undo add() on remove()
+        self._doc_len = {}      # {doc_id: token count}
+        self._total_len = 0
+        self._n_postings = 0    # sum of len(plist) over _postings, for memory_bytes()
+
+    def __len__(self):
+        return len(self._doc_len)
+
+    def __contains__(self, doc_id):
+        return doc_id in self._doc_len
+
+    def add(self, doc_id, tokens):
+        """Adds (or replaces) one document's tokens."""
+        if doc_id in self._doc_len:
+            self.remove(doc_id)
+        tf = {}
+        for tok in tokens:
+            tf[tok] = tf.get(tok, 0) + 1
+        for term, freq in tf.items():
+            self._postings.setdefault(term, {})[doc_id] = freq
+        self._doc_terms[doc_id] = tuple(tf)
+        self._doc_len[doc_id] = len(tokens)
+        self._total_len += len(tokens)
+        self._n_postings += len(tf)
+
+    def remove(self, doc_id):
+        """Removes one document; a no-op if it isn't indexed."""
+        terms = self._doc_terms.pop(doc_id, None)
+        if terms is None:
+            return
+        for term in terms:
+            plist = self._postings.get(term)
+            if plist is None:
+                continue
+            plist.pop(doc_id, None)
+            if not plist:
+                del self._postings[term]
+        self._total_len -= self._doc_len.pop(doc_id)
+        self._n_postings -= len(terms)
+
+    def copy(self) -> "BM25Index":
+        """Independent copy (O(postings), no re-tokenizing) - for updating
+        a published segment without touching the original."""
+        other = BM25Index(self.k1, self.b)
+        other._postings = {term: dict(plist) for term, plist in self._postings.items()}
+        other._doc_terms = dict(self._doc_terms)
+        other._doc_len = dict(self._doc_len)
+        other._total_len = self._total_len
+        other._n_postings = self._n_postings
+        return other
+
+    def clear(self):
+        self._postings.clear()
+        self._doc_terms.clear()
+        self._doc_len.clear()
+        self._total_len = 0
+        self._n_postings = 0
+
+    def memory_bytes(self) -> int:
+        """Rough resident size (dict entries dominate: one per posting, plus
+        per-document bookkeeping)."""
+        return 100 * self._n_postings + 200 * len(self._doc_len)
+
+    def doc_freq(self, term):
+        return len(self._postings.get(term, ()))
+
+    def stats(self, terms=()):
+        """This index's own CorpusStats (df only for `terms`)."""
+        return CorpusStats(len(self._doc_len), self._total_len, {t: self.doc_freq(t) for t in terms})
+
+    def idf(self, term, stats=None):
+        if stats is None:
+            n, N = self.doc_freq(term), len(self._doc_len)
+        else:
+            n, N = stats.df.get(term, 0), stats.n_docs
+        if not n:
+            return 0.0
+        return math.log(1.0 + (N - n + 0.5) / (n + 0.5))
+
+    def score(self, query_tokens, allowed=None, stats=None):
+        """
+        Returns {doc_id: bm25_score} for every document sharing at least
+        one term with the query (all scores > 0). Only the posting lists of
+        the query terms are visited. `allowed`, if given, is a predicate
+        (doc_id -> bool) applied per posting, so restricted searches don't
+        accumulate scores for documents they'd discard anyway. `stats`
+        (from corpus_stats()) scores this index as one segment of a larger
+        corpus; by default it is scored on its own statistics.
+        """
+        if not self._doc_len:
+            return {}
+        if stats is None:
+            stats = self.stats(query_tokens)
+        avgdl = (stats.total_len / stats.n_docs if stats.n_docs else 0.0) or 1.0
+        k1, b = self.k1, self.b
+        doc_len = self._doc_len
+        scores = {}
+        # Duplicated query terms contribute once per occurrence, same as
+        # BM25Okapi.get_scores().
+        for term in query_tokens:
+            plist = self._postings.get(term)
+            if not plist:
+                continue
+            idf = self.idf(term, stats)
+            for doc_id, freq in plist.items():
+                if allowed is not None and not allowed(doc_id):
+                    continue
+                denom = freq + k1 * (1.0 - b + b * doc_len[doc_id] / avgdl)
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * freq * (k1 + 1.0) / denom
+        return scores
+
+    def score_many(self, queries, stats=None):
+        """
+        score() for several tokenized queries in one pass. Returns
+        (doc_ids, scores): an int64 array of the documents sharing a term
+        with at least one query, ascending, and a (len(doc_ids),
+        len(queries)) float64 matrix of their BM25 scores (0 for a query
+        the document shares nothing with). `stats` must cover every term
+        of every query.
+        """
+        terms = sorted({t for q in queries for t in q if t in self._postings})
+        if not terms:
+            return np.zeros(0, dtype=np.int64), np.zeros((0, len(queries)))
+        if stats is None:
+            stats = self.stats(terms)
+        avgdl = (stats.total_len / stats.n_docs if stats.n_docs else 0.0) or 1.0
+        k1, b = self.k1, self.b
+        doc_len = self._doc_len
+        ids, cols, weights = [], [], []
+        for col, term in enumerate(terms):
+            plist = self._postings[term]
+            n = len(plist)
+            freq = np.fromiter(plist.values(), dtype=np.float64, count=n)
+            dl = np.fromiter((doc_len[d] for d in plist), dtype=np.float64, count=n)
+            ids.append(np.fromiter(plist.keys(), dtype=np.int64, count=n))
+            cols.append(np.full(n, col))
+            weights.append(self.idf(term, stats) * freq * (k1 + 1.0) / (freq + k1 * (1.0 - b + b * dl / avgdl)))
+        doc_ids, rows = np.unique(np.concatenate(ids), return_inverse=True)
+        # (document x term) weights times (term x query) term counts -
+        # duplicated query terms count once per occurrence, as in score().
+        per_term = np.zeros((len(doc_ids), len(terms)))
+        per_term[rows, np.concatenate(cols)] = np.concatenate(weights)
+        column = {t: i for i, t in enumerate(terms)}
+        counts = np.zeros((len(terms), len(queries)))
+        for j, q in enumerate(queries):
+            for t in q:
+                if t in column:
+                    counts[column[t], j] += 1
+        return doc_ids, per_term @ counts
+
+    def top(self, query_tokens, k, allowed=None, stats=None):
+        """Best `k` (doc_id, score) pairs, highest score first."""
+        scores = self.score(query_tokens, allowed, stats)
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
+
+
+def corpus_stats(indexes, terms):
+    """CorpusStats summed over several segments - N, total length and the
+    document frequency of each of `terms` - so that scoring any subset of
+    them matches scoring the union as a single index. O(segments x terms)."""
+    terms = set(terms)
+    n_docs = total_len = 0
+    df = dict.fromkeys(terms, 0)
+    for ix in indexes:
+        n_docs += len(ix)
+        total_len += ix._total_len
+        for t in terms:
+            df[t] += ix.doc_freq(t)
+    return CorpusStats(n_docs, total_len, df)
@@ -0,0 +1,297 @@
+"""
+chunk_table.py
+==============
+Compact, append-only chunk store for rag_store (replaces metadata.json).
+
+metadata.json held one Python dict per chunk ({filename, page, text}) keyed
+by a stringified id, was re-serialized in full by every upload/delete, and
+was json.load()-ed in full at every startup. For 300-500 page documents
+that's tens of thousands of small dicts (hundreds of bytes of object
+overhead each, on top of the text) and a multi-megabyte rewrite per write.
+
+Layout here, all under one directory:
+
+- chunks.bin     fixed-width binary rows, one per chunk (ROW_DTYPE): id,
+                 file id, page, text offset/length and the normalized-text
+                 hash. Memory-mapped at startup, so loading is O(1) instead
+                 of a JSON parse of the whole corpus.
+- text.arena     every chunk's UTF-8 text, concatenated; rows point into it.
+- filenames.json the interned filename table (file id -> filename), tiny.
+
+Writes are appends (new rows + new text at the end of both files) and
+deletes are in-place tombstones (file id set to -1), so a write costs
+O(chunks changed), never a full rewrite. Tombstoned rows/text stay on disk
+until rag_store compacts the shard into a fresh, dense table.
+
+Rows are only ever appended with increasing ids, so the id column is
+always sorted and id -> row is a binary search. Page numbers are stored
+as -1 for "no page" (non-paginated formats) and surfaced as None.
+
+ChunkTable.view() returns a read-only ChunkView pinned to the rows/text
+mapped at that moment: later appends remap the table but never touch an
+existing view, so rag_store's immutable store versions can read their own
+view without a lock. Tombstones ARE visible through older views (they're
+written in place), which is why rag_store defers them until no version
+that still sees those rows is in use.
+
+ChunkTable itself is not thread-safe: rag_store serializes its writers.
+"""
+
+import json
+import mmap
+import os
+
+import numpy as np
+
+ROW_DTYPE = np.dtype([
+    ("id", "<i8"),
+    ("file", "<i4"),      # index into the filename table; -1 = deleted
+    ("page", "<i4"),      # -1 = no page number
+    ("off", "<i8"),       # byte offset into text.arena
+    ("len", "<i4"),       # byte length in text.arena
+    ("hash", "S16"),      # md5 of the normalized text (dedup)
+])
+NO_PAGE = -1
+DELETED = -1
+FORMAT_VERSION = 1
+
+
+def hash_hex(value) -> str:
+    """Hex of a stored S16 hash. numpy drops trailing NUL bytes when a
+    fixed-width bytes field is read back, so pad to the full 32 digits;
+    rows stored without a hash read back as ""."""
+    return value.hex().ljust(32, "0") if value else ""
+
+
+class FileChunks:
+    """
+    Secondary index over one file's chunks: ids in document order, their
+    pages and text hashes, (page -> ids) and the page range, so page
+    lookups, document sampling and re-upload diffs cost O(result) instead
+    of a scan of the whole table. Built once when the file is indexed
+    (from the rows' ids/pages/hashes - no text is read) and immutable
+    after, like everything else rag_store publishes in a version.
+
+    Document order is the order of the ids given, not id order: a
+    re-upload keeps the ids of unchanged chunks and appends new ones, so
+    ids stop being monotonic within a file.
+    """
+
+    def __init__(self, ids: np.ndarray, pages: np.ndarray, hashes: np.ndarray):
+        self.ids = ids                               # document order
+        self.pages = pages                           # NO_PAGE = no page number
+        self.hashes = hashes                         # S16 normalized-text hashes
+        self._by_page = np.argsort(pages, kind="stable")
+        self._sorted_pages = pages[self._by_page]
+        paged = self._sorted_pages[self._sorted_pages != NO_PAGE]
+        self.page_range = (int(paged[0]), int(paged[-1])) if len(paged) else (None, None)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def ids_for_page(self, page: int) -> np.ndarray:
+        """Chunk ids on `page`, in document order."""
+        lo = np.searchsorted(self._sorted_pages, page, side="left")
+        hi = np.searchsorted(self._sorted_pages, page, side="right")
+        return self.ids[self._by_page[lo:hi]]
+
+
+class ChunkView:
+    """Read side of the table over a fixed set of mapped rows + text."""
+
+    def __init__(self, rows, arena, filenames, file_ids):
+        self._rows = rows
+        self._arena = arena
+        self._filenames = filenames   # file id -> filename
+        self._file_ids = file_ids     # filename -> file id
+
+    def _row_index(self, ids) -> np.ndarray:
+        """Rows of the live chunks among `ids`, in the order given
+        (unknown/deleted ids are skipped)."""
+        ids = np.asarray(ids, dtype=np.int64).reshape(-1)
+        if not len(ids) or not len(self._rows):
+            return np.zeros(0, dtype=np.int64)
+        all_ids = self._rows["id"]
+        rows = np.searchsorted(all_ids, ids)
+        in_range = rows < len(all_ids)
+        rows, ids = rows[in_range], ids[in_range]
+        rows = rows[all_ids[rows] == ids]
+        return rows[self._rows["file"][rows] != DELETED]
+
+    def _live_mask(self):
+        return self._rows["file"] != DELETED
+
+    def __len__(self):
+        return int(np.count_nonzero(self._live_mask())) if len(self._rows) else 0
+
+    def __contains__(self, cid):
+        return len(self._row_index([cid])) == 1
+
+    def _text_at(self, row) -> str:
+        off, n = int(row["off"]), int(row["len"])
+        return bytes(self._arena[off:off + n]).decode("utf-8")
+
+    def _as_dict(self, row) -> dict:
+        page = int(row["page"])
+        return {
+            "filename": self._filenames[int(row["file"])],
+            "page": None if page == NO_PAGE else page,
+            "text": self._text_at(row),
+            "hash": hash_hex(row["hash"]),
+        }
+
+    def get_many(self, ids):
+        """{cid: {filename, page, text, hash}} for the live ids among `ids`."""
+        return {int(self._rows[r]["id"]): self._as_dict(self._rows[r]) for r in self._row_index(ids)}
+
+    def ids_by_file(self) -> dict:
+        """{filename: live chunk ids in id order} for every file, in one
+        pass over the table (startup/reconcile; per-request lookups go
+        through FileChunks instead)."""
+        if not len(self._rows):
+            return {}
+        live = self._rows[self._live_mask()]
+        order = np.argsort(live["file"], kind="stable")
+        fids, starts = np.unique(live["file"][order], return_index=True)
+        groups = np.split(np.asarray(live["id"][order], dtype=np.int64), starts[1:])
+        return {self._filenames[int(fid)]: ids for fid, ids in zip(fids, groups)}
+
+    def file_chunks(self, ids) -> "FileChunks":
+        """FileChunks over the live rows among `ids` (one file's chunks, in
+        document order)."""
+        rows = self._rows[self._row_index(ids)]
+        return FileChunks(np.asarray(rows["id"], dtype=np.int64), np.asarray(rows["page"], dtype=np.int32),
+                          np.asarray(rows["hash"]))
+
+
+class ChunkTable(ChunkView):
+    def __init__(self, directory: str):
+        self.dir = directory
+        self.rows_path = os.path.join(directory, "chunks.bin")
+        self.arena_path = os.path.join(directory, "text.arena")
+        self.names_path = os.path.join(directory, "filenames.json")
+        os.makedirs(directory, exist_ok=True)
+        self._filenames = []          # file id -> filename
+        self._file_ids = {}           # filename -> file id
+        self._rows = np.zeros(0, dtype=ROW_DTYPE)
+        self._arena = b""
+        self._load()
+
+    # ------------------------------------------------------------------
+    # Load / persistence
+    # ------------------------------------------------------------------
+    def _load(self):
+        if os.path.exists(self.names_path):
+            with open(self.names_path, "r", encoding="utf-8") as f:
+                self._filenames = json.load(f)["filenames"]
+            self._file_ids = {name: i for i, name in enumerate(self._filenames)}
+        for path in (self.rows_path, self.arena_path):
+            if not os.path.exists(path):
+                open(path, "ab").close()
+        # Trim anything a crash mid-append left behind: a partial trailing
+        # row, or rows whose text never made it into the arena.
+        arena_size = os.path.getsize(self.arena_path)
+        n_rows = os.path.getsize(self.rows_path) // ROW_DTYPE.itemsize
+        if n_rows:
+            rows = np.memmap(self.rows_path, dtype=ROW_DTYPE, mode="r", shape=(n_rows,))
+            while n_rows and int(rows[n_rows - 1]["off"]) + int(rows[n_rows - 1]["len"]) > arena_size:
+                n_rows -= 1
+            del rows
+        if os.path.getsize(self.rows_path) != n_rows * ROW_DTYPE.itemsize:
+            with open(self.rows_path, "r+b") as f:
+                f.truncate(n_rows * ROW_DTYPE.itemsize)
+        self._remap()
+
+    def _remap(self):
+        n_rows = os.path.getsize(self.rows_path) // ROW_DTYPE.itemsize
+        self._rows = (np.memmap(self.rows_path, dtype=ROW_DTYPE, mode="r+", shape=(n_rows,))
+                      if n_rows else np.zeros(0, dtype=ROW_DTYPE))
+        if os.path.getsize(self.arena_path):
+            with open(self.arena_path, "rb") as f:
+                self._arena = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._arena = b""
+
+    def _save_filenames(self):
+        tmp = self.names_path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"format": FORMAT_VERSION, "filenames": self._filenames}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.names_path)
+
+    def _intern(self, filename: str) -> int:
+        fid = self._file_ids.get(filename)
+        if fid is None:
+            # Copy-on-write, so views holding the old lists never change.
+            fid = len(self._filenames)
+            self._filenames = self._filenames + [filename]
+            self._file_ids = {**self._file_ids, filename: fid}
+            self._save_filenames()
+        return fid
+
+    def view(self) -> ChunkView:
+        """Read-only view of the table as it is now (see module docstring)."""
+        return ChunkView(self._rows, self._arena, self._filenames, self._file_ids)
+
+    # ------------------------------------------------------------------
+    # Writes
+    # ------------------------------------------------------------------
+    @property
+    def n_rows(self) -> int:
+        """Rows on disk, tombstoned ones included (len() counts live rows)."""
+        return len(self._rows)
+
+    @property
+    def next_id(self) -> int:
+        return int(self._rows["id"][-1]) + 1 if len(self._rows) else 0
+
+    def append(self, filename: str, chunks, ids=None) -> np.ndarray:
+        """
+        Appends `chunks` (dicts with "page", "text" and optionally "hash" -
+        a hex md5 of the normalized text) for `filename`. Ids are assigned
+        from next_id unless given (they must then be increasing and above
+        every existing id). Returns the ids.
+        """
+        if not chunks:
+            return np.zeros(0, dtype=np.int64)
+        if ids is None:
+            ids = np.arange(self.next_id, self.next_id + len(chunks), dtype=np.int64)
+        ids = np.asarray(ids, dtype=np.int64)
+        fid = self._intern(filename)
+        encoded = [c["text"].encode("utf-8") for c in chunks]
+        new = np.zeros(len(chunks), dtype=ROW_DTYPE)
+        new["id"] = ids
+        new["file"] = fid
+        new["page"] = [NO_PAGE if c["page"] is None else c["page"] for c in chunks]
+        new["len"] = [len(b) for b in encoded]
+        off = os.path.getsize(self.arena_path)
+        new["off"] = off + np.concatenate(([0], np.cumsum(new["len"][:-1], dtype=np.int64)))
+        new["hash"] = [bytes.fromhex(c["hash"]) if c.get("hash") else b"" for c in chunks]
+        # Text first, rows second: a crash in between leaves orphan text
+        # (harmless) rather than rows pointing past the end of the arena.
+        # Both are fsynced before returning, so a caller that commits the
+        # ids elsewhere afterwards (rag_store's write-ahead log) never
+        # refers to rows that a crash could still lose.
+        for path, data in ((self.arena_path, b"".join(encoded)), (self.rows_path, new.tobytes())):
+            with open(path, "ab") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        self._remap()
+        return ids
+
+    def remove_ids(self, ids):
+        """Tombstones the given chunk ids in place."""
+        rows = self._row_index(ids)
+        if len(rows):
+            self._rows["file"][rows] = DELETED
+            self._rows.flush()
+
+    def clear(self):
+        for path in (self.rows_path, self.arena_path):
+            with open(path, "wb"):
+                pass
+        self._filenames, self._file_ids = [], {}
+        self._save_filenames()
+        self._remap()
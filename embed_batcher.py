@@ -0,0 +1,92 @@
+"""
+embed_batcher.py
+================
+Micro-batching of single-text embedding calls from concurrent requests.
+
+Every /chat that touches documents embeds its query on its own -
+engine.embed_texts([query]) - so N users asking at the same moment cost N
+separate one-row model runs, each paying the full per-call overhead
+(tokenizer setup, ONNX session dispatch) and all contending for the same
+cores. The model is far cheaper per text in a batch.
+
+MicroBatcher puts one worker thread in front of a batch function
+(texts -> (n, dim) array). Callers submit one text and block on a future;
+the worker takes the first waiting text, keeps collecting for up to
+`window_ms` (or until `max_batch` texts are queued), runs them as one
+batch - identical texts only once - and hands each caller its row. While
+a batch runs, new arrivals queue up and form the next one, so even
+window_ms=0 coalesces under load without delaying a lone request.
+
+max_batch <= 1 turns it into a plain pass-through call.
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    def __init__(self, fn, window_ms: float, max_batch: int, name: str = "embed-batcher"):
+        self._fn = fn
+        self.window_ms = window_ms
+        self.max_batch = max_batch
+        self.name = name
+        self._queue = queue.SimpleQueue()
+        self._worker = None
+        self._start_lock = threading.Lock()
+        self.batches = 0          # model calls made
+        self.items = 0            # texts submitted
+
+    def submit(self, text: str) -> Future:
+        future = Future()
+        if self.max_batch <= 1:
+            try:
+                future.set_result(self._fn([text])[0])
+            except Exception as e:
+                future.set_exception(e)
+            self.batches += 1
+            self.items += 1
+            return future
+        if self._worker is None:
+            with self._start_lock:
+                if self._worker is None:
+                    self._worker = threading.Thread(target=self._run, name=self.name, daemon=True)
+                    self._worker.start()
+        self._queue.put((text, future))
+        return future
+
+    def __call__(self, text: str, timeout=None):
+        """The embedding of `text` (blocks until its batch has run)."""
+        return self.submit(text).result(timeout)
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window_ms / 1000
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            unique = list(dict.fromkeys(text for text, _ in batch))
+            try:
+                rows = self._fn(unique)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            finally:
+                self.batches += 1
+                self.items += len(batch)
+            where = {text: i for i, text in enumerate(unique)}
+            for text, future in batch:
+                future.set_result(rows[where[text]].copy())
+
+    def mean_batch_size(self) -> float:
+        return self.items / self.batches if self.batches else 0.0
@@ -0,0 +1,188 @@
+"""
+embed_cache.py
+==============
+Persistent, content-addressed cache of chunk embeddings for rag_store.
+
+index_document() used to embed every chunk of a changed file from scratch,
+even when almost all of its chunks were byte-for-byte the same as in the
+previous upload (a lightly edited 400-page PDF) or as in another document
+(boilerplate repeated across a report series). Chunks already carry a
+hash of their normalized text, so the embedding of a chunk is cached
+under (embedding model, that hash) and only cache misses go to
+engine.embed_texts.
+
+Layout, under <directory>/<model slug>/:
+
+- vectors.f32  float32 rows, one slot per cached embedding (memory-mapped;
+               only the rows actually read are paged in)
+- slots.bin    one SLOT_DTYPE row per slot: the 16-byte text hash (empty =
+               free slot) and a last-used tick for LRU eviction
+- meta.json    model name + dim; a mismatch (different model/dimension
+               under the same slug) discards the cache
+
+The model name is part of the key (it selects the directory), so switching
+EMBED_MODEL_NAME can never serve vectors from another model. The cache
+holds at most `capacity` entries; beyond that the least recently used
+slots are overwritten in place. A put writes the vector before the key, so
+a crash can lose recent entries but never pair a key with the wrong vector.
+
+Thread-safe (rag_store indexes several uploads concurrently).
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+
+SLOT_DTYPE = np.dtype([("key", "S16"), ("tick", "<i8")])
+GROW_ROWS = 4096          # slots are allocated in steps, not one remap per put
+FORMAT_VERSION = 1
+
+
+def _slug(model_name: str) -> str:
+    safe = "".join(ch if ch.isalnum() or ch in "-_." else "_" for ch in model_name)
+    return f"{safe[:48]}-{hashlib.sha1(model_name.encode('utf-8')).hexdigest()[:8]}"
+
+
+class EmbeddingCache:
+    def __init__(self, directory: str, model_name: str, dim: int, capacity: int):
+        self.dir = os.path.join(directory, _slug(model_name))
+        self.model_name = model_name
+        self.dim = dim
+        self.capacity = capacity
+        self.vectors_path = os.path.join(self.dir, "vectors.f32")
+        self.slots_path = os.path.join(self.dir, "slots.bin")
+        self.meta_path = os.path.join(self.dir, "meta.json")
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(self.dir, exist_ok=True)
+        self._load()
+
+    # ------------------------------------------------------------------
+    # Load / persistence
+    # ------------------------------------------------------------------
+    def _load(self):
+        meta = {"format": FORMAT_VERSION, "model": self.model_name, "dim": self.dim}
+        stored = None
+        if os.path.exists(self.meta_path):
+            try:
+                with open(self.meta_path, "r", encoding="utf-8") as f:
+                    stored = json.load(f)
+            except Exception:
+                stored = None
+        if stored != meta:
+            for path in (self.vectors_path, self.slots_path):
+                with open(path, "wb"):
+                    pass
+            with open(self.meta_path, "w", encoding="utf-8") as f:
+                json.dump(meta, f)
+        for path in (self.vectors_path, self.slots_path):
+            if not os.path.exists(path):
+                open(path, "ab").close()
+        # A crash mid-grow can leave the two files with different lengths;
+        # only slots present in both are usable.
+        n = min(os.path.getsize(self.slots_path) // SLOT_DTYPE.itemsize,
+                os.path.getsize(self.vectors_path) // (4 * self.dim))
+        self._resize(n)
+        keys = self._slots["key"]
+        used = np.flatnonzero(keys != b"")
+        self._where = {bytes(keys[i]): int(i) for i in used}
+        self._free = [int(i) for i in np.flatnonzero(keys == b"")][::-1]
+        self._tick = int(self._slots["tick"].max()) + 1 if n else 1
+
+    def _resize(self, n: int):
+        for path, row_bytes in ((self.vectors_path, 4 * self.dim), (self.slots_path, SLOT_DTYPE.itemsize)):
+            if os.path.getsize(path) != n * row_bytes:
+                with open(path, "r+b") as f:
+                    f.truncate(n * row_bytes)
+        if n:
+            self._vecs = np.memmap(self.vectors_path, dtype=np.float32, mode="r+", shape=(n, self.dim))
+            self._slots = np.memmap(self.slots_path, dtype=SLOT_DTYPE, mode="r+", shape=(n,))
+        else:
+            self._vecs = np.zeros((0, self.dim), dtype=np.float32)
+            self._slots = np.zeros(0, dtype=SLOT_DTYPE)
+
+    def _flush(self):
+        if isinstance(self._vecs, np.memmap):
+            self._vecs.flush()
+            self._slots.flush()
+
+    # ------------------------------------------------------------------
+    # Lookup / insert
+    # ------------------------------------------------------------------
+    def __len__(self):
+        return len(self._where)
+
+    def get_many(self, hashes):
+        """
+        Looks up hex text hashes. Returns (vectors, hit_mask): a
+        (len(hashes), dim) float32 array with the cached rows filled in
+        (zeros elsewhere), and a bool mask of which ones were hits. Hits
+        count as "used" for LRU.
+        """
+        out = np.zeros((len(hashes), self.dim), dtype=np.float32)
+        mask = np.zeros(len(hashes), dtype=bool)
+        with self._lock:
+            rows, slots = [], []
+            for i, h in enumerate(hashes):
+                slot = self._where.get(bytes.fromhex(h)) if h else None
+                if slot is not None:
+                    rows.append(i)
+                    slots.append(slot)
+            if slots:
+                slots = np.asarray(slots)
+                out[rows] = self._vecs[slots]
+                mask[rows] = True
+                self._slots["tick"][slots] = self._tick
+                self._tick += 1
+            self.hits += len(rows)
+            self.misses += len(hashes) - len(rows)
+        return out, mask
+
+    def put_many(self, hashes, vectors):
+        """Stores vectors under their hex text hashes (evicting the least
+        recently used entries when full)."""
+        items = {bytes.fromhex(h): i for i, h in enumerate(hashes) if h}
+        if not items or self.capacity <= 0:
+            return
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._lock:
+            new = [k for k in items if k not in self._where][-self.capacity:]
+            slots = self._take_slots(len(new))
+            # Evicted slots lose their old key before their vector is
+            # overwritten, then vectors reach the disk before the keys
+            # that point at them.
+            for slot in slots:
+                old = bytes(self._slots["key"][slot])
+                if old:
+                    self._where.pop(old, None)
+                    self._slots["key"][slot] = b""
+            self._flush()
+            for key, slot in zip(new, slots):
+                self._vecs[slot] = vectors[items[key]]
+            self._flush()
+            for key, slot in zip(new, slots):
+                self._slots[slot] = (key, self._tick)
+                self._where[key] = slot
+            self._tick += 1
+            self._flush()
+
+    def _take_slots(self, k: int):
+        slots = [self._free.pop() for _ in range(min(k, len(self._free)))]
+        if len(slots) < k and len(self._slots) < self.capacity:
+            start = len(self._slots)
+            self._flush()
+            self._resize(min(self.capacity, start + max(k - len(slots), GROW_ROWS)))
+            self._free.extend(range(len(self._slots) - 1, start - 1, -1))
+            slots += [self._free.pop() for _ in range(min(k - len(slots), len(self._free)))]
+        if len(slots) < k:
+            # Full: overwrite the least recently used slots, excluding the
+            # ones already handed out above.
+            ticks = np.array(self._slots["tick"], dtype=np.int64)
+            ticks[slots] = np.iinfo(np.int64).max
+            n_evict = k - len(slots)
+            slots += [int(i) for i in np.argpartition(ticks, n_evict - 1)[:n_evict]]
+        return slots
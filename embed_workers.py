@@ -0,0 +1,285 @@
+"""
+embed_workers.py
+================
+Optional out-of-process embedding service for engine.embed_texts.
+
+By default the embedding model lives in the server process, so a large
+upload being embedded (rag_store, CPU-bound for seconds to minutes) and a
+chat request's query embedding share one ONNX session plus the GIL and the
+request-handling threads: bulk indexing shows up directly as chat latency.
+With EMBED_WORKERS > 0 engine starts an EmbedWorkerPool instead:
+
+- N worker processes (multiprocessing "spawn" - no fork of a threaded
+  server), each holding its own copy of the model, with the ONNX thread
+  count split between them so they don't oversubscribe the cores.
+- Two priority lanes: "interactive" (query embeddings a request is
+  waiting on) and "bulk" (document indexing). The pool itself hands jobs
+  out, one at a time, to idle workers, interactive work first, and the
+  first `interactive_workers` workers get nothing else, so a query never
+  waits behind a long indexing batch.
+- Results come back through one shared-memory block (float32 rows) split
+  into per-lane slots; the result queue only carries a job id. Requests
+  larger than a slot are split into several jobs and reassembled.
+
+Everything is local (queues + shared memory on this machine); nothing is
+served over the network. Because the pool records which worker a job
+went to before sending it, a worker that dies is replaced and the job it
+held - running or not yet picked up - fails with an error, never just
+disappears. embed() also gives up after `timeout` seconds
+(EmbedWorkerPool.job_timeout by default).
+"""
+
+import atexit
+import collections
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from multiprocessing import shared_memory
+
+import numpy as np
+
+LANES = ("interactive", "bulk")
+
+
+def fastembed_factory(model_name: str, threads: int):
+    """Default model loader, run inside each worker process."""
+    from fastembed import TextEmbedding
+    model = TextEmbedding(model_name=model_name, threads=threads)
+    return lambda texts: np.array(list(model.embed(texts)), dtype=np.float32)
+
+
+def _worker_main(index, inbox, results, shm_name, total_rows, dim, factory, model_name, threads):
+    try:
+        embed = factory(model_name, threads)
+        shm = shared_memory.SharedMemory(name=shm_name)
+        out = np.ndarray((total_rows, dim), dtype=np.float32, buffer=shm.buf)
+    except Exception as e:
+        results.put(("failed", index, f"{type(e).__name__}: {e}"))
+        return
+    results.put(("ready", index, None))
+    while True:
+        job = inbox.get()
+        if job is None:
+            break
+        job_id, row, texts = job
+        try:
+            out[row:row + len(texts)] = embed(texts)
+            results.put(("done", index, job_id))
+        except Exception as e:
+            results.put(("error", index, (job_id, f"{type(e).__name__}: {e}\n{traceback.format_exc()}")))
+    del out
+    shm.close()
+
+
+class EmbedWorkerPool:
+    def __init__(self, model_name: str, dim: int, n_workers: int, interactive_workers: int = 1,
+                 slot_rows: int = 256, factory=fastembed_factory, threads: int | None = None,
+                 job_timeout: float = 300.0):
+        self.model_name = model_name
+        self.dim = dim
+        self.n_workers = n_workers
+        self.interactive_workers = min(interactive_workers, n_workers - 1) if n_workers > 1 else 0
+        self.slot_rows = slot_rows
+        self.job_timeout = job_timeout
+        self._factory = factory
+        self._threads = threads or max(1, (os.cpu_count() or 1) // n_workers)
+        self._ctx = multiprocessing.get_context("spawn")
+        self._queued = {lane: collections.deque() for lane in LANES}   # jobs no worker holds yet
+        self._results = self._ctx.Queue()
+        # One slot per worker per lane: a lane can't run more jobs than
+        # there are workers anyway, and bulk can never take interactive's.
+        self._free = {lane: list(range(i * n_workers, (i + 1) * n_workers)) for i, lane in enumerate(LANES)}
+        self._slot_sem = {lane: threading.Semaphore(n_workers) for lane in LANES}
+        self._total_rows = len(LANES) * n_workers * slot_rows
+        self._shm = shared_memory.SharedMemory(create=True, size=self._total_rows * dim * 4)
+        self._rows = np.ndarray((self._total_rows, dim), dtype=np.float32, buffer=self._shm.buf)
+        self._pending = {}        # job_id -> (future, lane, slot, n)
+        # worker index -> the job id it was sent and hasn't finished, or
+        # None. Set before the job is sent, so a worker's death always
+        # accounts for the job it held.
+        self._assigned = [None] * n_workers
+        self._inboxes = [None] * n_workers
+        self._lock = threading.Lock()
+        self._job_ids = itertools.count()
+        self._ready = set()
+        self._failed = {}
+        self._ready_cond = threading.Condition()
+        self._closed = False
+        self._procs = [self._spawn(i) for i in range(n_workers)]
+        self._listener = threading.Thread(target=self._listen, name="embed-worker-results", daemon=True)
+        self._listener.start()
+        atexit.register(self.close)
+
+    def _spawn(self, index):
+        # A fresh inbox every time: a dead worker's may still hold the job
+        # it never picked up, which has been failed already.
+        self._inboxes[index] = self._ctx.Queue()
+        proc = self._ctx.Process(
+            target=_worker_main, name=f"embed-worker-{index}", daemon=True,
+            args=(index, self._inboxes[index], self._results, self._shm.name, self._total_rows, self.dim,
+                  self._factory, self.model_name, self._threads))
+        proc.start()
+        return proc
+
+    def _lanes_of(self, index):
+        return LANES[:1] if index < self.interactive_workers else LANES
+
+    def _dispatch(self):
+        """Sends queued jobs to idle, started workers, interactive first.
+        Caller holds self._lock."""
+        for index in range(self.n_workers):
+            if self._assigned[index] is not None or index not in self._ready or self._closed:
+                continue
+            lane = next((lane for lane in self._lanes_of(index) if self._queued[lane]), None)
+            if lane is None:
+                continue
+            job_id, row, texts = self._queued[lane].popleft()
+            self._assigned[index] = job_id
+            self._inboxes[index].put((job_id, row, texts))
+
+    # ------------------------------------------------------------------
+    # Lifecycle
+    # ------------------------------------------------------------------
+    def wait_ready(self, timeout=None) -> bool:
+        """Blocks until every worker has loaded the model. Raises
+        RuntimeError if any failed to."""
+        with self._ready_cond:
+            self._ready_cond.wait_for(lambda: len(self._ready) + len(self._failed) >= self.n_workers, timeout)
+            if self._failed:
+                raise RuntimeError(f"Embedding worker(s) failed to start: {self._failed}")
+            return len(self._ready) == self.n_workers
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        for inbox in self._inboxes:
+            inbox.put(None)
+        for proc in self._procs:
+            proc.join(timeout=5)
+            if proc.is_alive():
+                proc.terminate()
+        self._listener.join(timeout=5)
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for future, _, _, _ in pending.values():
+            future.set_exception(RuntimeError("Embedding worker pool closed."))
+        del self._rows
+        self._shm.close()
+        self._shm.unlink()
+
+    def _listen(self):
+        last_check = time.monotonic()
+        while not self._closed:
+            if time.monotonic() - last_check >= 1.0:
+                self._respawn_dead()
+                last_check = time.monotonic()
+            try:
+                kind, index, payload = self._results.get(timeout=1.0)
+            except queue.Empty:
+                continue
+            except (EOFError, OSError):
+                return
+            if kind in ("ready", "failed"):
+                with self._ready_cond:
+                    if kind == "ready":
+                        self._ready.add(index)
+                    else:
+                        self._failed[index] = payload
+                        print(f"[EMBED-WORKERS] Worker {index} failed to start: {payload}")
+                    self._ready_cond.notify_all()
+                with self._lock:
+                    self._dispatch()
+                continue
+            with self._lock:
+                if self._assigned[index] == (payload if kind == "done" else payload[0]):
+                    self._assigned[index] = None
+                self._dispatch()
+            if kind == "done":
+                self._finish(payload)
+            else:
+                self._finish(payload[0], f"Embedding worker {index} failed: {payload[1]}")
+
+    def _finish(self, job_id, error=None):
+        """Resolves a job's future and frees its result slot."""
+        with self._lock:
+            future, lane, slot, n = self._pending.pop(job_id, (None, None, None, None))
+        if future is None:
+            return
+        if error is None:
+            row = slot * self.slot_rows
+            future.set_result(self._rows[row:row + n].copy())
+        else:
+            future.set_exception(RuntimeError(error))
+        self._free[lane].append(slot)
+        self._slot_sem[lane].release()
+
+    def _respawn_dead(self):
+        for i, proc in enumerate(self._procs):
+            if not self._closed and not proc.is_alive() and i in self._ready:
+                print(f"[EMBED-WORKERS] Worker {i} exited (code {proc.exitcode}) - restarting it.")
+                with self._ready_cond:
+                    self._ready.discard(i)
+                with self._lock:
+                    job_id, self._assigned[i] = self._assigned[i], None
+                if job_id is not None:
+                    self._finish(job_id, f"Embedding worker {i} exited (code {proc.exitcode}) mid-job.")
+                self._procs[i] = self._spawn(i)
+
+    # ------------------------------------------------------------------
+    # Requests
+    # ------------------------------------------------------------------
+    def _submit(self, texts, lane, deadline):
+        """Queues one job; returns (job id, Future)."""
+        if not self._slot_sem[lane].acquire(timeout=max(0.0, deadline - time.monotonic())):
+            raise TimeoutError
+        future = Future()
+        with self._lock:
+            if self._closed:
+                self._slot_sem[lane].release()
+                raise RuntimeError("Embedding worker pool closed.")
+            slot = self._free[lane].pop()
+            job_id = next(self._job_ids)
+            self._pending[job_id] = (future, lane, slot, len(texts))
+            self._queued[lane].append((job_id, slot * self.slot_rows, list(texts)))
+            self._dispatch()
+        return job_id, future
+
+    def _abandon(self, job_ids):
+        """Fails jobs a caller stopped waiting for; one still queued is
+        dropped, one a worker holds is left to finish (and free its slot)."""
+        dropped = []
+        with self._lock:
+            for lane in LANES:
+                dropped += [job[0] for job in self._queued[lane] if job[0] in job_ids]
+                self._queued[lane] = collections.deque(job for job in self._queued[lane] if job[0] not in job_ids)
+        for job_id in dropped:
+            self._finish(job_id, "Embedding job abandoned (timed out).")
+
+    def embed(self, texts, lane: str = "interactive", timeout=None) -> np.ndarray:
+        """(len(texts), dim) float32 embeddings, computed by the workers.
+        Raises TimeoutError if they aren't all back within `timeout`
+        seconds (default: job_timeout)."""
+        if lane not in self._queued:
+            raise ValueError(f"Unknown lane {lane!r} (expected one of {LANES}).")
+        if len(self._failed) == self.n_workers:
+            raise RuntimeError(f"No embedding worker is running: {self._failed}")
+        timeout = self.job_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        out = np.empty((len(texts), self.dim), dtype=np.float32)
+        jobs = []
+        try:
+            for start in range(0, len(texts), self.slot_rows):
+                jobs.append((start, *self._submit(texts[start:start + self.slot_rows], lane, deadline)))
+            for start, _job_id, future in jobs:
+                rows = future.result(max(0.0, deadline - time.monotonic()))
+                out[start:start + len(rows)] = rows
+        except (TimeoutError, FutureTimeoutError):
+            self._abandon({job_id for _start, job_id, _future in jobs})
+            raise TimeoutError(f"Embedding {len(texts)} text(s) on the {lane} lane took over {timeout}s.") from None
+        return out
@@ -5,6 +5,7 @@ import io
 import json as _json
 import os
 import re
+import threading
 
 import numpy as np
 import pdfplumber
@@ -29,6 +30,10 @@ except ImportError:
 
 import requests
 
+from embed_batcher import MicroBatcher
+from embed_workers import EmbedWorkerPool
+from ttl_cache import TTLCache
+
 load_dotenv()
 
 CHAT_MODEL = "openai/gpt-oss-20b"
@@ -265,19 +270,154 @@ TAVILY_API_KEY = get_secret("TAVILY_API_KEY")
 TAVILY_URL = "https://api.tavily.com/search"
 
 _embedder = None
-
-
-def get_embedder():
-    global _embedder
-    if _embedder is None:
-        _embedder = TextEmbedding(model_name=EMBED_MODEL_NAME)
-    return _embedder
-
-
-def embed_texts(texts):
+_concurrent_embedder = None
+_embedder_lock = threading.Lock()
+
+# Optional out-of-process embedding (embed_workers.py): with EMBED_WORKERS
+# > 0 the model runs in that many local worker processes instead of this
+# one, and query embeddings (the "interactive" lane) are served ahead of
+# document indexing ("bulk") - EMBED_INTERACTIVE_WORKERS of the workers
+# take interactive work only - so a large upload being embedded doesn't
+# slow chat down. 0 (the default) keeps the in-process model.
+EMBED_WORKERS = int(os.environ.get("EMBED_WORKERS", "0"))
+EMBED_INTERACTIVE_WORKERS = int(os.environ.get("EMBED_INTERACTIVE_WORKERS", "1"))
+_embed_pool = None
+_embed_pool_lock = threading.Lock()
+
+# Cores document indexing may keep busy, across all uploads (default:
+# every core but one, left for request handling). rag_store runs up to
+# this many bulk embedding batches at once; for that to stay within the
+# budget, those calls (embed_texts(..., concurrent=True)) go to a second
+# in-process session with EMBED_THREADS = cores // budget ONNX intra-op
+# threads - with ONNX Runtime's default of one per core, N concurrent
+# batches would each have spanned every core. Query embeddings and
+# build_index() keep the default session at full thread count. (With
+# EMBED_WORKERS the threads are split between the worker processes
+# instead, see embed_workers.fastembed_factory.)
+EMBED_CORE_BUDGET = int(os.environ.get("RAG_EMBED_CORE_BUDGET", str(max(1, (os.cpu_count() or 1) - 1))))
+EMBED_THREADS = int(os.environ.get("EMBED_THREADS", str(max(1, (os.cpu_count() or 1) // EMBED_CORE_BUDGET))))
+
+
+def get_embedder(concurrent=False):
+    """The in-process model: the default session, or (`concurrent`) the
+    one sized for EMBED_CORE_BUDGET parallel bulk calls - loaded on the
+    first upload."""
+    global _embedder, _concurrent_embedder
+    with _embedder_lock:
+        if concurrent:
+            if _concurrent_embedder is None:
+                _concurrent_embedder = TextEmbedding(model_name=EMBED_MODEL_NAME, threads=EMBED_THREADS)
+            return _concurrent_embedder
+        if _embedder is None:
+            _embedder = TextEmbedding(model_name=EMBED_MODEL_NAME)
+        return _embedder
+
+
+def get_embed_pool():
+    """The embedding worker pool (started on first use), or None when
+    embeddings run in-process."""
+    global _embed_pool
+    if EMBED_WORKERS <= 0:
+        return None
+    with _embed_pool_lock:
+        if _embed_pool is None:
+            _embed_pool = EmbedWorkerPool(EMBED_MODEL_NAME, EMBED_DIM, EMBED_WORKERS, EMBED_INTERACTIVE_WORKERS)
+    return _embed_pool
+
+
+def preload_embedder():
+    """Loads the model wherever embeddings will run. If the worker
+    processes can't start, falls back to the in-process model."""
+    global EMBED_WORKERS, _embed_pool
+    pool = get_embed_pool()
+    if pool is not None:
+        try:
+            pool.wait_ready()
+            return
+        except RuntimeError as e:
+            print(f"[EMBED] {e} - falling back to the in-process embedding model.")
+            EMBED_WORKERS = 0
+            _embed_pool = None
+            pool.close()
+    get_embedder()
+
+
+def embed_texts(texts, lane="interactive", concurrent=False):
+    """`lane` only matters with EMBED_WORKERS: "bulk" for background
+    document indexing, "interactive" for anything a request waits on.
+    `concurrent` only matters without them: the caller runs several of
+    these calls at once (see EMBED_CORE_BUDGET)."""
     if not texts:
         return np.zeros((0, EMBED_DIM))
-    return np.array(list(get_embedder().embed(texts)))
+    pool = get_embed_pool()
+    if pool is not None:
+        return pool.embed(list(texts), lane)
+    return np.array(list(get_embedder(concurrent).embed(texts)))
+
+
+# Single-query embeddings (one per /chat, retrieval) from concurrent
+# requests are coalesced into one model call (embed_batcher.py): the
+# worker waits up to EMBED_QUERY_BATCH_WINDOW_MS for more queries after the
+# first, or until EMBED_QUERY_MAX_BATCH are queued. EMBED_QUERY_MAX_BATCH=1
+# turns batching off (direct embed_texts call per query).
+EMBED_QUERY_BATCH_WINDOW_MS = float(os.environ.get("EMBED_QUERY_BATCH_WINDOW_MS", "2"))
+EMBED_QUERY_MAX_BATCH = int(os.environ.get("EMBED_QUERY_MAX_BATCH", "32"))
+# Looked up at call time (not bound here) so replacing embed_texts - as the
+# benchmarks do - also replaces what the batcher runs.
+_query_batcher = MicroBatcher(lambda texts: embed_texts(texts), EMBED_QUERY_BATCH_WINDOW_MS,
+                              EMBED_QUERY_MAX_BATCH, name="embed-query-batcher")
+
+
+# Recent query embeddings, keyed by (model, query with whitespace
+# collapsed): regenerate/retry resends the same question, and a cache hit
+# skips the model entirely. Bounded by EMBED_QUERY_CACHE_SIZE entries and
+# EMBED_QUERY_CACHE_TTL_SECONDS; EMBED_QUERY_CACHE_SIZE=0 disables it.
+# query_cache_stats() has the hit counters (also shown by /rag-status).
+EMBED_QUERY_CACHE_SIZE = int(os.environ.get("EMBED_QUERY_CACHE_SIZE", "1024"))
+EMBED_QUERY_CACHE_TTL_SECONDS = float(os.environ.get("EMBED_QUERY_CACHE_TTL_SECONDS", "600"))
+_query_cache = TTLCache(EMBED_QUERY_CACHE_SIZE, EMBED_QUERY_CACHE_TTL_SECONDS)
+
+
+def embed_query(text: str) -> np.ndarray:
+    """Embedding of one query text (1-D, read-only), from the query cache or
+    batched with concurrent callers'."""
+    normalized = " ".join(text.split())
+    key = (EMBED_MODEL_NAME, normalized)
+    vec = _query_cache.get(key)
+    if vec is None:
+        vec = np.asarray(_query_batcher(normalized))
+        vec.flags.writeable = False   # shared by every caller that hits the cache
+        _query_cache.put(key, vec)
+    return vec
+
+
+def embed_queries(texts) -> np.ndarray:
+    """(len(texts), EMBED_DIM) embeddings of several query texts: cache hits
+    are reused and every miss goes to the model in a single call (one miss
+    is batched with concurrent callers', like embed_query)."""
+    normalized = [" ".join(t.split()) for t in texts]
+    out = np.zeros((len(texts), EMBED_DIM), dtype=np.float32)
+    misses = {}
+    for i, text in enumerate(normalized):
+        vec = _query_cache.get((EMBED_MODEL_NAME, text))
+        if vec is None:
+            misses.setdefault(text, []).append(i)
+        else:
+            out[i] = vec
+    if len(misses) == 1:
+        text, rows = misses.popitem()
+        out[rows] = embed_query(text)
+    elif misses:
+        for (text, rows), vec in zip(misses.items(), embed_texts(list(misses))):
+            vec = np.array(vec, dtype=np.float32)
+            vec.flags.writeable = False
+            _query_cache.put((EMBED_MODEL_NAME, text), vec)
+            out[rows] = vec
+    return out
+
+
+def query_cache_stats() -> dict:
+    return _query_cache.stats()
 
 
 def extract_text_from_pdf(file) -> str:
@@ -326,36 +466,68 @@ def extract_pages_from_pdf(file):
     Returns a list of (page_number, text) tuples, 1-indexed. Falls back to
     per-page OCR for scanned pages with little/no embedded text.
     """
+    return list(iter_pages_from_pdf(file))
+
+
+def iter_pages_from_pdf(file, after_page: int = 0):
+    """
+    Streaming form of extract_pages_from_pdf(): yields the same (page,
+    text) tuples in the same order, each as soon as it is known, so the
+    RAG store can chunk and embed early pages while later ones are still
+    being extracted or OCR'd. Pages up to `after_page` are skipped (and
+    not OCR'd) - the RAG store resuming an interrupted extraction.
+
+    Whether to OCR is decided for the whole document (fewer than 30 chars
+    of embedded text per page on average = scanned), so pages from the
+    first empty one onwards are held back until that's settled - which,
+    for a document with real text, is as soon as it has enough of it.
+    """
     try:
         file.seek(0)
     except Exception:
         pass
-    pages = []
+    held = []           # [page, text] from the first empty page on, until decided
+    scanned = None      # None = undecided
     with pdfplumber.open(file) as pdf:
+        threshold = 30 * max(len(pdf.pages), 1)
+        total_chars = 0
         for i, page in enumerate(pdf.pages, start=1):
-            pages.append([i, (page.extract_text() or "").strip()])
+            text = (page.extract_text() or "").strip()
+            total_chars += len(text)
+            if scanned is None and total_chars >= threshold:
+                scanned = False
+                yield from ((p, t) for p, t in held if t and p > after_page)
+                held = []
+            if held or (not text and scanned is None):
+                held.append([i, text])
+            elif text and i > after_page:
+                yield (i, text)
+    held = [[p, t] for p, t in held if p > after_page]
+    if scanned is False or not held:
+        yield from ((p, t) for p, t in held if t)
+        return
 
-    total_chars = sum(len(t) for _, t in pages)
-    if total_chars < 30 * max(len(pages), 1):
-        # Likely a scanned document - OCR each page as an image.
+    # Likely a scanned document - OCR each page as an image.
+    try:
+        import pypdfium2 as pdfium
         try:
-            import pypdfium2 as pdfium
-            try:
-                file.seek(0)
-            except Exception:
-                pass
-            raw_bytes = file.read() if hasattr(file, "read") else open(file, "rb").read()
-            pdf_doc = pdfium.PdfDocument(raw_bytes)
-            for i in range(len(pdf_doc)):
-                if pages[i][1]:
-                    continue  # this page already had real embedded text
-                bitmap = pdf_doc[i].render(scale=3)
-                ocr_text = pytesseract.image_to_string(bitmap.to_pil())
-                pages[i][1] = ocr_text.strip()
+            file.seek(0)
         except Exception:
             pass
-
-    return [(p, t) for p, t in pages if t]
+        raw_bytes = file.read() if hasattr(file, "read") else open(file, "rb").read()
+        pdf_doc = pdfium.PdfDocument(raw_bytes)
+    except Exception:
+        pdf_doc = None
+    for page_num, text in held:
+        if not text and pdf_doc is not None:
+            # this page had no real embedded text
+            try:
+                bitmap = pdf_doc[page_num - 1].render(scale=3)
+                text = pytesseract.image_to_string(bitmap.to_pil()).strip()
+            except Exception:
+                pdf_doc = None   # as before: stop OCR'ing after the first failure
+        if text:
+            yield (page_num, text)
 
 
 def extract_pages_from_pptx(file):
@@ -404,6 +576,20 @@ def load_file_pages(path_or_buffer, filename: str):
     return [(None, text)] if text.strip() else []
 
 
+def iter_file_pages(path_or_buffer, filename: str, after_page: int = 0):
+    """Streaming form of load_file_pages(): PDFs are yielded page by page
+    as they are extracted (iter_pages_from_pdf()), other types all at once.
+    Numbered pages up to `after_page` are skipped."""
+    ext = filename.lower().rsplit(".", 1)[-1] if "." in filename else ""
+    if ext == "pdf":
+        buf = io.BytesIO(path_or_buffer) if isinstance(path_or_buffer, (bytes, bytearray)) else path_or_buffer
+        yield from iter_pages_from_pdf(buf, after_page)
+        return
+    for page, text in load_file_pages(path_or_buffer, filename):
+        if page is None or page > after_page:
+            yield (page, text)
+
+
 class UnsupportedFileError(Exception):
     """Raised when a file's content can't be extracted, so callers (the
     /upload route) can surface a proper error message to the user instead
@@ -718,7 +904,7 @@ def build_index(documents):
     return {
         "chunks": chunks,
         "sources": sources,
-        "embeddings": embed_texts(chunks)
+        "embeddings": embed_texts(chunks, lane="bulk")
     }
 
 
@@ -735,10 +921,12 @@ def get_base_index():
     return _base_index
 
 
-def retrieve(index, query: str, top_k: int = TOP_K):
+def retrieve(index, query: str, top_k: int = TOP_K, q_vec=None):
+    """`q_vec`: the query's embedding, if the caller already has it."""
     if index["embeddings"].shape[0] == 0 or not query.strip():
         return []
-    q_vec = embed_texts([query])[0]
+    if q_vec is None:
+        q_vec = embed_query(query)
     emb = index["embeddings"]
     denom = np.linalg.norm(emb, axis=1) * np.linalg.norm(q_vec)
     denom[denom == 0] = 1e-8
@@ -1431,7 +1619,7 @@ def resolve_referenced_documents(query: str, uploaded_docs: dict, last_uploaded:
 
 
 def build_prompt(query, index, chat_history, memory_limit=14, extra_file_content="",
-                  uploaded_docs=None, last_uploaded=None, last_uploaded_batch=None):
+                  uploaded_docs=None, last_uploaded=None, last_uploaded_batch=None, tenant=None):
     if is_greeting_or_smalltalk(query):
         newline = "\n"
         recent_lines = newline.join(f"{m['role']}: {m['message']}" for m in chat_history[-4:])
@@ -1443,7 +1631,15 @@ User: {query}
 Reply briefly and naturally (1-2 sentences)."""
         return prompt, [], False, True, []
 
-    retrieved = retrieve(index, query)
+    # The query is embedded once here and that vector is used by every
+    # retrieval path below - base index, hybrid_search() over indexed
+    # uploads, the raw-text fallback for files still being indexed -
+    # instead of each embedding it again. It is computed even for a blank
+    # query (which retrieve() skips): the raw-text fallbacks score file
+    # chunks against it with no blank-query check of their own.
+    q_vec = embed_query(query)
+
+    retrieved = retrieve(index, query, q_vec=q_vec)
     doc_context = "\n\n".join(chunk for chunk, src, score in retrieved)[:3000]
     uploaded_sources_used = []
 
@@ -1506,7 +1702,7 @@ Reply briefly and naturally (1-2 sentences)."""
                     # (extract_text_from_pptx already includes all of them)
                     # instead of the PDF-oriented cap/sample path below.
                     file_context_parts.append(f"[Source: {fname}]\n{text}")
-                elif len(text) <= per_doc_cap or fname not in rag_store.list_indexed():
+                elif len(text) <= per_doc_cap or fname not in rag_store.list_indexed(tenant):
                     # Small doc, or not yet indexed (e.g. indexing still
                     # running in the background) - use raw text as before.
                     file_context_parts.append(f"[Source: {fname}]\n{text[:per_doc_cap]}")
@@ -1515,7 +1711,7 @@ Reply briefly and naturally (1-2 sentences)."""
                     # instead of only ever seeing the first per_doc_cap
                     # characters, so summaries stay accurate on 300-500 page
                     # documents rather than describing only the intro.
-                    sampled = rag_store.sample_document_chunks(fname, max_chunks=14)
+                    sampled = rag_store.sample_document_chunks(fname, max_chunks=14, tenant=tenant)
                     for s in sampled:
                         citations.append({"filename": fname, "page": s["page"], "snippet": s["text"][:200]})
                     block = "\n\n".join(
@@ -1553,15 +1749,15 @@ Reply briefly and naturally (1-2 sentences)."""
             if page_match:
                 requested_page = int(page_match.group(1) or page_match.group(2))
                 for fname in resolved_ordered:
-                    page_chunks = rag_store.get_chunks_by_page(fname, requested_page)
+                    page_chunks = rag_store.get_chunks_by_page(fname, requested_page, tenant=tenant)
                     if page_chunks:
                         by_file[fname] = page_chunks
                         for c in page_chunks:
                             citations.append({"filename": fname, "page": requested_page, "snippet": c["text"][:200]})
                     else:
-                        progress = rag_store.get_progress(fname)
+                        progress = rag_store.get_progress(fname, tenant=tenant)
                         if progress.get("status") == "done":
-                            lo, hi = rag_store.get_page_range(fname)
+                            lo, hi = rag_store.get_page_range(fname, tenant=tenant)
                             print(f"[RAG] Page {requested_page} not found in '{fname}' "
                                   f"(indexed page range: {lo}-{hi}).")
                             if lo is not None:
@@ -1583,7 +1779,7 @@ Reply briefly and naturally (1-2 sentences)."""
                                 f"in a moment, rather than guessing at page content.)"
                             )
 
-            indexed_files = rag_store.list_indexed()
+            indexed_files = rag_store.list_indexed(tenant)
             ready = [f for f in resolved_ordered if f in indexed_files]
             not_ready = [f for f in resolved_ordered if f not in indexed_files]
             if not_ready:
@@ -1592,7 +1788,7 @@ Reply briefly and naturally (1-2 sentences)."""
                       f"falling back to direct search of raw text for these.")
 
             if ready and not (page_match and by_file):
-                results = rag_store.hybrid_search(ready, query, top_k=max(TOP_K, 5))
+                results = rag_store.hybrid_search(ready, query, top_k=max(TOP_K, 5), tenant=tenant, q_vec=q_vec)
                 for r in results:
                     by_file.setdefault(r["filename"], []).append(r)
                     citations.append({"filename": r["filename"], "page": r["page"], "snippet": r["text"][:200]})
@@ -1610,7 +1806,6 @@ Reply briefly and naturally (1-2 sentences)."""
                 file_chunks = chunk_text(text)
                 if not file_chunks:
                     continue
-                q_vec = embed_texts([query])[0]
                 file_embeddings = embed_texts(file_chunks)
                 denom = np.linalg.norm(file_embeddings, axis=1) * np.linalg.norm(q_vec)
                 denom[denom == 0] = 1e-8
@@ -1642,7 +1837,6 @@ Reply briefly and naturally (1-2 sentences)."""
         file_chunks = chunk_text(extra_file_content)
         if file_chunks:
             file_embeddings = embed_texts(file_chunks)
-            q_vec = embed_texts([query])[0]
             denom = np.linalg.norm(file_embeddings, axis=1) * np.linalg.norm(q_vec)
             denom[denom == 0] = 1e-8
             sims = (file_embeddings @ q_vec) / denom
@@ -1677,10 +1871,10 @@ Give a complete, well-structured answer following your response style rules."""
 
 def chat_with_agent_stream(query, index, chat_history, memory_limit=14, extra_file_content="",
                             uploaded_docs=None, last_uploaded=None, last_uploaded_batch=None, model=None,
-                            persona_prompt=None, memory_context=None):
+                            persona_prompt=None, memory_context=None, tenant=None):
     prompt, doc_sources, web_used, _, citations = build_prompt(
         query, index, chat_history, memory_limit, extra_file_content,
-        uploaded_docs, last_uploaded, last_uploaded_batch
+        uploaded_docs, last_uploaded, last_uploaded_batch, tenant=tenant
     )
     return (stream_groq(prompt, model=model, persona_prompt=persona_prompt, memory_context=memory_context),
             doc_sources, web_used, citations)
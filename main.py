@@ -43,13 +43,19 @@ def _preload_models():
     this, the FIRST /chat or /upload after a cold start paid the full
     model-download/load cost inline, which looked exactly like the same
     "everything is slow" symptom this whole pass is meant to fix, just
-    from a different cause. rag_store's own module-level FAISS/BM25 load
-    already runs at import time (see rag_store.py's `_load()`/
-    `_rebuild_bm25()` calls), so it needs no extra wiring here.
+    from a different cause. rag_store loads each user's shard on first
+    access (memory-mapped, so that is quick; BM25 warms up after it in the
+    background - see rag_store.py's `_load()`/`_warm_up()`), so it needs
+    no wiring here and doesn't hold up boot. Uploads whose
+    indexing the last shutdown interrupted are queued again here (they
+    resume from their checkpoints, in the background).
     """
-    engine.get_embedder()
+    engine.preload_embedder()
     engine.get_base_index()
     print("[STARTUP] Embedding model and base index preloaded.")
+    resumed = rag_store.resume_checkpoints()
+    if resumed:
+        print(f"[STARTUP] Resuming indexing of {resumed} interrupted upload(s).")
 
 
 # ============================================================================
@@ -77,20 +83,49 @@ def get_current_user(creds: HTTPAuthorizationCredentials = Depends(_bearer_schem
                              detail="Invalid token type.")
     return {"id": int(payload["sub"]), "email": payload.get("email"), "name": payload.get("name")}
 
-# Store uploaded documents in memory: {filename: extracted_text}
-uploaded_documents = {}
-last_uploaded_filename = None
+
+# Admin-only routes (index maintenance): users whose email is listed in
+# ADMIN_EMAILS (comma-separated), defaulting to the ADMIN_NOTIFY_EMAIL
+# that already receives the admin notifications.
+ADMIN_EMAILS = {e.strip().lower() for e in
+                (os.environ.get("ADMIN_EMAILS") or auth.ADMIN_NOTIFY_EMAIL or "").split(",") if e.strip()}
+
+
+def get_admin_user(user=Depends(get_current_user)):
+    if (user.get("email") or "").lower() not in ADMIN_EMAILS:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required.")
+    return user
+
+# Uploaded documents, in memory and PER USER (user id -> _UserUploads).
+# These used to be process-wide, which stopped working once rag_store gave
+# every user their own index shard (tenant = user id): each /chat looked up
+# every other user's files in the caller's shard, found them "not ready"
+# forever, re-embedded their raw text on every message, and put their names
+# and text into the caller's prompt.
+_user_uploads = {}
 # Shared-chat links: backed by db.py's SharedChat table (Postgres), same
 # durable storage as chat sessions/messages - see db.create_shared_chat()/
 # db.get_shared_chat(). Was an in-memory dict before, which meant every
 # link died silently on the next restart/redeploy.
-# Tracks files uploaded together in one multi-select action, so the chat
-# endpoint can default to using ALL of them (not just the single most
-# recent file) when the user attaches several files at once. Purely
-# additive: a normal single-file upload (no batch_id) behaves exactly as
-# before, only setting last_uploaded_filename.
-last_uploaded_batch = []
-_current_batch_id = None
+
+
+class _UserUploads:
+    def __init__(self):
+        self.documents = {}         # {filename: extracted_text}
+        self.last_uploaded = None
+        # Tracks files uploaded together in one multi-select action, so the
+        # chat endpoint can default to using ALL of them (not just the
+        # single most recent file) when the user attaches several files at
+        # once. Purely additive: a normal single-file upload (no batch_id)
+        # behaves exactly as before, only setting last_uploaded.
+        self.last_batch = []
+        self.batch_id = None
+
+
+def _uploads_for(user) -> _UserUploads:
+    # dict.setdefault is atomic, so concurrent first requests of one user
+    # still end up sharing a single entry.
+    return _user_uploads.setdefault(user["id"], _UserUploads())
 
 
 class Message(BaseModel):
@@ -332,11 +367,28 @@ def rag_status():
         "files_in_folder": os.listdir(engine.DOCS_FOLDER) if os.path.isdir(engine.DOCS_FOLDER) else [],
         "chunks_indexed": len(index["chunks"]),
         "sources_indexed": sorted(set(index["sources"])),
-        "uploaded_documents": list(uploaded_documents.keys()),
-        "last_uploaded": last_uploaded_filename,
+        "users_with_uploads": sum(1 for u in list(_user_uploads.values()) if u.documents),
+        "uploaded_document_count": sum(len(u.documents) for u in list(_user_uploads.values())),
+        "rag_store_shards": rag_store.shard_stats(),
+        "query_embedding_cache": engine.query_cache_stats(),
+        "search_result_cache": rag_store.result_cache_stats(),
     }
 
 
+@app.post("/admin/rag/compact")
+def admin_rag_compact(tenant: int | None = None, admin=Depends(get_admin_user)):
+    """Starts compacting a tenant's uploaded-document index (tenant = user
+    id; omitted = the unsharded store) in the background. Also triggered
+    automatically once enough of a shard is deleted chunks - see
+    rag_store.compact()."""
+    return rag_store.compact(tenant)
+
+
+@app.get("/admin/rag/compact")
+def admin_rag_compact_progress(tenant: int | None = None, admin=Depends(get_admin_user)):
+    return rag_store.get_compaction_progress(tenant)
+
+
 @app.get("/models")
 def list_models():
     return {
@@ -350,6 +402,7 @@ def list_models():
 
 @app.post("/chat")
 def chat(req: ChatRequest, user=Depends(get_current_user)):
+    uploads = _uploads_for(user)
     if req.research_mode:
         generator, sources = engine.research_report_stream(req.query, model=req.model)
 
@@ -358,7 +411,7 @@ def chat(req: ChatRequest, user=Depends(get_current_user)):
                 "type": "meta",
                 "doc_sources": [],
                 "web_used": True,
-                "uploaded_docs": list(uploaded_documents.keys()),
+                "uploaded_docs": list(uploads.documents.keys()),
                 "research_sources": sources,
             }
             yield f"data: {json.dumps(meta)}\n\n"
@@ -380,12 +433,13 @@ def chat(req: ChatRequest, user=Depends(get_current_user)):
         req.query,
         index,
         history,
-        uploaded_docs=uploaded_documents,
-        last_uploaded=last_uploaded_filename,
-        last_uploaded_batch=last_uploaded_batch,
+        uploaded_docs=uploads.documents,
+        last_uploaded=uploads.last_uploaded,
+        last_uploaded_batch=uploads.last_batch,
         model=req.model,
         persona_prompt=req.persona_prompt,
         memory_context=req.memory_context,
+        tenant=user["id"],
     )
 
     def event_stream():
@@ -393,7 +447,7 @@ def chat(req: ChatRequest, user=Depends(get_current_user)):
             "type": "meta",
             "doc_sources": doc_sources,
             "web_used": web_used,
-            "uploaded_docs": list(uploaded_documents.keys())
+            "uploaded_docs": list(uploads.documents.keys())
         }
         yield f"data: {json.dumps(meta)}\n\n"
         full_text_parts = []
@@ -551,7 +605,7 @@ def background_task(req: BackgroundTaskRequest, user=Depends(get_current_user)):
     """
     Background agent mode: starts a query running server-side without
     needing the chat stream/tab to stay open, returns a job_id immediately.
-    Fully isolated from /chat's session state (uploaded_documents, etc).
+    Fully isolated from /chat's session state (the user's uploads, etc).
     """
     job_id = engine.start_background_task(req.query, model=req.model, persona_prompt=req.persona_prompt)
     return {"job_id": job_id}
@@ -567,7 +621,6 @@ def background_task_status(job_id: str, user=Depends(get_current_user)):
 
 @app.post("/upload")
 async def upload(file: UploadFile = File(...), batch_id: str = Form(None), user=Depends(get_current_user)):
-    global last_uploaded_filename, last_uploaded_batch, _current_batch_id
     contents = await file.read()
     try:
         # engine.load_file() does synchronous, CPU-bound work (pdfplumber
@@ -599,16 +652,17 @@ async def upload(file: UploadFile = File(...), batch_id: str = Form(None), user=
             "filename": file.filename,
             "message": "No text could be extracted."
         }
-    uploaded_documents[file.filename] = text
-    last_uploaded_filename = file.filename
+    uploads = _uploads_for(user)
+    uploads.documents[file.filename] = text
+    uploads.last_uploaded = file.filename
     if batch_id:
-        if batch_id != _current_batch_id:
-            _current_batch_id = batch_id
-            last_uploaded_batch = []
-        last_uploaded_batch.append(file.filename)
+        if batch_id != uploads.batch_id:
+            uploads.batch_id = batch_id
+            uploads.last_batch = []
+        uploads.last_batch.append(file.filename)
     else:
-        _current_batch_id = None
-        last_uploaded_batch = [file.filename]
+        uploads.batch_id = None
+        uploads.last_batch = [file.filename]
 
     # Kick off page-aware chunking + embedding + FAISS/BM25 indexing in
     # the background so this response isn't held up by it (this is the
@@ -619,13 +673,15 @@ async def upload(file: UploadFile = File(...), batch_id: str = Form(None), user=
     # Runs on rag_store's own bounded worker pool, not a per-upload thread,
     # so many simultaneous uploads queue safely. Status is pollable via
     # GET /upload-status/{filename}; the response shape below is unchanged.
-    rag_store.index_document_background(file.filename, contents)
+    # Indexed into the uploader's own shard (tenant = user id), which is
+    # the only one their /chat searches.
+    rag_store.index_document_background(file.filename, contents, tenant=user["id"])
 
     return {
         "success": True,
         "filename": file.filename,
         "characters": len(text),
-        "documents_loaded": len(uploaded_documents),
+        "documents_loaded": len(uploads.documents),
         "message": "Document indexed successfully."
     }
 
@@ -638,29 +694,29 @@ def upload_status(filename: str, user=Depends(get_current_user)):
     change /upload's response shape or timing, so existing frontend flows
     that ignore this endpoint keep working exactly as before.
     """
-    return rag_store.get_progress(filename)
+    return rag_store.get_progress(filename, tenant=user["id"])
 
 
 @app.delete("/documents/{filename}")
 def delete_document(filename: str, user=Depends(get_current_user)):
-    global last_uploaded_filename
-    if filename not in uploaded_documents:
+    uploads = _uploads_for(user)
+    if filename not in uploads.documents:
         return {"success": False, "message": f"'{filename}' not found."}
-    del uploaded_documents[filename]
-    if last_uploaded_filename == filename:
-        last_uploaded_filename = list(uploaded_documents.keys())[-1] if uploaded_documents else None
+    del uploads.documents[filename]
+    if uploads.last_uploaded == filename:
+        uploads.last_uploaded = list(uploads.documents.keys())[-1] if uploads.documents else None
     return {
         "success": True,
         "message": f"'{filename}' removed.",
-        "remaining_documents": list(uploaded_documents.keys())
+        "remaining_documents": list(uploads.documents.keys())
     }
 
 
 @app.post("/clear")
 def clear_documents(user=Depends(get_current_user)):
-    global last_uploaded_filename
-    uploaded_documents.clear()
-    last_uploaded_filename = None
+    uploads = _uploads_for(user)
+    uploads.documents.clear()
+    uploads.last_uploaded = None
     return {
         "success": True,
         "message": "All uploaded documents removed."
@@ -669,10 +725,11 @@ def clear_documents(user=Depends(get_current_user)):
 
 @app.get("/documents")
 def documents(user=Depends(get_current_user)):
+    uploads = _uploads_for(user)
     return {
-        "count": len(uploaded_documents),
-        "documents": list(uploaded_documents.keys()),
-        "last_uploaded": last_uploaded_filename,
+        "count": len(uploads.documents),
+        "documents": list(uploads.documents.keys()),
+        "last_uploaded": uploads.last_uploaded,
     }
 
 
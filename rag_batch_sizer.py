@@ -0,0 +1,111 @@
+"""
+rag_batch_sizer.py
+==================
+Adaptive batch sizing for rag_store's bulk (indexing) embedding.
+
+index_document used to embed in fixed batches of 64 chunks whatever they
+contained. The model's cost - time and, above all, peak memory - is not
+per chunk but per padded token: every text in a batch is padded to the
+longest one, and attention memory grows with the square of that length.
+64 long OCR chunks could spike memory far above 64 short code chunks,
+which in turn left each model call mostly overhead.
+
+BatchSizer plans batches from the texts' lengths instead:
+
+- Token counts are estimated from character counts (CHARS_PER_TOKEN,
+  capped at the model's MAX_TOKENS truncation length). Texts are batched
+  shortest first, so each batch holds texts of similar length and little
+  padding is wasted (rag_store writes vectors back by row number, so
+  embedding order doesn't matter).
+- A batch grows while (a) its estimated peak activation memory - padded
+  tokens x per-token bytes + the attention matrices - stays under the
+  memory ceiling, (b) its padded token count stays within the token
+  budget and (c) it has at most max_batch texts.
+- The token budget follows measured latency: after every batch the
+  seconds-per-padded-token estimate (an exponential moving average) is
+  updated and the budget becomes target_seconds' worth of tokens. Slower
+  machines get smaller batches, faster ones bigger, within the memory
+  ceiling. Before the first measurement the budget is `initial_tokens`.
+
+Thread-safe: one sizer is shared by every upload, so what one document
+measured carries over to the next.
+"""
+
+import math
+import threading
+
+import numpy as np
+
+# Defaults for the BAAI/bge-small-en-v1.5 encoder (engine.EMBED_MODEL_NAME):
+# 512-token truncation, 12 attention heads, and roughly 24 KiB of live
+# float32 activations per token per layer (384 hidden + 1536 FFN
+# intermediates, with ONNX Runtime reusing buffers across layers).
+CHARS_PER_TOKEN = 4.0
+MAX_TOKENS = 512
+BYTES_PER_TOKEN = 24 * 1024
+ATTENTION_HEADS = 12
+EWMA_WEIGHT = 0.3          # weight of the newest latency sample
+
+
+class BatchSizer:
+    def __init__(self, memory_bytes: int, target_seconds: float, max_batch: int, initial_tokens: int):
+        self.memory_bytes = memory_bytes
+        self.target_seconds = target_seconds
+        self.max_batch = max_batch
+        self.initial_tokens = initial_tokens
+        self.seconds_per_token = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def tokens(n_chars: int) -> int:
+        # +2 for the [CLS]/[SEP] tokens every sequence gets.
+        return min(MAX_TOKENS, math.ceil(n_chars / CHARS_PER_TOKEN) + 2)
+
+    @staticmethod
+    def batch_bytes(n: int, seq_len: int) -> int:
+        """Estimated peak activation memory of n texts padded to seq_len."""
+        return n * (seq_len * BYTES_PER_TOKEN + 2 * ATTENTION_HEADS * seq_len * seq_len * 4)
+
+    def token_budget(self) -> int:
+        with self._lock:
+            if self.seconds_per_token is None:
+                return self.initial_tokens
+            return max(1, int(self.target_seconds / self.seconds_per_token))
+
+    def plan(self, rows, lengths, final: bool = True):
+        """
+        Yields batches (int arrays of `rows`) covering every row once,
+        shortest texts first. `lengths` are the texts' character counts,
+        aligned with `rows`. A generator: each batch is sized when it is
+        requested, so it uses every measurement observe() got before.
+        With final=False only full batches are yielded - the rows that
+        would make up a last, partial one are left for the caller to plan
+        again with the texts that arrive after them.
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        tokens = np.array([self.tokens(n) for n in lengths], dtype=np.int64)
+        order = np.argsort(tokens, kind="stable")
+        start = 0
+        while start < len(order):
+            budget = self.token_budget()
+            end = start + 1
+            while end < len(order) and end - start < self.max_batch:
+                n, seq_len = end + 1 - start, int(tokens[order[end]])
+                if n * seq_len > budget or self.batch_bytes(n, seq_len) > self.memory_bytes:
+                    break
+                end += 1
+            if end == len(order) and not final and end - start < self.max_batch:
+                return
+            yield rows[order[start:end]]
+            start = end
+
+    def observe(self, n_texts: int, seq_len: int, seconds: float):
+        """Records that n_texts padded to seq_len tokens took `seconds`."""
+        if n_texts <= 0 or seconds <= 0:
+            return
+        sample = seconds / (n_texts * seq_len)
+        with self._lock:
+            if self.seconds_per_token is None:
+                self.seconds_per_token = sample
+            else:
+                self.seconds_per_token += EWMA_WEIGHT * (sample - self.seconds_per_token)
@@ -0,0 +1,378 @@
+"""
+rag_bench.py
+============
+Offline benchmarks for the uploaded-document retrieval layer (rag_store and
+the modules under it). Not imported by the server - run by hand when tuning
+settings for an instance type or corpus size:
+
+    python rag_bench.py index-modes --n 100000 --queries 500
+
+Each subcommand prints a plain-text report to stdout.
+
+index-modes
+    Recall-vs-latency of the IVF / HNSW sub-index modes (vector_index.py)
+    against the exact flat baseline, over a sweep of nprobe / efSearch.
+
+compression
+    Memory, recall and latency of each RAG_VECTOR_COMPRESSION mode (sq8 /
+    pq / pca, first pass + exact re-rank from the side file) against the
+    uncompressed flat baseline, for a sweep of RERANK_FACTOR.
+
+mixed-rw
+    hybrid_search latency (mean / p50 / p99) from concurrent reader threads,
+    first on an idle store, then while a writer thread keeps indexing and
+    deleting documents - i.e. whether uploads stall chat requests.
+
+query-batching
+    Throughput and latency of single-query embeddings from concurrent
+    clients, called directly vs. through the micro-batcher engine.embed_query
+    uses (embed_batcher.py), for a sweep of batching windows.
+
+The first two default to synthetic clustered unit vectors (random uniform
+vectors have no neighborhood structure and make every ANN index look worse
+than it is on real embeddings); --from-store benchmarks the vectors already
+indexed instead - one user's shard (--tenant, a user id), loaded through
+rag_store the way the server resolves it (./rag_index/tenants/<hash>/),
+or the pre-sharding store directly under ./rag_index/ without --tenant. mixed-rw runs a real rag_store against a temporary
+RAG_INDEX_DIR, with a cheap hashed bag-of-words embedder unless
+--real-embedder is given (so it measures the store, not the model).
+query-batching uses a simulated model (fixed cost per call + cost per
+text, one call at a time) unless --real-embedder is given.
+"""
+
+import argparse
+import contextlib
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+
+import faiss
+import numpy as np
+
+import vector_index
+
+
+def _clustered_unit_vectors(n, dim, n_clusters=200, spread=0.35, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((n_clusters, dim)).astype(np.float32)
+    assign = rng.integers(0, n_clusters, size=n)
+    vecs = centers[assign] + spread * rng.standard_normal((n, dim)).astype(np.float32)
+    vecs /= np.linalg.norm(vecs, axis=1, keepdims=True)
+    return vecs
+
+
+def _store_vectors(tenant=None):
+    import rag_store
+    parts = [sub.vectors() for sub in rag_store._current(tenant)[1].vectors.values()]
+    if not parts:
+        raise SystemExit(f"The shard of tenant={tenant!r} ({rag_store._tenant_dir(tenant)}) is empty - "
+                         f"nothing to benchmark with --from-store.")
+    return np.vstack(parts)
+
+
+def _timed_search(index, queries, k):
+    latencies = []
+    results = []
+    for q in queries:
+        t0 = time.perf_counter()
+        _, ids = index.search(q[None, :], k)
+        latencies.append(time.perf_counter() - t0)
+        results.append(ids[0])
+    lat_ms = np.array(latencies) * 1000
+    return np.array(results), float(np.mean(lat_ms)), float(np.percentile(lat_ms, 99))
+
+
+def _recall(truth, found):
+    hits = sum(len(set(t) & set(f)) for t, f in zip(truth, found))
+    return hits / truth.size
+
+
+def _corpus_and_queries(args):
+    if args.from_store:
+        base = _store_vectors(args.tenant)
+    else:
+        base = _clustered_unit_vectors(args.n, args.dim)
+    rng = np.random.default_rng(1)
+    # Queries are perturbed corpus vectors, so each has real near neighbors
+    # (same as a real question phrased close to a chunk's wording).
+    picks = base[rng.integers(0, len(base), size=args.queries)]
+    queries = picks + 0.1 * rng.standard_normal(picks.shape).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return base, queries
+
+
+def index_modes(args):
+    base, queries = _corpus_and_queries(args)
+    n, dim = base.shape
+    ids = np.arange(n, dtype=np.int64)
+
+    print(f"index-modes: n={n} dim={dim} queries={len(queries)} k={args.k}")
+    rows = []
+
+    t0 = time.perf_counter()
+    flat = vector_index.build(dim, base, ids, kind="flat")
+    build_s = time.perf_counter() - t0
+    truth, mean_ms, p99_ms = _timed_search(flat, queries, args.k)
+    rows.append(("flat", "-", build_s, 1.0, mean_ms, p99_ms))
+
+    t0 = time.perf_counter()
+    ivf = vector_index.build(dim, base, ids, kind="ivf")
+    build_s = time.perf_counter() - t0
+    for nprobe in args.nprobe:
+        vector_index.IVF_NPROBE = nprobe
+        found, mean_ms, p99_ms = _timed_search(ivf, queries, args.k)
+        rows.append(("ivf", f"nprobe={nprobe}", build_s, _recall(truth, found), mean_ms, p99_ms))
+
+    t0 = time.perf_counter()
+    hnsw = vector_index.build(dim, base, ids, kind="hnsw")
+    build_s = time.perf_counter() - t0
+    for ef in args.ef_search:
+        vector_index.HNSW_EF_SEARCH = ef
+        found, mean_ms, p99_ms = _timed_search(hnsw, queries, args.k)
+        rows.append(("hnsw", f"efSearch={ef}", build_s, _recall(truth, found), mean_ms, p99_ms))
+
+    print(f"{'mode':<6} {'setting':<14} {'build_s':>8} {f'recall@{args.k}':>10} {'mean_ms':>8} {'p99_ms':>8}")
+    for mode, setting, build_s, recall, mean_ms, p99_ms in rows:
+        print(f"{mode:<6} {setting:<14} {build_s:>8.1f} {recall:>10.3f} {mean_ms:>8.3f} {p99_ms:>8.3f}")
+
+
+def _resident_bytes(sub):
+    """Bytes that stay in RAM: the FAISS index itself. The side file is
+    memory-mapped, so it's only paged in for re-ranked rows."""
+    return len(faiss.serialize_index(sub.index))
+
+
+def compression(args):
+    base, queries = _corpus_and_queries(args)
+    n, dim = base.shape
+    ids = np.arange(n, dtype=np.int64)
+    print(f"compression: n={n} dim={dim} queries={len(queries)} k={args.k} kind=flat")
+
+    baseline = vector_index.build(dim, base, ids, kind="flat", compression="none")
+    truth, mean_ms, p99_ms = _timed_search(baseline, queries, args.k)
+    base_bytes = _resident_bytes(baseline)
+    rows = [("none", "-", base_bytes, 1.0, 1.0, mean_ms, p99_ms)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in args.modes:
+            sub = vector_index.build(dim, base, ids, kind="flat", compression=mode)
+            actual = sub.compression
+            # Save + reload so re-ranking really reads the mapped side file.
+            path = os.path.join(tmp, f"{mode}.index")
+            vector_index.save(sub, path)
+            sub = vector_index.load(path)
+            for factor in args.rerank_factor:
+                vector_index.RERANK_FACTOR = factor
+                found, mean_ms, p99_ms = _timed_search(sub, queries, args.k)
+                rows.append((actual, f"rerank={factor}", _resident_bytes(sub),
+                             base_bytes / _resident_bytes(sub), _recall(truth, found), mean_ms, p99_ms))
+
+    print(f"{'mode':<6} {'setting':<10} {'ram_MB':>8} {'shrink':>7} {f'recall@{args.k}':>10} {'mean_ms':>8} {'p99_ms':>8}")
+    for mode, setting, nbytes, shrink, recall, mean_ms, p99_ms in rows:
+        print(f"{mode:<6} {setting:<10} {nbytes / 1e6:>8.1f} {shrink:>6.1f}x {recall:>10.3f} "
+              f"{mean_ms:>8.3f} {p99_ms:>8.3f}")
+
+
+_WORDS = ("revenue margin forecast audit ledger invoice contract clause liability warranty "
+          "patient dosage trial cohort protocol sensor voltage circuit firmware latency "
+          "throughput kernel cache shard replica quorum").split()
+
+
+def _synthetic_doc(seed, n_words):
+    rng = np.random.default_rng(seed)
+    words = [_WORDS[i] for i in rng.integers(0, len(_WORDS), size=n_words)]
+    for i in range(0, n_words, 120):
+        words[i] = f"section{i // 120}.\n\n"
+    return " ".join(words).encode("utf-8")
+
+
+def _hashed_embed(texts, lane=None, dim=None, concurrent=False):
+    import engine
+    dim = dim or engine.EMBED_DIM
+    out = np.zeros((len(texts), dim), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for word in text.lower().split():
+            out[row, int(hashlib.md5(word.encode("utf-8")).hexdigest()[:8], 16) % dim] += 1.0
+    return out
+
+
+def _latency_row(label, latencies, n_writes):
+    lat_ms = np.array(latencies) * 1000
+    return (label, len(lat_ms), float(np.mean(lat_ms)), float(np.percentile(lat_ms, 50)),
+            float(np.percentile(lat_ms, 99)), n_writes)
+
+
+def mixed_rw(args):
+    tmp = tempfile.TemporaryDirectory()
+    os.environ["RAG_INDEX_DIR"] = tmp.name
+    import engine
+    if not args.real_embedder:
+        engine.embed_texts = _hashed_embed
+    with contextlib.redirect_stdout(io.StringIO()):
+        import rag_store
+        base_files = [f"base{i}.txt" for i in range(args.files)]
+        for i, name in enumerate(base_files):
+            rag_store.index_document(name, _synthetic_doc(i, args.words))
+    queries = [" ".join(_WORDS[j] for j in np.random.default_rng(q).integers(0, len(_WORDS), size=6))
+               for q in range(64)]
+    print(f"mixed-rw: {args.files} file(s) x {args.words} words ({rag_store._ntotal()} chunks), "
+          f"{args.readers} reader(s), {args.seconds}s per phase, "
+          f"embedder={'real' if args.real_embedder else 'hashed'}")
+
+    def phase(with_writer):
+        stop = threading.Event()
+        latencies, writes = [], [0]
+
+        def reader(seed):
+            rng = np.random.default_rng(seed)
+            while not stop.is_set():
+                q = queries[int(rng.integers(0, len(queries)))]
+                t0 = time.perf_counter()
+                rag_store.hybrid_search(base_files, q, top_k=5)
+                latencies.append(time.perf_counter() - t0)
+
+        def writer():
+            n = 0
+            while not stop.is_set():
+                name = f"upload{n % 4}.txt"
+                rag_store.index_document(name, _synthetic_doc(10_000 + n, args.words))
+                if n % 2:
+                    rag_store.remove_document(name)
+                writes[0] += 1
+                n += 1
+
+        threads = [threading.Thread(target=reader, args=(i,)) for i in range(args.readers)]
+        if with_writer:
+            threads.append(threading.Thread(target=writer))
+        with contextlib.redirect_stdout(io.StringIO()):
+            for t in threads:
+                t.start()
+            time.sleep(args.seconds)
+            stop.set()
+            for t in threads:
+                t.join()
+        return latencies, writes[0]
+
+    rows = [_latency_row("reads only", *phase(False)),
+            _latency_row("reads + writes", *phase(True))]
+    print(f"{'phase':<16} {'searches':>9} {'mean_ms':>8} {'p50_ms':>8} {'p99_ms':>8} {'writes':>7}")
+    for label, n, mean_ms, p50_ms, p99_ms, n_writes in rows:
+        print(f"{label:<16} {n:>9} {mean_ms:>8.2f} {p50_ms:>8.2f} {p99_ms:>8.2f} {n_writes:>7}")
+
+
+def _simulated_model(overhead_ms, per_item_ms):
+    """Stand-in for the ONNX embedder: a fixed cost per call plus a cost
+    per text, one call at a time (a session already spreads a call over
+    every core, so concurrent calls queue rather than overlap)."""
+    lock = threading.Lock()
+
+    def embed(texts):
+        with lock:
+            time.sleep((overhead_ms + per_item_ms * len(texts)) / 1000)
+        return _hashed_embed(texts)
+    return embed
+
+
+def query_batching(args):
+    import engine
+    from embed_batcher import MicroBatcher
+    if args.real_embedder:
+        engine.embed_texts(["warm-up"])   # model load is not part of the measurement
+        embed = engine.embed_texts
+    else:
+        embed = _simulated_model(args.overhead_ms, args.per_item_ms)
+    queries = [" ".join(_WORDS[j] for j in np.random.default_rng(q).integers(0, len(_WORDS), size=8))
+               for q in range(1024)]
+    print(f"query-batching: {args.seconds}s per run, max_batch={args.max_batch}, embedder="
+          + ("real" if args.real_embedder else f"simulated ({args.overhead_ms}ms/call + {args.per_item_ms}ms/text)"))
+
+    def run(call, clients):
+        stop = threading.Event()
+        latencies = []
+
+        def client(seed):
+            rng = np.random.default_rng(seed)
+            while not stop.is_set():
+                q = queries[int(rng.integers(0, len(queries)))]
+                t0 = time.perf_counter()
+                call(q)
+                latencies.append(time.perf_counter() - t0)
+
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+        for t in threads:
+            t.start()
+        time.sleep(args.seconds)
+        stop.set()
+        for t in threads:
+            t.join()
+        return latencies
+
+    rows = []
+    for clients in args.clients:
+        lat_ms = np.array(run(lambda q: embed([q])[0], clients)) * 1000
+        rows.append(("direct", clients, lat_ms, 1.0))
+        for window in args.window_ms:
+            batcher = MicroBatcher(embed, window, args.max_batch)
+            lat_ms = np.array(run(batcher, clients)) * 1000
+            rows.append((f"window={window:g}ms", clients, lat_ms, batcher.mean_batch_size()))
+
+    print(f"{'mode':<14} {'clients':>7} {'qps':>8} {'mean_ms':>8} {'p50_ms':>8} {'p99_ms':>8} {'batch':>6}")
+    for mode, clients, lat_ms, batch in rows:
+        print(f"{mode:<14} {clients:>7} {len(lat_ms) / args.seconds:>8.1f} {np.mean(lat_ms):>8.2f} "
+              f"{np.percentile(lat_ms, 50):>8.2f} {np.percentile(lat_ms, 99):>8.2f} {batch:>6.1f}")
+
+
+def _add_corpus_args(p):
+    p.add_argument("--n", type=int, default=100_000)
+    p.add_argument("--dim", type=int, default=384)
+    p.add_argument("--queries", type=int, default=500)
+    p.add_argument("--k", type=int, default=50, help="matches hybrid_search's usual fetch_k")
+    p.add_argument("--from-store", action="store_true", help="use the vectors already indexed in ./rag_index/")
+    p.add_argument("--tenant", type=int, default=None,
+                   help="with --from-store: the user id whose shard to read (default: the pre-sharding store)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("index-modes", help="recall vs latency of IVF/HNSW against flat")
+    _add_corpus_args(p)
+    p.add_argument("--nprobe", type=int, nargs="+", default=[4, 8, 16, 32, 64])
+    p.add_argument("--ef-search", type=int, nargs="+", default=[32, 64, 128, 256],
+                   help="effective efSearch is max(value, k)")
+    p.set_defaults(func=index_modes)
+
+    p = sub.add_parser("compression", help="memory/recall/latency of sq8, pq, pca vs uncompressed")
+    _add_corpus_args(p)
+    p.add_argument("--modes", nargs="+", default=["sq8", "pq", "pca"], choices=["sq8", "pq", "pca"])
+    p.add_argument("--rerank-factor", type=int, nargs="+", default=[2, 4, 8])
+    p.set_defaults(func=compression)
+
+    p = sub.add_parser("mixed-rw", help="search latency with and without concurrent indexing")
+    p.add_argument("--files", type=int, default=20)
+    p.add_argument("--words", type=int, default=20_000, help="words per synthetic document")
+    p.add_argument("--readers", type=int, default=4)
+    p.add_argument("--seconds", type=float, default=10.0)
+    p.add_argument("--real-embedder", action="store_true", help="use engine.embed_texts as-is")
+    p.set_defaults(func=mixed_rw)
+
+    p = sub.add_parser("query-batching", help="concurrent query embedding: direct vs micro-batched")
+    p.add_argument("--clients", type=int, nargs="+", default=[1, 4, 16, 64])
+    p.add_argument("--window-ms", type=float, nargs="+", default=[0, 2, 5])
+    p.add_argument("--max-batch", type=int, default=32)
+    p.add_argument("--seconds", type=float, default=5.0)
+    p.add_argument("--overhead-ms", type=float, default=6.0, help="simulated model: cost per call")
+    p.add_argument("--per-item-ms", type=float, default=0.4, help="simulated model: cost per text")
+    p.add_argument("--real-embedder", action="store_true", help="use engine.embed_texts as-is")
+    p.set_defaults(func=query_batching)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
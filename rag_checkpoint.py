@@ -0,0 +1,189 @@
+"""
+rag_checkpoint.py
+=================
+Resumable indexing checkpoints for rag_store.
+
+Indexing a large scanned document is minutes of OCR plus minutes of
+embedding, and it used to be all or nothing: a batch timing out at chunk
+9,000 of 12,000, or the server restarting, threw the work away and the
+next attempt started again from page 1. Now rag_store checkpoints a
+document while it is being indexed, and an attempt that finds a
+checkpoint for the same upload picks up where the last one stopped:
+
+- extracted pages are replayed instead of extracted again, and extraction
+  resumes after the last saved page (engine.iter_file_pages(after_page=))
+- chunk vectors embedded before are reused instead of embedded again (the
+  chunk list itself isn't stored: it is re-derived from the pages, which
+  is cheap and deterministic)
+
+Layout, one directory per upload (rag_store keys it by filename + upload
+hash, and lets one indexing run use it at a time):
+
+- meta.json    filename, tenant, upload hash, embedding model + dim, whether
+               extraction finished, how many attempts used it
+- upload.bin   the uploaded bytes, so a restarted server can resume without
+               the client uploading again
+- pages.log    one frame per extracted page: u32 length | u32 crc32 | JSON
+               [page, text]
+- vectors.log  fixed-size records, one per embedded chunk: the 16-byte
+               normalized-text hash + its float32 vector
+
+Both logs are append-only and fsynced once per embedding batch (sync()),
+so a crash loses at most the work since the last batch. A torn tail - a
+crash mid-append - is detected on load (short or bad-CRC frame, partial
+record) and cut off. A checkpoint made for other bytes or another
+embedding model is discarded, never mixed in.
+
+Not thread-safe: one indexing run uses a checkpoint at a time.
+"""
+
+import json
+import os
+import shutil
+import struct
+import zlib
+
+import numpy as np
+
+from rag_wal import atomic_write
+
+FORMAT_VERSION = 1
+_PAGE_FRAME = struct.Struct("<II")
+_HASH_BYTES = 16
+
+
+class IndexCheckpoint:
+    def __init__(self, directory: str, model: str, dim: int):
+        self.dir = directory
+        self.model = model
+        self.dim = dim
+        self.meta_path = os.path.join(directory, "meta.json")
+        self.upload_path = os.path.join(directory, "upload.bin")
+        self.pages_path = os.path.join(directory, "pages.log")
+        self.vectors_path = os.path.join(directory, "vectors.log")
+        self.meta = {}
+        self.pages = []           # (page, text) saved so far, in extraction order
+        self.vectors = {}         # normalized-text hash (hex) -> float32 vector, as loaded
+        self.n_vectors = 0        # vectors saved, by earlier attempts and this one
+        self._pages_f = None
+        self._vectors_f = None
+
+    @property
+    def _record_bytes(self) -> int:
+        return _HASH_BYTES + 4 * self.dim
+
+    @property
+    def extracted(self) -> bool:
+        return bool(self.meta.get("extracted"))
+
+    # ------------------------------------------------------------------
+    # Open / create
+    # ------------------------------------------------------------------
+    @staticmethod
+    def read_meta(directory: str):
+        try:
+            with open(os.path.join(directory, "meta.json"), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def open(self, filename: str, tenant, file_hash: str, raw_bytes: bytes) -> bool:
+        """
+        Resumes the checkpoint in the directory if it was made for this
+        upload (same bytes) with this embedding model; otherwise replaces
+        it with an empty one. Returns whether anything was resumed.
+        """
+        meta = self.read_meta(self.dir)
+        resumed = (meta is not None and meta.get("format") == FORMAT_VERSION
+                   and meta.get("file_hash") == file_hash
+                   and meta.get("model") == self.model and meta.get("dim") == self.dim
+                   and os.path.exists(self.upload_path))
+        if resumed:
+            self.meta = meta
+            self._load()
+        else:
+            self.discard()
+            os.makedirs(self.dir, exist_ok=True)
+            atomic_write(self.upload_path, raw_bytes)
+            self.meta = {"format": FORMAT_VERSION, "filename": filename, "tenant": tenant,
+                         "file_hash": file_hash, "model": self.model, "dim": self.dim,
+                         "extracted": False, "attempts": 0}
+        self.meta["attempts"] += 1
+        self._write_meta()
+        self._pages_f = open(self.pages_path, "ab")
+        self._vectors_f = open(self.vectors_path, "ab")
+        return resumed and bool(self.pages or self.vectors)
+
+    def _load(self):
+        good = 0
+        try:
+            with open(self.pages_path, "rb") as f:
+                data = f.read()
+        except OSError:
+            data = b""
+        while good + _PAGE_FRAME.size <= len(data):
+            length, crc = _PAGE_FRAME.unpack_from(data, good)
+            body = data[good + _PAGE_FRAME.size:good + _PAGE_FRAME.size + length]
+            if len(body) < length or zlib.crc32(body) != crc:
+                break
+            page, text = json.loads(body.decode("utf-8"))
+            self.pages.append((page, text))
+            good += _PAGE_FRAME.size + length
+        self._truncate(self.pages_path, good)
+
+        try:
+            with open(self.vectors_path, "rb") as f:
+                data = f.read()
+        except OSError:
+            data = b""
+        n = len(data) // self._record_bytes
+        if n:
+            records = np.frombuffer(data, dtype=np.uint8, count=n * self._record_bytes).reshape(n, -1)
+            vectors = records[:, _HASH_BYTES:].copy().view("<f4")
+            for i in range(n):
+                self.vectors[records[i, :_HASH_BYTES].tobytes().hex()] = vectors[i]
+        self._truncate(self.vectors_path, n * self._record_bytes)
+        self.n_vectors = n
+
+    @staticmethod
+    def _truncate(path: str, size: int):
+        if os.path.exists(path) and os.path.getsize(path) > size:
+            with open(path, "r+b") as f:
+                f.truncate(size)
+
+    def _write_meta(self):
+        atomic_write(self.meta_path, json.dumps(self.meta).encode("utf-8"))
+
+    # ------------------------------------------------------------------
+    # Recording progress
+    # ------------------------------------------------------------------
+    def add_page(self, page, text: str):
+        body = json.dumps([page, text]).encode("utf-8")
+        self._pages_f.write(_PAGE_FRAME.pack(len(body), zlib.crc32(body)) + body)
+        self.pages.append((page, text))
+
+    def add_vectors(self, hashes, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype="<f4")
+        self._vectors_f.write(b"".join(bytes.fromhex(h) + vectors[i].tobytes() for i, h in enumerate(hashes)))
+        self.n_vectors += len(hashes)
+
+    def sync(self):
+        """Makes everything recorded so far durable."""
+        for f in (self._pages_f, self._vectors_f):
+            f.flush()
+            os.fsync(f.fileno())
+
+    def finish_extraction(self):
+        self.sync()
+        self.meta["extracted"] = True
+        self._write_meta()
+
+    def close(self):
+        for f in (self._pages_f, self._vectors_f):
+            if f is not None:
+                f.close()
+        self._pages_f = self._vectors_f = None
+
+    def discard(self):
+        self.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
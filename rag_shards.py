@@ -0,0 +1,130 @@
+"""
+rag_shards.py
+=============
+Lazily loaded, LRU-evicted registry of rag_store's per-tenant shards.
+
+rag_store used to be one index for every user, loaded in full at import
+time: the memory footprint and the per-search candidate set (BM25 corpus
+statistics, manifest lookups) grew with the total number of tenants, not
+with what the caller can actually see. Each tenant (user) now gets its own
+shard - its own directory, chunk table, write-ahead log and version chain -
+and this registry decides which shards are in memory:
+
+- acquire(key) returns the tenant's shard, loading it on first access.
+  Concurrent acquires of a shard that is loading (or being evicted) wait
+  for that to finish instead of opening the same directory twice.
+- A shard is pinned while acquired (release() unpins it); pinned shards
+  are never evicted, so an in-flight upload keeps its shard even when the
+  registry is over budget.
+- After every load and release the registry evicts the least recently
+  used unpinned shards until the estimated memory of the loaded ones fits
+  the budget. Eviction calls the `close` callback (rag_store snapshots the
+  shard and closes its log) outside the registry lock; the shard's key
+  stays reserved until that finishes.
+
+Searches that took a StoreVersion from a shard before it was evicted keep
+working - versions are immutable and hold their own references.
+"""
+
+import collections
+import contextlib
+import threading
+
+
+class _Entry:
+    __slots__ = ("shard", "pins", "state")
+
+    def __init__(self):
+        self.shard = None
+        self.pins = 0
+        self.state = "loading"      # "loading" | "ready" | "closing"
+
+
+class ShardRegistry:
+    def __init__(self, load, close, size, budget_bytes: int):
+        self._load = load                # key -> shard
+        self._close = close              # shard -> None (flush + release resources)
+        self._size = size                # shard -> estimated resident bytes
+        self.budget_bytes = budget_bytes
+        self._entries = collections.OrderedDict()   # key -> _Entry, least recently used first
+        self._cond = threading.Condition()
+        self.loads = 0
+        self.evictions = 0
+
+    def acquire(self, key):
+        """The shard for `key`, loaded if needed and pinned until release()."""
+        with self._cond:
+            while True:
+                entry = self._entries.get(key)
+                if entry is None:
+                    entry = self._entries[key] = _Entry()
+                    entry.pins = 1
+                    break
+                if entry.state == "ready":
+                    entry.pins += 1
+                    self._entries.move_to_end(key)
+                    return entry.shard
+                self._cond.wait()
+        try:
+            shard = self._load(key)
+        except BaseException:
+            with self._cond:
+                del self._entries[key]
+                self._cond.notify_all()
+            raise
+        with self._cond:
+            entry.shard = shard
+            entry.state = "ready"
+            self.loads += 1
+            self._cond.notify_all()
+        self.trim()
+        return shard
+
+    def release(self, key):
+        with self._cond:
+            self._entries[key].pins -= 1
+        self.trim()
+
+    @contextlib.contextmanager
+    def use(self, key):
+        shard = self.acquire(key)
+        try:
+            yield shard
+        finally:
+            self.release(key)
+
+    def peek(self, key):
+        """The shard for `key` if it is loaded (no load, no pin), else None."""
+        with self._cond:
+            entry = self._entries.get(key)
+            return entry.shard if entry is not None and entry.state == "ready" else None
+
+    def loaded(self):
+        """The shards currently in memory, least recently used first."""
+        with self._cond:
+            return [e.shard for e in self._entries.values() if e.state == "ready"]
+
+    def memory_bytes(self) -> int:
+        with self._cond:
+            return sum(self._size(e.shard) for e in self._entries.values() if e.state == "ready")
+
+    def trim(self):
+        """Evicts least recently used, unpinned shards while over budget."""
+        victims = []
+        with self._cond:
+            total = sum(self._size(e.shard) for e in self._entries.values() if e.state == "ready")
+            for key, entry in self._entries.items():
+                if total <= self.budget_bytes:
+                    break
+                if entry.state == "ready" and entry.pins == 0:
+                    entry.state = "closing"
+                    total -= self._size(entry.shard)
+                    victims.append((key, entry))
+        for key, entry in victims:
+            try:
+                self._close(entry.shard)
+            finally:
+                with self._cond:
+                    del self._entries[key]
+                    self.evictions += 1
+                    self._cond.notify_all()
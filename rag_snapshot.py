@@ -0,0 +1,191 @@
+"""
+rag_snapshot.py
+===============
+Portable snapshot archive of (part of) a rag_store shard, for warming up
+a new replica from an existing one instead of re-extracting and
+re-embedding every document.
+
+An archive is a single stream, written and read front to back (no seeking,
+so it can be piped between machines or over HTTP):
+
+    magic "RAGSNAP\\0" | frame* | end frame
+
+    frame = u32 header_len | u64 payload_len | header (UTF-8 JSON) | payload
+
+- the first frame is {"type": "meta", "format", "model", "dim", "files"}:
+  an archive is only importable into a store using the same embedding
+  model and dimension (the vectors would be meaningless otherwise)
+- then one {"type": "file", "filename", "entry", "n", "text_bytes"} frame
+  per document, whose payload is its chunks in document order: pages
+  (<i8), text lengths (<i8), 16-byte normalized-text hashes, the UTF-8
+  texts, then the full-precision float32 vectors
+- last, {"type": "end", "files", "sha256"}: a SHA-256 over every byte
+  before the end frame. A reader yields nothing as final until it has
+  checked it, so a truncated or corrupted archive is rejected as a whole.
+
+What is not in the archive is derived on import: chunk ids (the importing
+shard assigns its own), the FAISS structure (rebuilt from the vectors with
+the importer's index settings) and the BM25 segments (from the texts).
+
+Usage (server stopped, or against a directory no server is using):
+
+    python rag_snapshot.py export out.ragsnap [--tenant ID] [--files a.pdf b.pdf]
+    python rag_snapshot.py import out.ragsnap [--tenant ID]
+"""
+
+import argparse
+import hashlib
+import json
+import struct
+import sys
+
+import numpy as np
+
+FORMAT_VERSION = 1
+_MAGIC = b"RAGSNAP\0"
+_FRAME = struct.Struct("<IQ")
+
+
+class SnapshotError(ValueError):
+    """The archive is malformed, corrupt, truncated or incompatible."""
+
+
+class SnapshotWriter:
+    def __init__(self, f, model: str, dim: int, filenames):
+        self._f = f
+        self._sha = hashlib.sha256()
+        self.dim = dim
+        self.n_files = 0
+        self._write(_MAGIC)
+        self._frame({"type": "meta", "format": FORMAT_VERSION, "model": model, "dim": dim,
+                     "files": list(filenames)})
+
+    def _write(self, data: bytes):
+        self._sha.update(data)
+        self._f.write(data)
+
+    def _frame(self, header: dict, payload: bytes = b""):
+        raw = json.dumps(header, separators=(",", ":")).encode("utf-8")
+        self._write(_FRAME.pack(len(raw), len(payload)) + raw)
+        self._write(payload)
+
+    def write_file(self, filename: str, entry: dict, chunks, vectors):
+        """`chunks`: dicts with "page", "text", "hash" in document order;
+        `vectors`: their (n, dim) embeddings, same order."""
+        encoded = [c["text"].encode("utf-8") for c in chunks]
+        pages = np.array([-1 if c["page"] is None else c["page"] for c in chunks], dtype="<i8")
+        lens = np.array([len(b) for b in encoded], dtype="<i8")
+        hashes = b"".join(bytes.fromhex(c["hash"]) if c["hash"] else bytes(16) for c in chunks)
+        text = b"".join(encoded)
+        payload = (pages.tobytes() + lens.tobytes() + hashes + text
+                   + np.ascontiguousarray(vectors, dtype="<f4").tobytes())
+        self._frame({"type": "file", "filename": filename, "entry": entry, "n": len(chunks),
+                     "text_bytes": len(text)}, payload)
+        self.n_files += 1
+
+    def close(self):
+        digest = self._sha.hexdigest()
+        raw = json.dumps({"type": "end", "files": self.n_files, "sha256": digest}).encode("utf-8")
+        self._f.write(_FRAME.pack(len(raw), 0) + raw)
+        self._f.flush()
+
+
+def _read_exact(f, n: int) -> bytes:
+    parts, left = [], n
+    while left:
+        part = f.read(left)
+        if not part:
+            raise SnapshotError("Archive is truncated.")
+        parts.append(part)
+        left -= len(part)
+    return b"".join(parts)
+
+
+def _parse_file(header: dict, payload: bytes, dim: int):
+    n, text_bytes = header["n"], header["text_bytes"]
+    if len(payload) != n * (8 + 8 + 16) + text_bytes + n * dim * 4:
+        raise SnapshotError(f"Bad payload size for '{header['filename']}'.")
+    pages = np.frombuffer(payload, dtype="<i8", count=n)
+    lens = np.frombuffer(payload, dtype="<i8", count=n, offset=8 * n)
+    pos = 16 * n
+    hashes = [payload[pos + 16 * i:pos + 16 * (i + 1)].hex() for i in range(n)]
+    pos += 16 * n
+    chunks = []
+    for i in range(n):
+        text = payload[pos:pos + int(lens[i])].decode("utf-8")
+        pos += int(lens[i])
+        chunks.append({"page": None if pages[i] < 0 else int(pages[i]), "text": text,
+                       "hash": "" if hashes[i] == "00" * 16 else hashes[i]})
+    vectors = np.frombuffer(payload, dtype="<f4", offset=pos).reshape(n, dim).astype(np.float32)
+    return chunks, vectors
+
+
+def read_snapshot(f, model: str, dim: int):
+    """
+    Streams an archive: yields ("file", filename, entry, chunks, vectors)
+    per document (one document in memory at a time), then ("end", n_files)
+    once the checksum has been verified. Raises SnapshotError on anything
+    malformed or if it was made with another embedding model/dimension -
+    callers must not commit what they got before the "end" item.
+    """
+    sha = hashlib.sha256()
+    magic = _read_exact(f, len(_MAGIC))
+    if magic != _MAGIC:
+        raise SnapshotError("Not a rag_index snapshot archive.")
+    sha.update(magic)
+    meta = None
+    n_files = 0
+    while True:
+        frame = _read_exact(f, _FRAME.size)
+        header_len, payload_len = _FRAME.unpack(frame)
+        raw = _read_exact(f, header_len)
+        header = json.loads(raw.decode("utf-8"))
+        if header.get("type") == "end":
+            if meta is None or header.get("sha256") != sha.hexdigest() or header.get("files") != n_files:
+                raise SnapshotError("Archive checksum mismatch (corrupt or incomplete).")
+            yield ("end", n_files)
+            return
+        payload = _read_exact(f, payload_len)
+        sha.update(frame)
+        sha.update(raw)
+        sha.update(payload)
+        if meta is None:
+            if header.get("type") != "meta" or header.get("format") != FORMAT_VERSION:
+                raise SnapshotError(f"Unsupported archive format: {header.get('format')!r}.")
+            if header.get("model") != model or header.get("dim") != dim:
+                raise SnapshotError(f"Archive was made with {header.get('model')} ({header.get('dim')} dims); "
+                                    f"this store uses {model} ({dim} dims).")
+            meta = header
+            continue
+        if header.get("type") != "file":
+            raise SnapshotError(f"Unexpected frame type {header.get('type')!r}.")
+        chunks, vectors = _parse_file(header, payload, dim)
+        n_files += 1
+        yield ("file", header["filename"], header["entry"], chunks, vectors)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    sub = parser.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("export", help="write a snapshot archive of a shard")
+    p.add_argument("path")
+    p.add_argument("--tenant", default=None, help="tenant (user id); default: the unsharded store")
+    p.add_argument("--files", nargs="+", default=None, help="only these filenames (default: all)")
+    p = sub.add_parser("import", help="install a snapshot archive into a shard")
+    p.add_argument("path")
+    p.add_argument("--tenant", default=None)
+    args = parser.parse_args(argv)
+
+    import rag_store
+    if args.cmd == "export":
+        with open(args.path, "wb") as f:
+            info = rag_store.export_snapshot(f, filenames=args.files, tenant=args.tenant)
+    else:
+        with open(args.path, "rb") as f:
+            info = rag_store.import_snapshot(f, tenant=args.tenant)
+    rag_store.flush()
+    print(json.dumps(info, indent=2))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -12,23 +12,70 @@ is only ever touched when `uploaded_docs` is non-empty.
 Design:
 - FAISS (IndexIDMap2 over IndexFlatIP, cosine via L2-normalized vectors) is
   the primary vector store -> fast ANN search, scales comfortably to
-  300-500 page PDFs (tens of thousands of chunks).
-- BM25 (rank_bm25) runs alongside for lexical/keyword recall (hybrid
-  search), fused with embedding results via Reciprocal Rank Fusion (RRF).
+  300-500 page PDFs (tens of thousands of chunks). There is one FAISS
+  sub-index PER FILE (keyed by filename, global chunk ids), so a search
+  restricted to some files only ever scans those files' vectors. Large
+  files get an IVF/HNSW sub-index instead of a flat one, and vectors can
+  optionally be stored compressed (SQ8/PQ/PCA) with an exact re-rank from
+  a memory-mapped full-precision side file (vector_index.py).
+- BM25 (bm25_index.BM25Index, an incremental inverted index) runs
+  alongside for lexical/keyword recall (hybrid search), fused with
+  embedding results via Reciprocal Rank Fusion (RRF). Uploads/deletes
+  update only the affected chunks' postings instead of rebuilding it.
+- hybrid_search_many() runs a batch of queries with one embedding call,
+  one FAISS search per sub-index over the whole query matrix and one
+  BM25 scoring pass per segment; hybrid_search() is its one-query case.
+- A search over many files is routed first: each file keeps a few summary
+  vectors, and only the files closest to the query are searched chunk by
+  chunk (ROUTE_TOP_DOCS).
 - Everything is persisted to disk (./rag_index/) so embeddings are never
   recomputed on server restart - only newly uploaded/changed files get
   (re)indexed, tracked via a per-file content hash in manifest.json.
+  Even then, chunks whose text was embedded before (unchanged pages of a
+  re-uploaded file, boilerplate shared with other documents) reuse their
+  cached embedding (embed_cache.py).
+  Writes go through an fsynced write-ahead log (rag_wal.py) and are applied
+  in memory immediately; a background thread writes the per-file
+  sub-indexes + manifest as a snapshot (atomic renames) and trims the log.
 - Indexing runs in a background thread so /upload returns immediately;
-  progress is queryable via get_progress().
-- Chunks carry filename + page number + chunk id metadata for citations.
+  progress is queryable via get_progress(). Within it, extraction,
+  chunking and embedding overlap: pages stream out of extraction into
+  chunking and batches go to the embedder as soon as they fill, so OCR
+  time is largely hidden behind embedding.
+- Chunks carry filename + page number + chunk id metadata for citations,
+  stored in an append-only, memory-mapped binary table (chunk_table.py)
+  instead of a JSON dict that was rewritten in full on every upload.
 - Near-duplicate chunks (e.g. repeated headers/footers) are skipped at
   chunk time via a normalized-text hash set, per document.
+- Searches are lock-free: they read an immutable, versioned view of the
+  index and writers publish the next version with a pointer swap
+  (rag_versions.py), so indexing never stalls chat requests.
+- The store is sharded per tenant (the signed-in user): every public
+  function takes a `tenant`, each tenant's documents live in their own
+  shard directory with its own chunk table, log and versions, and shards
+  are loaded on first access and evicted LRU under a memory budget
+  (rag_shards.py). A search only ever touches the caller's shard.
+  tenant=None is the original, unsharded store directly under INDEX_DIR;
+  requests no longer read it, its files move into a user's shard when that
+  user uploads the same bytes again (_adopt_legacy_vectors()).
+- A shard (or some of its files) can be exported as a portable,
+  checksummed archive and imported into another replica without
+  re-embedding anything (export_snapshot()/import_snapshot(),
+  rag_snapshot.py).
+- Shards that accumulate deleted chunks are compacted in the background
+  into a fresh generation directory (live rows only, dense ids) that is
+  swapped in atomically (compact(); automatic past a dead-row threshold).
 """
 
+import collections
 import concurrent.futures
+import glob
 import hashlib
+import itertools
 import json
 import os
+import queue
+import shutil
 import threading
 import time
 import traceback
@@ -36,35 +83,145 @@ from concurrent.futures import ThreadPoolExecutor
 
 import faiss
 import numpy as np
-from rank_bm25 import BM25Okapi
 
 import engine  # reuse existing embedder, chunker constants, file loaders
+import vector_index
+import bm25_index
+from bm25_index import BM25Index, tokenize
+from chunk_table import NO_PAGE, ChunkTable, hash_hex
+from embed_cache import EmbeddingCache
+from rag_batch_sizer import BatchSizer
+from rag_checkpoint import IndexCheckpoint
+from rag_shards import ShardRegistry
+from rag_snapshot import SnapshotError, SnapshotWriter, read_snapshot
+from rag_versions import StoreVersion, VersionChain
+from rag_wal import WriteAheadLog, atomic_write
+from ttl_cache import TTLCache
 
 # ---------------------------------------------------------------------------
 # Persistence paths
 # ---------------------------------------------------------------------------
-INDEX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "rag_index")
-FAISS_PATH = os.path.join(INDEX_DIR, "faiss.index")
-META_PATH = os.path.join(INDEX_DIR, "metadata.json")
-MANIFEST_PATH = os.path.join(INDEX_DIR, "manifest.json")
+# INDEX_DIR holds the default (tenant=None) shard, laid out exactly as the
+# unsharded store always was, plus tenants/<key>/ - one directory per
+# tenant with the same layout - and the shared embedding cache.
+INDEX_DIR = (os.environ.get("RAG_INDEX_DIR")
+             or os.path.join(os.path.dirname(os.path.abspath(__file__)), "rag_index"))
+TENANTS_DIR = os.path.join(INDEX_DIR, "tenants")
 
 os.makedirs(INDEX_DIR, exist_ok=True)
 
 EMBED_DIM = engine.EMBED_DIM
 CHUNK_SIZE = engine.CHUNK_SIZE
 CHUNK_OVERLAP = engine.CHUNK_OVERLAP
-EMBED_BATCH_SIZE = 64  # bounds peak memory when indexing large documents
+EMBED_BATCH_SIZE = 64  # starting batch size (in average-length chunks), see below
+
+# Bulk (indexing) embedding runs several batches at once on a shared pool
+# (_embed_batches()): ONNX releases the GIL, and with engine.EMBED_WORKERS
+# the batches spread over the worker processes. RAG_EMBED_CORE_BUDGET
+# (engine.EMBED_CORE_BUDGET, which also sizes the threads of the model
+# session these batches use, so the batches in flight share those cores
+# while queries keep every core) caps the batches in flight
+# across ALL uploads together; RAG_EMBED_PARALLEL_BATCHES caps one
+# document's share of that.
+EMBED_CORE_BUDGET = engine.EMBED_CORE_BUDGET
+EMBED_PARALLEL_BATCHES = int(os.environ.get("RAG_EMBED_PARALLEL_BATCHES", str(EMBED_CORE_BUDGET)))
+_embed_executor = ThreadPoolExecutor(max_workers=EMBED_CORE_BUDGET, thread_name_prefix="rag-embed")
+
+# Bulk embedding batches are sized from the chunks' lengths, a memory
+# ceiling and measured latency (rag_batch_sizer.py) instead of a fixed
+# count: shortest chunks first, each batch as large as fits both
+# RAG_EMBED_MEMORY_MB (estimated model activations, shared by the
+# batches in flight) and RAG_EMBED_TARGET_BATCH_SECONDS' worth of tokens
+# at the measured speed, and at most RAG_EMBED_MAX_BATCH chunks.
+EMBED_MEMORY_MB = int(os.environ.get("RAG_EMBED_MEMORY_MB", "1024"))
+EMBED_TARGET_BATCH_SECONDS = float(os.environ.get("RAG_EMBED_TARGET_BATCH_SECONDS", "2"))
+EMBED_MAX_BATCH = int(os.environ.get("RAG_EMBED_MAX_BATCH", "256"))
+_batch_sizer = BatchSizer(EMBED_MEMORY_MB * 2**20 // EMBED_CORE_BUDGET, EMBED_TARGET_BATCH_SECONDS,
+                          EMBED_MAX_BATCH, initial_tokens=EMBED_BATCH_SIZE * BatchSizer.tokens(CHUNK_SIZE))
+
+# Persistent chunk-embedding cache keyed by (model, normalized-text hash)
+# (embed_cache.py). Bounded by entry count, LRU beyond that; at the default
+# 384 dims, 200k entries is ~300 MB on disk. 0 disables caching. Shared by
+# all tenants: it maps a text hash to that text's embedding, so a hit only
+# ever hands a tenant the vector of text it just uploaded itself.
+EMBED_CACHE_DIR = os.path.join(INDEX_DIR, "embed_cache")
+EMBED_CACHE_MAX_ENTRIES = int(os.environ.get("RAG_EMBED_CACHE_MAX_ENTRIES", "200000"))
+_embed_cache = EmbeddingCache(EMBED_CACHE_DIR, engine.EMBED_MODEL_NAME, EMBED_DIM, EMBED_CACHE_MAX_ENTRIES)
+
+# Indexing checkpoints (rag_checkpoint.py): while a document is being
+# indexed its extracted pages and embedded vectors are kept under
+# <shard root>/checkpoints/, so an attempt that fails (a batch timing out,
+# the server restarting) is resumed by the next one instead of redone from
+# page 1. resume_checkpoints() restarts the ones a restart interrupted, at
+# most RAG_CHECKPOINT_MAX_ATTEMPTS attempts each. RAG_INDEX_CHECKPOINTS=0
+# turns checkpointing off. A checkpoint is keyed by file name AND upload
+# hash, and used by one indexing run at a time (_checkpoints_in_use): a
+# second, concurrent upload of the same bytes indexes without one, and an
+# upload of other bytes never touches it. Uploads under
+# RAG_CHECKPOINT_MIN_KB are quick to redo, so they aren't checkpointed
+# (which would copy and fsync them first).
+INDEX_CHECKPOINTS = os.environ.get("RAG_INDEX_CHECKPOINTS", "1") != "0"
+CHECKPOINT_MAX_ATTEMPTS = int(os.environ.get("RAG_CHECKPOINT_MAX_ATTEMPTS", "3"))
+CHECKPOINT_MIN_BYTES = int(os.environ.get("RAG_CHECKPOINT_MIN_KB", "256")) * 1024
+_checkpoints_in_use = set()
+_checkpoints_lock = threading.Lock()
 
 # Relevance floor for hybrid_search: candidates below this are dropped
 # BEFORE RRF fusion (rather than always returning top_k regardless of how
 # weak the match is), so genuinely irrelevant chunks never reach the LLM.
-# Embedding vectors are L2-normalized and FAISS is IndexFlatIP, so this is
-# a plain cosine-similarity threshold (0.0-1.0 scale). BM25 has no fixed
-# scale, so its filter is simply "score > 0" (zero = no lexical overlap
-# with the query at all).
+# Embedding vectors are L2-normalized and every FAISS sub-index uses the
+# inner-product metric, so this is a plain cosine-similarity threshold
+# (0.0-1.0 scale). BM25 has no fixed scale, so its filter is simply
+# "score > 0" (zero = no lexical overlap with the query at all).
 MIN_EMBED_SIMILARITY = 0.35
 
-_lock = threading.Lock()
+# Optional maximal-marginal-relevance re-ranking (off at the default
+# RAG_MMR_LAMBDA=1). Exact-text dedup still lets near-duplicates through:
+# neighbouring chunks share CHUNK_OVERLAP characters, so two or three of
+# them can fill top_k with one passage and waste the prompt budget. With
+# lambda < 1 the best MMR_POOL_FACTOR x top_k fused results are re-picked
+# greedily, each next one maximizing
+#     lambda * relevance - (1 - lambda) * max similarity to those picked,
+# relevance being the fused score relative to the best one and similarity
+# the cosine between stored chunk vectors (one matrix product over the
+# pool, see _mmr()). Lower lambda = more diverse results.
+MMR_LAMBDA = float(os.environ.get("RAG_MMR_LAMBDA", "1"))
+MMR_POOL_FACTOR = int(os.environ.get("RAG_MMR_POOL_FACTOR", "4"))
+
+# Document-level routing. A search restricted to more than ROUTE_MIN_DOCS
+# files (typically resolve_referenced_documents() falling back to "all
+# uploaded files") used to scan every chunk of every one of them. Now each
+# query first picks the ROUTE_TOP_DOCS files whose summary vectors - up to
+# ROUTE_SUMMARY_VECTORS spherical k-means centroids of the file's chunk
+# vectors, computed when its sub-index is built (at shard warm-up for one
+# loaded from disk) - are closest to it (plus files holding one of its
+# rare terms, see _route_documents()), and
+# only those are searched chunk by chunk, FAISS and BM25 alike. Chunk-level
+# cost then stays about flat as a user's file count grows into the
+# hundreds; routing itself is one (queries x files*summaries) product.
+# The price is recall for a file whose summary looks nothing like the
+# query. RAG_ROUTE_TOP_DOCS=0 turns routing off.
+ROUTE_MIN_DOCS = int(os.environ.get("RAG_ROUTE_MIN_DOCS", "12"))
+ROUTE_TOP_DOCS = int(os.environ.get("RAG_ROUTE_TOP_DOCS", "6"))
+ROUTE_SUMMARY_VECTORS = int(os.environ.get("RAG_ROUTE_SUMMARY_VECTORS", "4"))
+
+# hybrid_search() results are cached (LRU, at most RAG_RESULT_CACHE_MB of
+# result text; 0 disables it), so a regenerate or a repeated question
+# skips FAISS, BM25, fusion and dedup. There is no TTL: the key holds
+# everything the results depend on - the requested files' version numbers
+# (rag_versions.py; new whenever a file is indexed, re-indexed, removed or
+# compacted), the normalized query, top_k and the query terms' BM25 corpus
+# statistics (IDF is taken over the whole shard) - so an entry can only be
+# hit while it is still exactly what a fresh search would return.
+RESULT_CACHE_MB = int(os.environ.get("RAG_RESULT_CACHE_MB", "64"))
+_result_cache = TTLCache(100_000 if RESULT_CACHE_MB > 0 else 0, 0, max_bytes=RESULT_CACHE_MB * 2**20,
+                         sizeof=lambda results: sum(200 + len(r["text"]) + len(r["filename"]) for r in results))
+
+# Estimated resident memory (FAISS codes + BM25 postings, see
+# _shard_bytes()) the loaded tenant shards may use together before the
+# least recently used idle ones are evicted. A shard in use (search or
+# upload running) is never evicted, so this can be exceeded briefly.
+SHARD_MEMORY_BUDGET_MB = int(os.environ.get("RAG_SHARD_MEMORY_BUDGET_MB", "1024"))
 
 # Bounded worker pool for background indexing (extraction + embedding).
 # Replaces the previous unbounded `threading.Thread(...).start()` per
@@ -77,86 +234,751 @@ _lock = threading.Lock()
 # contract are all unchanged.
 _index_executor = ThreadPoolExecutor(max_workers=3, thread_name_prefix="rag-index")
 
-# In-memory mirrors of the on-disk index, loaded once at import time.
-_index = None                # faiss.IndexIDMap2
-_metadata = {}                # {str(chunk_id): {filename, page, text, hash}}
-_manifest = {}                # {filename: {"hash":..., "num_chunks":..., "status":...}}
-_next_id = 0
-_bm25 = None                  # rebuilt lazily whenever metadata changes
-_bm25_ids = []                # chunk ids in the order fed to BM25
+_progress = {}                # {(tenant, filename): {"status": "queued|indexing|done|error", "percent": int, "message": str}}
 
-_progress = {}                # {filename: {"status": "queued|indexing|done|error", "percent": int, "message": str}}
+
+class _Shard:
+    """
+    One tenant's index: in-memory mirrors of its on-disk directory. Everything
+    searches read lives in the current StoreVersion (per-file FAISS
+    sub-indexes, per-file BM25 segments, the manifest and a chunk-table
+    view); readers take `versions.current` without locking, writers publish
+    a new version under `lock` (rag_versions.py).
+
+    The shard's files live in its current generation directory (`dir`):
+    the shard root itself for generation 0, root/gen-<n>/ once compaction
+    has rewritten it (see _compact()); root/CURRENT names the generation.
+    """
+
+    def __init__(self, tenant, root: str):
+        self.tenant = tenant
+        self.root = root
+        self.generation = _read_generation(root)
+        _remove_stale_generations(root, self.generation)
+        self._set_dir(_generation_dir(root, self.generation))
+        # Serializes writers (index/remove/clear commits, snapshot capture).
+        # Searches never take it - they read an immutable StoreVersion.
+        self.lock = threading.Lock()
+        self.snapshot_lock = threading.Lock()   # one snapshot (or compaction) at a time
+        self.chunks = None        # ChunkTable: chunk_id -> {filename, page, text}, on disk under self.dir
+        self.versions = None      # VersionChain, set once loading finishes
+        self.wal = WriteAheadLog(self.dir)
+        self.dirty = set()        # filenames whose sub-index changed since the last snapshot
+        self.memory_bytes = 0     # _shard_bytes() of the current version, updated on publish
+        self.closed = False
+        # Set once _warm_up() has built the BM25 segments; until then
+        # searches are vector-only (see _load()).
+        self.warm = threading.Event()
+
+    def _set_dir(self, directory: str):
+        self.dir = directory
+        self.faiss_path = os.path.join(directory, "faiss.index")      # legacy single index, migrated on load
+        self.vectors_dir = os.path.join(directory, "vectors")         # one <key>.index per file
+        self.meta_path = os.path.join(directory, "metadata.json")     # legacy chunk metadata, migrated on load
+        self.manifest_path = os.path.join(directory, "manifest.json")
+        os.makedirs(self.vectors_dir, exist_ok=True)
+
+    def vector_path(self, filename: str) -> str:
+        return _vector_file(self.vectors_dir, filename)
+
+    def checkpoint_dir(self, filename: str, file_hash: str) -> str:
+        # Under the root, not the generation directory: compaction swaps
+        # generations while an upload may be checkpointing.
+        return os.path.join(self.root, "checkpoints", f"{self._checkpoint_key(filename)}-{file_hash[:16]}")
+
+    def discard_checkpoints(self, filename: str):
+        """Deletes `filename`'s checkpoints (any upload hash) except those an
+        indexing run is using."""
+        prefix = self._checkpoint_key(filename) + "-"
+        for directory in glob.glob(os.path.join(self.root, "checkpoints", glob.escape(prefix) + "?" * 16)):
+            with _checkpoints_lock:
+                if directory not in _checkpoints_in_use:
+                    shutil.rmtree(directory, ignore_errors=True)
+
+    @staticmethod
+    def _checkpoint_key(filename: str) -> str:
+        return os.path.basename(_vector_file("", filename))[:-len(".index")]
+
+
+def _vector_file(vectors_dir: str, filename: str) -> str:
+    """Filenames are user-supplied (spaces, unicode, path separators), so
+    the per-file index is stored under a hash of the name instead."""
+    key = hashlib.sha1(filename.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(vectors_dir, f"{key}.index")
+
+
+# ---------------------------------------------------------------------------
+# Hashing helpers
+# ---------------------------------------------------------------------------
+def _file_hash(raw_bytes: bytes) -> str:
+    return hashlib.sha256(raw_bytes).hexdigest()
+
+
+def _norm_text_hash(text: str) -> str:
+    return hashlib.md5(" ".join(text.lower().split()).encode("utf-8")).hexdigest()
 
 
 # ---------------------------------------------------------------------------
 # Load / save
 # ---------------------------------------------------------------------------
-def _load():
-    global _index, _metadata, _manifest, _next_id
-    if os.path.exists(FAISS_PATH) and os.path.exists(META_PATH):
-        try:
-            _index = faiss.read_index(FAISS_PATH)
-            with open(META_PATH, "r", encoding="utf-8") as f:
-                _metadata = json.load(f)
-            _next_id = (max((int(k) for k in _metadata), default=-1)) + 1
-        except Exception as e:
-            print(f"[RAG-STORE] Failed to load existing index, starting fresh: {e}")
-            _index = None
-            _metadata = {}
-    if _index is None:
-        _index = faiss.IndexIDMap2(faiss.IndexFlatIP(EMBED_DIM))
-    if os.path.exists(MANIFEST_PATH):
+def _migrate_legacy_metadata(shard):
+    """
+    One-time import of the old metadata.json ({str(id): {filename, page,
+    text}}) into the chunk table, keeping every chunk's id so the FAISS
+    sub-indexes still line up. Appended in id order, per file in runs.
+    """
+    with open(shard.meta_path, "r", encoding="utf-8") as f:
+        legacy = json.load(f)
+    ordered = sorted(((int(cid), m) for cid, m in legacy.items()), key=lambda item: item[0])
+    run_file, run = None, []
+    for cid, m in ordered + [(None, None)]:
+        if run and (m is None or m["filename"] != run_file):
+            shard.chunks.append(run_file, [c for _, c in run], ids=[i for i, _ in run])
+            run = []
+        if m is None:
+            break
+        run_file = m["filename"]
+        run.append((cid, {"page": m["page"], "text": m["text"], "hash": _norm_text_hash(m["text"])}))
+    os.remove(shard.meta_path)
+    print(f"[RAG-STORE] Migrated legacy metadata.json ({len(legacy)} chunk(s)) into the chunk table.")
+
+
+def _migrate_legacy_index(shard, state):
+    """
+    One-time split of the old single faiss.index (every file's vectors in
+    one IndexIDMap2) into per-file sub-indexes. Vectors are copied out via
+    reconstruct() under their existing chunk ids, so nothing is re-embedded
+    and the chunk table needs no changes.
+    """
+    legacy = faiss.read_index(shard.faiss_path)
+    for filename, ids in shard.chunks.ids_by_file().items():
+        vecs = np.vstack([legacy.reconstruct(int(i)) for i in ids]).astype(np.float32)
+        sub = vector_index.build(EMBED_DIM, vecs, ids, summary_k=ROUTE_SUMMARY_VECTORS)
+        state.vectors[filename] = sub
+        vector_index.save(sub, shard.vector_path(filename))
+    os.remove(shard.faiss_path)
+    print(f"[RAG-STORE] Migrated legacy faiss.index ({legacy.ntotal} vector(s)) "
+          f"into {len(state.vectors)} per-file sub-index(es).")
+
+
+def _migrate_index_kinds(shard, state):
+    """
+    Rebuilds any sub-index whose structure or compression no longer
+    matches what vector_index picks for its size - e.g. after changing
+    RAG_INDEX_MODE / RAG_ANN_THRESHOLD / RAG_VECTOR_COMPRESSION, or for
+    flat indexes written before IVF/HNSW existed. Reuses the stored vectors
+    (full precision - the side file when compressed; no re-embedding) and
+    records the new type in the manifest.
+    """
+    migrated = []
+    for filename, sub in list(state.vectors.items()):
+        want = (vector_index.choose_kind(sub.ntotal), vector_index.choose_compression(sub.ntotal))
+        have = (sub.kind, sub.compression)
+        if want != have:
+            sub = vector_index.build(EMBED_DIM, sub.vectors(), sub.ids(), kind=want[0], compression=want[1],
+                                     summary_k=ROUTE_SUMMARY_VECTORS)
+            state.vectors[filename] = sub
+            vector_index.save(sub, shard.vector_path(filename))
+            migrated.append(f"{filename} ({'/'.join(have)}->{'/'.join(want)})")
+        if filename in state.manifest:
+            state.manifest[filename]["index"] = vector_index.describe(sub)
+    if migrated:
+        atomic_write(shard.manifest_path, json.dumps(state.manifest).encode("utf-8"))
+        print(f"[RAG-STORE] Migrated {len(migrated)} sub-index(es) to a new index type: {migrated}")
+
+
+def _load_manifest(shard) -> dict:
+    if os.path.exists(shard.manifest_path):
         try:
-            with open(MANIFEST_PATH, "r", encoding="utf-8") as f:
-                _manifest = json.load(f)
+            with open(shard.manifest_path, "r", encoding="utf-8") as f:
+                return json.load(f)
         except Exception:
-            _manifest = {}
+            pass
+    return {}
 
 
-def _save():
-    faiss.write_index(_index, FAISS_PATH)
-    with open(META_PATH, "w", encoding="utf-8") as f:
-        json.dump(_metadata, f)
-    with open(MANIFEST_PATH, "w", encoding="utf-8") as f:
-        json.dump(_manifest, f)
+def _load(shard) -> StoreVersion:
+    """
+    Loads the shard's last snapshot + replays its log into the first
+    version. Kept cheap so a cold start doesn't scale with corpus size:
+    sub-indexes are memory-mapped (vector_index.load) and the chunk table
+    already is; the BM25 segments - re-tokenizing every chunk - are left
+    out and built afterwards by _warm_up() on a background thread.
+    """
+    state = StoreVersion()
+    try:
+        state.manifest = _load_manifest(shard)
+        shard.chunks = ChunkTable(shard.dir)
+        if os.path.exists(shard.meta_path):
+            shard.chunks.clear()
+            _migrate_legacy_metadata(shard)
+        if os.path.exists(shard.faiss_path):
+            _migrate_legacy_index(shard, state)
+        else:
+            # The manifest is the snapshot's commit point: only files it
+            # lists are loaded, so a sub-index written by a snapshot that
+            # crashed before its manifest landed is ignored (the WAL
+            # replay below rebuilds that file from its log record).
+            for filename in list(state.manifest):
+                path = shard.vector_path(filename)
+                if not os.path.exists(path):
+                    print(f"[RAG-STORE] '{filename}' is in the manifest but its sub-index "
+                          f"{path} is missing - dropping it.")
+                    state.manifest.pop(filename)
+                    continue
+                kind = state.manifest[filename].get("index", {}).get("index_type")
+                state.vectors[filename] = vector_index.load(path, kind)
+    except Exception as e:
+        print(f"[RAG-STORE] Failed to load existing index in {shard.dir}, starting fresh: {e}")
+        state = StoreVersion()
+        if shard.chunks is None:
+            shard.chunks = ChunkTable(shard.dir)
+        shard.chunks.clear()
+        # The log's records refer to the chunk rows just dropped.
+        shard.wal.discard(shard.wal.rotate())
+    _replay_wal(shard, state)
+    _reconcile_chunks(shard, state)
+    _migrate_index_kinds(shard, state)
+    state.chunks = shard.chunks.view()
+    for filename, sub in state.vectors.items():
+        state.files[filename] = state.chunks.file_chunks(sub.ids())
+    return state
+
+
+def _warm_up(shard):
+    """
+    Builds the BM25 segments _load() skipped, from the version current at
+    the start, then publishes them in one version. Files that an upload or
+    delete replaced meanwhile are left alone - that writer already built
+    (or dropped) their segment. Also gives the sub-indexes loaded from
+    disk their routing summary (vector_index.SubIndex.with_summary()) -
+    every other path builds a sub-index with one - and publishes those
+    copies in the same version.
+    """
+    warm_start = time.monotonic()
+    try:
+        version = shard.versions.current
+        built = {}
+        summarized = {}
+        for filename, file_chunks in version.files.items():
+            if shard.closed:
+                return
+            built[filename] = (file_chunks, _build_bm25(version.chunks.get_many(file_chunks.ids)))
+            sub = version.vectors.get(filename)
+            if sub is not None and sub.summary(ROUTE_SUMMARY_VECTORS) is None:
+                summarized[filename] = (sub, sub.with_summary(ROUTE_SUMMARY_VECTORS))
+        del version
+        with shard.lock:
+            current = shard.versions.current
+            nxt = current.derive()
+            for filename, (file_chunks, segment) in built.items():
+                if nxt.files.get(filename) is file_chunks and filename not in nxt.bm25:
+                    nxt.bm25[filename] = segment
+            for filename, (sub, copy) in summarized.items():
+                if nxt.vectors.get(filename) is sub:
+                    nxt.vectors[filename] = copy
+            _publish(shard, nxt)
+            del current
+        print(f"[RAG-STORE] Shard tenant={shard.tenant!r} warm: BM25 for {len(built)} file(s) "
+              f"built in {time.monotonic() - warm_start:.2f}s - hybrid search enabled.")
+    except Exception as e:
+        # Searches stay vector-only for this shard until it is reloaded.
+        print(f"[RAG-STORE] Warm-up of shard tenant={shard.tenant!r} FAILED: {e}\n{traceback.format_exc()}")
+        return
+    shard.warm.set()
 
 
-_load()
+# ---------------------------------------------------------------------------
+# Write-ahead log + background snapshots (rag_wal.py)
+# ---------------------------------------------------------------------------
+# Every add/remove/clear is appended to the shard's log and fsynced (the
+# commit point - O(size of the change)) and then applied to the in-memory
+# state straight away; nothing else is rewritten on the write path. A
+# background thread periodically writes a snapshot of each loaded shard -
+# the sub-indexes of the files changed since the last one, then
+# manifest.json, each via temp file + atomic rename - and only then drops
+# the log records it covers. A crash at any point leaves the last complete
+# snapshot plus a log that replays on top of it. The chunk table persists
+# itself (append-only rows, in-place tombstones) and is reconciled against
+# the replayed state on load, so rows appended by a write that crashed
+# before its log record committed are tombstoned.
+SNAPSHOT_INTERVAL_SECONDS = float(os.environ.get("RAG_SNAPSHOT_INTERVAL_SECONDS", "30"))
+# A burst of large uploads can grow the log faster than the interval;
+# past this size the snapshot is taken right away.
+WAL_MAX_BYTES = int(os.environ.get("RAG_WAL_MAX_BYTES", str(256 * 1024 * 1024)))
+
+_snapshot_wakeup = threading.Event()
+
+
+def _add_payload(ids, vectors) -> bytes:
+    return np.asarray(ids, dtype="<i8").tobytes() + np.asarray(vectors, dtype="<f4").tobytes()
+
+
+def _update_payload(ids, new_rows, new_vectors) -> bytes:
+    # All ids (document order), then which positions are new, then only
+    # the new vectors - the kept ones are already in the previous state.
+    return (np.asarray(ids, dtype="<i8").tobytes() + np.asarray(new_rows, dtype="<i8").tobytes()
+            + np.asarray(new_vectors, dtype="<f4").tobytes())
+
+
+def _parse_update_payload(record, payload, old_sub):
+    n, n_new = record["n"], record["n_new"]
+    ids = np.frombuffer(payload, dtype="<i8", count=n).astype(np.int64)
+    new_rows = np.frombuffer(payload, dtype="<i8", count=n_new, offset=8 * n).astype(np.int64)
+    vectors = np.zeros((n, EMBED_DIM), dtype=np.float32)
+    vectors[new_rows] = np.frombuffer(payload, dtype="<f4", offset=8 * (n + n_new)).reshape(n_new, EMBED_DIM)
+    kept = np.ones(n, dtype=bool)
+    kept[new_rows] = False
+    vectors[kept] = old_sub.vectors(ids[kept])
+    return ids, vectors
+
+
+def _parse_add_payload(record, payload):
+    n = record["n"]
+    ids = np.frombuffer(payload, dtype="<i8", count=n).astype(np.int64)
+    vectors = np.frombuffer(payload, dtype="<f4", offset=8 * n).reshape(n, EMBED_DIM).astype(np.float32)
+    return ids, vectors
+
+
+def _replay_wal(shard, state):
+    """Re-applies the logged changes that the on-disk snapshot doesn't
+    cover yet (only in-memory vectors + manifest; the chunk table is
+    reconciled against the result afterwards)."""
+    n_records = 0
+    for record, payload in shard.wal.replay():
+        n_records += 1
+        op, filename = record["op"], record.get("filename")
+        if op in ("add", "update"):
+            if op == "add":
+                ids, vectors = _parse_add_payload(record, payload)
+            else:
+                ids, vectors = _parse_update_payload(record, payload, state.vectors[filename])
+            sub = vector_index.build(EMBED_DIM, vectors, ids, summary_k=ROUTE_SUMMARY_VECTORS)
+            state.vectors[filename] = sub
+            state.manifest[filename] = dict(record["entry"], index=vector_index.describe(sub))
+            shard.dirty.add(filename)
+        elif op == "import":
+            offset = 0
+            for item in record["files"]:
+                n = item["n"]
+                size = n * (8 + 4 * EMBED_DIM)
+                ids, vectors = _parse_add_payload(item, payload[offset:offset + size])
+                offset += size
+                sub = vector_index.build(EMBED_DIM, vectors, ids, summary_k=ROUTE_SUMMARY_VECTORS)
+                state.vectors[item["filename"]] = sub
+                state.manifest[item["filename"]] = dict(item["entry"], index=vector_index.describe(sub))
+                shard.dirty.add(item["filename"])
+        elif op == "remove":
+            state.vectors.pop(filename, None)
+            state.manifest.pop(filename, None)
+            shard.dirty.add(filename)
+        elif op == "clear":
+            shard.dirty.update(state.vectors)
+            state.vectors.clear()
+            state.manifest.clear()
+    if n_records:
+        print(f"[RAG-STORE] Replayed {n_records} write-ahead log record(s) on top of the last snapshot.")
+
+
+def _reconcile_chunks(shard, state):
+    """Tombstones chunk rows that no loaded sub-index refers to - left by a
+    write that crashed between appending its chunks and committing its log
+    record (or by a delete whose tombstones never reached the disk)."""
+    stale = 0
+    for filename, ids in shard.chunks.ids_by_file().items():
+        sub = state.vectors.get(filename)
+        orphans = ids if sub is None else ids[~np.isin(ids, sub.ids())]
+        if len(orphans):
+            shard.chunks.remove_ids(orphans)
+            stale += len(orphans)
+    if stale:
+        print(f"[RAG-STORE] Tombstoned {stale} chunk row(s) from uncommitted writes.")
+
+
+def _snapshot(shard):
+    """Writes the files changed since the last snapshot + the manifest,
+    then drops the log records that covers. The state is captured from
+    the current version under the shard's lock (cheap: references to
+    immutable sub-indexes and a serialized manifest); the writing itself
+    happens outside it, so uploads don't wait on disk I/O (searches never
+    lock)."""
+    with shard.snapshot_lock:
+        if not shard.closed:
+            _write_snapshot(shard)
+
+
+def _write_snapshot(shard):
+    with shard.lock:
+        shard.versions.run_reclaimed()
+        if not shard.dirty and not shard.wal.pending_bytes():
+            return
+        current = shard.versions.current
+        changed = {filename: current.vectors.get(filename) for filename in shard.dirty}
+        manifest = json.dumps(current.manifest).encode("utf-8")
+        shard.dirty.clear()
+        covered = shard.wal.rotate()
+    try:
+        for filename, sub in changed.items():
+            if sub is not None:
+                vector_index.save(sub, shard.vector_path(filename))
+        atomic_write(shard.manifest_path, manifest)
+        for filename, sub in changed.items():
+            if sub is None:
+                vector_index.remove(shard.vector_path(filename))
+    except Exception as e:
+        # Nothing is lost - the covered log records are kept and replay on
+        # the next start; retry these files with the next snapshot.
+        print(f"[RAG-STORE] Snapshot of {shard.dir} FAILED (log kept): {e}\n{traceback.format_exc()}")
+        with shard.lock:
+            shard.dirty.update(changed)
+        return
+    shard.wal.discard(covered)
+    print(f"[RAG-STORE] Snapshot of {shard.dir} written: {len(changed)} changed file(s), "
+          f"{len(covered)} log segment(s) dropped.")
+
+
+def _snapshot_loop():
+    while True:
+        _snapshot_wakeup.wait(SNAPSHOT_INTERVAL_SECONDS)
+        _snapshot_wakeup.clear()
+        for shard in _shards.loaded():
+            try:
+                _snapshot(shard)
+                if _needs_compaction(shard):
+                    compact(shard.tenant)
+            except Exception as e:
+                print(f"[RAG-STORE] Snapshot thread error: {e}\n{traceback.format_exc()}")
+
+
+def _log_write(shard, record: dict, payload: bytes = b""):
+    """Commits one change to the shard's log (caller holds shard.lock and
+    applies it to memory right after)."""
+    shard.wal.append(record, payload)
+    if shard.wal.size() >= WAL_MAX_BYTES:
+        _snapshot_wakeup.set()
+
+
+def _publish(shard, nxt: StoreVersion, tombstone_ids=None):
+    """Makes `nxt` the version searches see (caller holds shard.lock). Chunk
+    rows that left the index with this change are only tombstoned once no
+    search can still be reading a version that contains them."""
+    on_reclaim = None
+    if tombstone_ids is not None and len(tombstone_ids):
+        chunks = shard.chunks
+        on_reclaim = lambda: chunks.remove_ids(tombstone_ids)
+    shard.versions.publish(nxt, on_reclaim)
+    shard.memory_bytes = _shard_bytes(nxt)
+
+
+def _build_bm25(metas) -> BM25Index:
+    """One file's BM25 segment from {cid: {"text": ...}}. Built before the
+    version holding it is published and never modified afterwards."""
+    segment = BM25Index()
+    for cid, m in metas.items():
+        segment.add(int(cid), tokenize(m["text"]))
+    return segment
+
+
+def _try_reclaim(shard):
+    """Lets a search that just released a version run its deferred
+    cleanup - only if no writer holds the shard's lock (never waits for
+    one)."""
+    if shard.lock.acquire(blocking=False):
+        try:
+            shard.versions.run_reclaimed()
+        finally:
+            shard.lock.release()
 
 
-def _rebuild_bm25():
-    """Lazily rebuilt whenever metadata changes. Cheap relative to
-    embedding, so simplest-correct approach rather than incremental."""
-    global _bm25, _bm25_ids
-    if not _metadata:
-        _bm25, _bm25_ids = None, []
+# ---------------------------------------------------------------------------
+# Compaction (generations)
+# ---------------------------------------------------------------------------
+# Deletes and re-uploads only tombstone chunk rows (their text stays in the
+# arena) and every new chunk gets a fresh id, so a shard with heavy churn
+# keeps growing on disk - and its chunk table, which id lookups
+# binary-search, keeps growing in memory - long after its documents are
+# gone. Compaction rewrites the shard into a new generation directory:
+# live rows only, ids renumbered densely from 0 per shard, each file's
+# sub-index rebuilt under its new ids from its stored vectors (nothing is
+# re-embedded) with the same index type, and its BM25 segment rebuilt.
+# That happens in the background while uploads, deletes and searches carry
+# on against the old generation; writes committed meanwhile are caught up
+# under the shard's lock, then root/CURRENT is switched atomically (the
+# commit point) and the new generation is published in one version swap.
+# The old generation's files are deleted once no search still reads them.
+# A crash before CURRENT is switched leaves the old generation in charge
+# (the half-written one is removed on the next load); after it, the new
+# one (and the old one is removed).
+COMPACT_DEAD_FRACTION = float(os.environ.get("RAG_COMPACT_DEAD_FRACTION", "0.3"))
+# Small shards aren't worth a rewrite whatever their dead fraction.
+COMPACT_MIN_ROWS = int(os.environ.get("RAG_COMPACT_MIN_ROWS", "1000"))
+
+# Everything a generation owns directly in its directory (generation 0 is
+# the shard root, which also holds CURRENT, gen-*/ and - for the default
+# shard - tenants/ and embed_cache/, never touched here).
+_GENERATION_FILES = ("chunks.bin", "text.arena", "filenames.json", "filenames.json.tmp",
+                     "manifest.json", "manifest.json.tmp", "faiss.index", "metadata.json")
+
+_compaction = {}              # {tenant: {"status": "running|done|error", "percent": int, "message": str}}
+_compaction_lock = threading.Lock()
+
+
+def _generation_dir(root: str, generation: int) -> str:
+    return root if generation == 0 else os.path.join(root, f"gen-{generation}")
+
+
+def _read_generation(root: str) -> int:
+    # Written with atomic_write(), so it is either absent (generation 0)
+    # or complete; an unreadable one fails the load rather than guessing.
+    path = os.path.join(root, "CURRENT")
+    if not os.path.exists(path):
+        return 0
+    with open(path, "r", encoding="utf-8") as f:
+        return int(json.load(f)["generation"])
+
+
+def _discard_generation(root: str, generation: int):
+    directory = _generation_dir(root, generation)
+    if generation:
+        shutil.rmtree(directory, ignore_errors=True)
         return
-    _bm25_ids = list(_metadata.keys())
-    tokenized = [_metadata[cid]["text"].lower().split() for cid in _bm25_ids]
-    _bm25 = BM25Okapi(tokenized)
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name in _GENERATION_FILES or name == "wal.log" or name.startswith("wal.log."):
+            os.remove(path)
+    shutil.rmtree(os.path.join(directory, "vectors"), ignore_errors=True)
+
+
+def _remove_stale_generations(root: str, generation: int):
+    """Removes what a crashed or interrupted compaction left behind: a
+    generation that never became current, or the one it replaced."""
+    os.makedirs(root, exist_ok=True)
+    for name in os.listdir(root):
+        if name.startswith("gen-") and name != f"gen-{generation}":
+            print(f"[RAG-STORE] Removing stale generation {os.path.join(root, name)}.")
+            shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+    if generation and os.path.exists(os.path.join(root, "chunks.bin")):
+        print(f"[RAG-STORE] Removing generation 0 files from {root} (replaced by gen-{generation}).")
+        _discard_generation(root, 0)
+
+
+def _set_compaction(tenant, status, percent, message=""):
+    _compaction[tenant] = {"status": status, "percent": percent, "message": message}
+
+
+def _needs_compaction(shard) -> bool:
+    with shard.lock:
+        if shard.closed or shard.chunks is None:
+            return False
+        total = shard.chunks.n_rows
+        return total >= COMPACT_MIN_ROWS and 1 - len(shard.chunks) / total > COMPACT_DEAD_FRACTION
+
+
+def _compact_files(shard, table, vectors_dir, built, version, report=False):
+    """Brings the new generation (`table`, `vectors_dir`, `built`:
+    {filename: (FileChunks copied, new ids, sub-index, BM25 segment)}) in
+    line with `version`: files deleted since are dropped, files that are
+    new or were replaced (a different FileChunks object) are copied."""
+    for filename in [f for f in built if f not in version.files]:
+        table.remove_ids(built.pop(filename)[1])
+        vector_index.remove(_vector_file(vectors_dir, filename))
+    todo = [f for f, fc in version.files.items() if f not in built or built[f][0] is not fc]
+    for i, filename in enumerate(todo):
+        if filename in built:
+            table.remove_ids(built[filename][1])
+        old_sub = version.vectors[filename]
+        old_ids = old_sub.ids()
+        metas = version.chunks.get_many(old_ids)
+        chunks = [metas[int(cid)] for cid in old_ids]
+        ids = table.append(filename, chunks)
+        sub = vector_index.build(EMBED_DIM, old_sub.vectors(), ids, kind=old_sub.kind,
+                                 compression=old_sub.compression, summary_k=ROUTE_SUMMARY_VECTORS)
+        vector_index.save(sub, _vector_file(vectors_dir, filename))
+        built[filename] = (version.files[filename], ids, sub, _build_bm25(dict(zip(ids, chunks))))
+        if report:
+            _set_compaction(shard.tenant, "running", 5 + int(80 * (i + 1) / len(todo)),
+                            f"Rewrote {i + 1}/{len(todo)} file(s)...")
+
+
+def _compact(shard):
+    with shard.snapshot_lock:
+        if shard.closed:
+            return
+        compact_start = time.monotonic()
+        generation = shard.generation + 1
+        new_dir = _generation_dir(shard.root, generation)
+        vectors_dir = os.path.join(new_dir, "vectors")
+        shutil.rmtree(new_dir, ignore_errors=True)
+        os.makedirs(vectors_dir)
+        rows_before = shard.chunks.n_rows
+        built = {}
+        try:
+            table = ChunkTable(new_dir)
+            _set_compaction(shard.tenant, "running", 5, "Rewriting files...")
+            _compact_files(shard, table, vectors_dir, built, shard.versions.current, report=True)
+            _set_compaction(shard.tenant, "running", 90, "Catching up with writes made meanwhile...")
+            with shard.lock:
+                shard.versions.run_reclaimed()
+                current = shard.versions.current
+                _compact_files(shard, table, vectors_dir, built, current)
+                manifest = {f: dict(current.manifest[f], index=vector_index.describe(built[f][2]))
+                            for f in current.files}
+                atomic_write(os.path.join(new_dir, "manifest.json"), json.dumps(manifest).encode("utf-8"))
+                # Commit point.
+                atomic_write(os.path.join(shard.root, "CURRENT"),
+                             json.dumps({"generation": generation}).encode("utf-8"))
+                old_generation = shard.generation
+                shard.wal.close()
+                shard.generation = generation
+                shard._set_dir(new_dir)
+                shard.chunks = table
+                shard.wal = WriteAheadLog(new_dir)
+                # The new generation is a complete snapshot of `current`.
+                shard.dirty.clear()
+                nxt = StoreVersion(manifest=manifest, chunks=table.view())
+                for filename, (_, ids, sub, segment) in built.items():
+                    nxt.vectors[filename] = sub
+                    nxt.bm25[filename] = segment
+                    nxt.files[filename] = nxt.chunks.file_chunks(ids)
+                root = shard.root
+                shard.versions.publish(nxt, lambda: _discard_generation(root, old_generation))
+                shard.memory_bytes = _shard_bytes(nxt)
+                del current
+        except BaseException:
+            if _read_generation(shard.root) != generation:
+                shutil.rmtree(new_dir, ignore_errors=True)
+            raise
+    took = time.monotonic() - compact_start
+    print(f"[RAG-STORE] Compacted shard tenant={shard.tenant!r} into generation {generation} "
+          f"in {took:.1f}s: {rows_before} -> {table.n_rows} chunk row(s) across {len(built)} file(s).")
+    _set_compaction(shard.tenant, "done", 100,
+                    f"Compacted {rows_before} -> {table.n_rows} chunk rows in {took:.1f}s.")
+
+
+def _run_compaction(tenant):
+    try:
+        # Pinned, so the shard isn't evicted halfway.
+        with _shards.use(tenant) as shard:
+            _compact(shard)
+    except Exception as e:
+        print(f"[RAG-STORE] Compaction of shard tenant={tenant!r} FAILED: {e}\n{traceback.format_exc()}")
+        _set_compaction(tenant, "error", 0, f"Compaction failed: {e}")
 
 
-_rebuild_bm25()
-print(f"[RAG-STORE] Startup: {_index.ntotal} vector(s), {len(_metadata)} chunk(s) "
-      f"across {len(_manifest)} file(s): {list(_manifest.keys())}")
+def compact(tenant=None) -> dict:
+    """Starts compacting `tenant`'s shard in the background (unless it is
+    already running) and returns its progress; poll
+    get_compaction_progress() for the rest."""
+    with _compaction_lock:
+        start = _compaction.get(tenant, {}).get("status") != "running"
+        if start:
+            _set_compaction(tenant, "running", 0, "Queued for compaction.")
+    if start:
+        threading.Thread(target=_run_compaction, args=(tenant,), name="rag-compact", daemon=True).start()
+    return get_compaction_progress(tenant)
+
+
+def get_compaction_progress(tenant=None) -> dict:
+    return _compaction.get(tenant, {"status": "idle", "percent": 0})
 
 
 # ---------------------------------------------------------------------------
-# Hashing / dedup helpers
+# Tenant shards (rag_shards.py)
 # ---------------------------------------------------------------------------
-def _file_hash(raw_bytes: bytes) -> str:
-    return hashlib.sha256(raw_bytes).hexdigest()
+def _tenant_dir(tenant) -> str:
+    if tenant is None:
+        return INDEX_DIR
+    # Tenant ids come from auth (user ids) but are hashed like filenames,
+    # so any string is a safe directory name.
+    return os.path.join(TENANTS_DIR, hashlib.sha1(str(tenant).encode("utf-8")).hexdigest()[:16])
+
+
+def _shard_bytes(version: StoreVersion) -> int:
+    """Estimated resident memory of a version: FAISS codes + BM25 postings
+    (chunk text and full-precision side files are memory-mapped)."""
+    return (sum(vector_index.memory_bytes(sub) for sub in version.vectors.values())
+            + sum(segment.memory_bytes() for segment in version.bm25.values()))
+
+
+def _open_shard(tenant) -> _Shard:
+    shard = _Shard(tenant, _tenant_dir(tenant))
+    load_start = time.monotonic()
+    shard.versions = VersionChain(_load(shard))
+    shard.memory_bytes = _shard_bytes(shard.versions.current)
+    if shard.dirty:
+        _snapshot_wakeup.set()
+    current = shard.versions.current
+    if current.files:
+        threading.Thread(target=_warm_up, args=(shard,), name="rag-warm-up", daemon=True).start()
+    else:
+        shard.warm.set()
+    print(f"[RAG-STORE] Loaded shard tenant={tenant!r} ({shard.dir}) in {time.monotonic() - load_start:.2f}s: "
+          f"{current.ntotal()} vector(s), {len(shard.chunks)} chunk(s) across {len(current.manifest)} "
+          f"file(s) (~{shard.memory_bytes / 2**20:.1f} MB): {list(current.manifest.keys())}")
+    return shard
 
 
-def _norm_text_hash(text: str) -> str:
-    return hashlib.md5(" ".join(text.lower().split()).encode("utf-8")).hexdigest()
+def _close_shard(shard):
+    """Eviction: snapshot whatever the log still holds (so the next load
+    doesn't have to replay it) and release the log file."""
+    with shard.snapshot_lock:
+        try:
+            _write_snapshot(shard)
+        except Exception as e:
+            print(f"[RAG-STORE] Snapshot before evicting {shard.dir} failed (log kept): {e}")
+        shard.wal.close()
+        shard.closed = True
+    print(f"[RAG-STORE] Evicted shard tenant={shard.tenant!r} (~{shard.memory_bytes / 2**20:.1f} MB) "
+          f"to stay within the {SHARD_MEMORY_BUDGET_MB} MB shard memory budget.")
+
+
+_shards = ShardRegistry(_open_shard, _close_shard, lambda shard: shard.memory_bytes,
+                        SHARD_MEMORY_BUDGET_MB * 2**20)
+
+
+def _current(tenant):
+    """(shard, current version) for a reader. The pin is only held while
+    looking the shard up: the version stays valid even if the shard is
+    evicted while the caller is still using it."""
+    with _shards.use(tenant) as shard:
+        return shard, shard.versions.current
+
+
+def _ntotal(tenant=None) -> int:
+    return _current(tenant)[1].ntotal()
 
 
-def _chunk_pages(pages, filename):
+def is_ready(tenant=None) -> bool:
+    """Whether `tenant`'s shard is loaded and warmed up (full hybrid
+    search). Never triggers a load."""
+    shard = _shards.peek(tenant)
+    return shard is not None and shard.warm.is_set()
+
+
+def shard_stats() -> dict:
+    """How many shards are loaded / warmed up, and their estimated memory."""
+    loaded = _shards.loaded()
+    return {"loaded": len(loaded), "warm": sum(1 for shard in loaded if shard.warm.is_set()),
+            "memory_mb": round(_shards.memory_bytes() / 2**20, 1),
+            "memory_budget_mb": SHARD_MEMORY_BUDGET_MB}
+
+
+# No shard is preloaded: every shard - a user's, or the pre-sharding
+# default one, which only _adopt_legacy_vectors() still reads - loads on
+# first access (memory-mapped, BM25 warmed up in the background).
+threading.Thread(target=_snapshot_loop, name="rag-wal-snapshot", daemon=True).start()
+
+
+# ---------------------------------------------------------------------------
+# Chunking / dedup
+# ---------------------------------------------------------------------------
+def _chunk_pages(pages, filename, seen_hashes=None):
     """Chunk (page_num, text) pairs with overlap, tagging each chunk with
     its page number, and drop near-duplicate chunks (repeated boilerplate
-    like headers/footers) within this document."""
-    seen_hashes = set()
+    like headers/footers) within this document. Pass the same
+    `seen_hashes` set for every call on one document when chunking it
+    page by page."""
+    seen_hashes = set() if seen_hashes is None else seen_hashes
     chunks = []
     for page_num, text in pages:
         for raw_chunk in engine.chunk_text(text, CHUNK_SIZE, CHUNK_OVERLAP):
@@ -164,10 +986,35 @@ def _chunk_pages(pages, filename):
             if h in seen_hashes:
                 continue
             seen_hashes.add(h)
-            chunks.append({"filename": filename, "page": page_num, "text": raw_chunk})
+            chunks.append({"filename": filename, "page": page_num, "text": raw_chunk, "hash": h})
     return chunks
 
 
+def _old_chunk_map(old_chunks) -> dict:
+    """hash -> (id, page) of the indexed version of a file, for _diff_chunks()."""
+    if old_chunks is None:
+        return {}
+    return {hash_hex(h): (int(cid), int(page))
+            for cid, page, h in zip(old_chunks.ids, old_chunks.pages, old_chunks.hashes)}
+
+
+def _diff_chunks(old: dict, chunks) -> np.ndarray:
+    """
+    For each new chunk, the id of the identical chunk in the indexed
+    version of the file (same normalized-text hash AND same page, since
+    the page is part of the stored row and of citations), or -1 if it is
+    new/changed. `old` is _old_chunk_map() of that version. Hashes are
+    unique within a file (_chunk_pages dedups on them), so this is one
+    dict lookup per chunk.
+    """
+    keep = np.full(len(chunks), -1, dtype=np.int64)
+    for i, c in enumerate(chunks):
+        hit = old.get(c["hash"])
+        if hit is not None and hit[1] == (NO_PAGE if c["page"] is None else c["page"]):
+            keep[i] = hit[0]
+    return keep
+
+
 # ---------------------------------------------------------------------------
 # Hard timeouts for indexing stages
 # ---------------------------------------------------------------------------
@@ -175,191 +1022,624 @@ def _chunk_pages(pages, filename):
 # slow/blocked network on first use, or OCR looping on a malformed/huge
 # scanned PDF) never raises an exception - it just blocks the worker
 # thread indefinitely, which is what left documents parked at "indexing"
-# forever with no error surfaced anywhere. Every call to these two stages
-# now runs through _call_with_timeout() so a hang becomes a caught,
-# logged TimeoutError -> status "error" -within a bounded time, instead
-# of an invisible, permanent hang.
-EXTRACTION_TIMEOUT_SECONDS = 180     # generous for large/scanned+OCR PDFs
+# forever with no error surfaced anywhere. Both stages now wait with a
+# deadline, so a hang becomes a caught, logged TimeoutError -> status
+# "error" within a bounded time, instead of an invisible, permanent hang.
+# Python can't force-kill a thread, so a genuinely hung call keeps running
+# in the background - but the document is marked failed right away.
+# Extraction streams pages (below), so its deadline is per page: no page
+# for EXTRACTION_TIMEOUT_SECONDS means it is stuck, however long a big
+# scanned PDF takes in total.
+EXTRACTION_TIMEOUT_SECONDS = 180     # generous for a huge/scanned+OCR page
 EMBED_BATCH_TIMEOUT_SECONDS = 90     # per embedding batch (incl. first-use model load)
 
 
-def _call_with_timeout(fn, timeout_seconds, *args, **kwargs):
+# ---------------------------------------------------------------------------
+# Streaming extract -> chunk -> embed
+# ---------------------------------------------------------------------------
+# Indexing used to run its stages back to back: extract every page (for a
+# scanned PDF that means OCR, by far the slowest step), then chunk, then
+# embed, with the embedding pool idle for all of extraction. Now pages flow
+# out of engine.iter_file_pages() on an extraction thread through a
+# bounded queue (at most EXTRACT_QUEUE_PAGES extracted pages wait in
+# memory); the indexing thread chunks, diffs and cache-checks each page as
+# it arrives and hands the embedding pool a batch as soon as a full one's
+# worth of chunks is waiting. OCR of the next pages overlaps embedding of
+# the previous ones, so for an OCR-heavy PDF most of the extraction time
+# is hidden behind embedding (or the other way round).
+EXTRACT_QUEUE_PAGES = 32
+_PAGES_DONE = object()
+
+
+class _ExtractionError(Exception):
+    """The extraction stage failed; `cause` is what it raised."""
+
+    def __init__(self, cause: BaseException):
+        super().__init__(str(cause))
+        self.cause = cause
+
+
+def _extract_into(raw_bytes, filename, after_page, pages: queue.Queue, stop: threading.Event):
+    """Extraction thread: puts each (page, text), then _PAGES_DONE or the
+    exception extraction raised. Gives up once `stop` is set."""
+    def put(item):
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    try:
+        for page in engine.iter_file_pages(raw_bytes, filename, after_page):
+            if not put(page):
+                return
+    except Exception as e:
+        put(e)
+        return
+    put(_PAGES_DONE)
+
+
+def _stream_pages(raw_bytes, filename, stop: threading.Event, after_page: int = 0):
+    """Yields a document's (page, text) after page `after_page` as the
+    extraction thread produces them. Raises _ExtractionError if extraction
+    fails or produces no page for EXTRACTION_TIMEOUT_SECONDS. Set `stop`
+    to abandon it early."""
+    pages = queue.Queue(maxsize=EXTRACT_QUEUE_PAGES)
+    threading.Thread(target=_extract_into, args=(raw_bytes, filename, after_page, pages, stop),
+                     name="rag-extract", daemon=True).start()
+    while True:
+        try:
+            item = pages.get(timeout=EXTRACTION_TIMEOUT_SECONDS)
+        except queue.Empty:
+            raise _ExtractionError(concurrent.futures.TimeoutError()) from None
+        if item is _PAGES_DONE:
+            return
+        if isinstance(item, Exception):
+            raise _ExtractionError(item) from item
+        yield item
+
+
+class _IndexPipeline:
+    """
+    One document's chunks, diff and vectors, built up page by page.
+    batches() drives the whole thing: it pulls pages, chunks them, takes
+    each chunk's vector from the old version of the file (unchanged chunk)
+    or the embedding cache where it can, and yields row batches of the
+    rest for _embed_batches(), whose results the caller stores in
+    `vectors`. Single-threaded: only the indexing thread touches it.
+    """
+
+    def __init__(self, filename, progress_key, old_chunks, old_sub, checkpoint=None):
+        self.filename = filename
+        self.progress_key = progress_key
+        self.old = _old_chunk_map(old_chunks)
+        self.old_sub = old_sub
+        self.checkpoint = checkpoint
+        self.n_resumed_pages = len(checkpoint.pages) if checkpoint is not None else 0
+        self.n_resumed_vectors = 0
+        self.seen_hashes = set()
+        self.chunks, self.texts, self.hashes, self.keep = [], [], [], []
+        self.vectors = np.zeros((0, EMBED_DIM), dtype=np.float32)   # grown by doubling
+        self.pending = []          # rows waiting to be batched
+        self.pending_tokens = 0
+        self.n_pages = 0
+        self.page_nums = []
+        self.n_todo = 0            # rows that need the model (so far)
+        self.n_embedded = 0
+        self.extracted = False
+        self.extract_seconds = None
+        self.percent = 5
+
+    def add_page(self, page_num, text, record=True):
+        self.n_pages += 1
+        if record:
+            self._checkpoint(lambda checkpoint: checkpoint.add_page(page_num, text))
+        if page_num is not None:
+            self.page_nums.append(page_num)
+        new = _chunk_pages([(page_num, text)], self.filename, self.seen_hashes)
+        if not new:
+            return
+        start, end = len(self.chunks), len(self.chunks) + len(new)
+        self.chunks += new
+        self.texts += [c["text"] for c in new]
+        self.hashes += [c["hash"] for c in new]
+        keep = _diff_chunks(self.old, new)
+        kept = keep >= 0
+        self.keep += keep.tolist()
+        # Chunks whose normalized text was embedded before - in an earlier
+        # version of this file or in any other document - come straight
+        # from the embedding cache; only the rest go to the model.
+        vectors, cached = _embed_cache.get_many([c["hash"] for c in new])
+        if kept.any():
+            vectors[kept] = self.old_sub.vectors(keep[kept])
+            cached |= kept
+        if self.checkpoint is not None and self.checkpoint.vectors:
+            # Embedded by an earlier, interrupted attempt at this upload.
+            for i in np.flatnonzero(~cached):
+                vector = self.checkpoint.vectors.get(new[i]["hash"])
+                if vector is not None:
+                    vectors[i] = vector
+                    cached[i] = True
+                    self.n_resumed_vectors += 1
+        if end > len(self.vectors):
+            grown = np.zeros((max(end, 2 * len(self.vectors)), EMBED_DIM), dtype=np.float32)
+            grown[:start] = self.vectors[:start]
+            self.vectors = grown
+        self.vectors[start:end] = vectors
+        todo = (start + np.flatnonzero(~cached)).tolist()
+        self.pending += todo
+        self.pending_tokens += sum(BatchSizer.tokens(len(self.texts[i])) for i in todo)
+        self.n_todo += len(todo)
+
+    def _plan(self, final):
+        taken = []
+        for rows in _batch_sizer.plan(self.pending, [len(self.texts[i]) for i in self.pending], final=final):
+            taken += rows.tolist()
+            self.pending_tokens -= sum(BatchSizer.tokens(len(self.texts[i])) for i in rows)
+            yield rows
+        taken = set(taken)
+        self.pending = [i for i in self.pending if i not in taken]
+
+    def batches(self, pages):
+        """`pages`: what extraction yields after the pages the checkpoint
+        already has (which are replayed first)."""
+        extract_start = time.monotonic()
+        replayed = [(page_num, text, False) for page_num, text in
+                    (self.checkpoint.pages if self.checkpoint is not None else ())]
+        for page_num, text, record in itertools.chain(
+                replayed, ((page_num, text, True) for page_num, text in pages)):
+            self.add_page(page_num, text, record)
+            self.report()
+            if (self.pending_tokens >= _batch_sizer.token_budget()
+                    or len(self.pending) >= _batch_sizer.max_batch):
+                yield from self._plan(final=False)
+        self.extracted = True
+        self.extract_seconds = time.monotonic() - extract_start
+        if self.checkpoint is not None and not self.checkpoint.extracted:
+            self._checkpoint(lambda checkpoint: checkpoint.finish_extraction())
+        self.report()
+        yield from self._plan(final=True)
+
+    def save_batch(self, rows, emb):
+        """Checkpoints an embedded batch (and every page recorded before it)."""
+        hashes = [self.hashes[i] for i in rows]
+
+        def write(checkpoint):
+            checkpoint.add_vectors(hashes, emb)
+            checkpoint.sync()
+        self._checkpoint(write)
+
+    def _checkpoint(self, write):
+        # A checkpoint is an optimization: failing to write one (disk full,
+        # ...) stops checkpointing this run, not the indexing.
+        if self.checkpoint is None:
+            return
+        try:
+            write(self.checkpoint)
+        except OSError as e:
+            print(f"[RAG-STORE] '{self.filename}': writing the indexing checkpoint FAILED ({e}) - "
+                  f"continuing without one.")
+            self.checkpoint.discard()
+            self.checkpoint = None
+
+    def report(self):
+        if self.n_todo:
+            share = self.n_embedded / self.n_todo
+        else:
+            share = 1.0 if self.extracted else 0.0
+        # How much is still to come is unknown until extraction ends, so
+        # until then the bar covers only half of the embedding range.
+        self.percent = max(self.percent, 5 + int((85 if self.extracted else 45) * share))
+        extract_state = "done" if self.extracted else "running"
+        message = (f"Extracted {self.n_pages} page(s){'' if self.extracted else ' so far'}, "
+                   f"{len(self.chunks)} chunk(s); embedded {self.n_embedded}/{self.n_todo}...")
+        _set_progress(self.progress_key, "indexing", self.percent, message, stages={
+            "extract": {"status": extract_state, "pages": self.n_pages, "resumed": self.n_resumed_pages},
+            "chunk": {"status": extract_state, "chunks": len(self.chunks),
+                      "reused": len(self.chunks) - self.n_todo},
+            "embed": {"status": "done" if self.extracted and self.n_embedded == self.n_todo else "running",
+                      "done": self.n_embedded, "total": self.n_todo, "resumed": self.n_resumed_vectors},
+        })
+
+
+def _timed_embed(batch):
+    embed_start = time.monotonic()
+    emb = engine.embed_texts(batch, lane="bulk", concurrent=True)
+    return emb, time.monotonic() - embed_start
+
+
+def _embed_batches(texts, batches):
     """
-    Runs fn(*args, **kwargs) with a hard wall-clock deadline. Raises
-    concurrent.futures.TimeoutError (a subclass of Exception, so existing
-    `except Exception` blocks around extraction/embedding already catch
-    it) if the deadline is exceeded. Python can't force-kill a thread, so
-    a genuinely hung call keeps running in the background after this
-    returns - but the document being indexed is immediately marked
-    "error" instead of the caller (and its progress status) blocking
-    forever.
+    Embeds `batches` (arrays of row numbers into `texts`; an iterable,
+    consumed one batch at a time as earlier ones finish) on the shared
+    bulk-embedding pool, up to EMBED_PARALLEL_BATCHES of them at once, and
+    yields (rows, L2-normalized float32 vectors, seconds) per batch in
+    batch order, reporting each batch's latency to _batch_sizer. Getting
+    the next batch may block (the indexing pipeline makes them as pages
+    are extracted), so a finished batch is yielded before more are
+    queued behind it.
+    A batch that hasn't finished EMBED_BATCH_TIMEOUT_SECONDS after it
+    became the next one in line raises concurrent.futures.TimeoutError
+    (a hung call is abandoned, not killed).
     """
-    ex = concurrent.futures.ThreadPoolExecutor(max_workers=1)
-    future = ex.submit(fn, *args, **kwargs)
+    in_flight = collections.deque()
+    queued = iter(batches)
+
+    exhausted = False
+
     try:
-        return future.result(timeout=timeout_seconds)
+        while True:
+            while not exhausted and len(in_flight) < max(1, EMBED_PARALLEL_BATCHES) \
+                    and not (in_flight and in_flight[0][1].done()):
+                rows = next(queued, None)
+                if rows is None:
+                    exhausted = True
+                else:
+                    in_flight.append((rows, _embed_executor.submit(_timed_embed, [texts[i] for i in rows])))
+            if not in_flight:
+                return
+            rows, future = in_flight.popleft()
+            emb, seconds = future.result(timeout=EMBED_BATCH_TIMEOUT_SECONDS)
+            _batch_sizer.observe(len(rows), max(BatchSizer.tokens(len(texts[i])) for i in rows), seconds)
+            # L2-normalize so FAISS inner product == cosine similarity.
+            emb = np.asarray(emb, dtype=np.float32)
+            norms = np.linalg.norm(emb, axis=1, keepdims=True)
+            norms[norms == 0] = 1e-8
+            yield rows, emb / norms, seconds
     finally:
-        ex.shutdown(wait=False)
+        for _, future in in_flight:
+            future.cancel()
 
 
 # ---------------------------------------------------------------------------
 # Progress tracking
 # ---------------------------------------------------------------------------
-def get_progress(filename: str | None = None):
+def get_progress(filename: str | None = None, tenant=None):
     if filename:
-        return _progress.get(filename, {"status": "not_indexed", "percent": 0})
-    return dict(_progress)
+        return _progress.get((tenant, filename), {"status": "not_indexed", "percent": 0})
+    return {f: p for (t, f), p in list(_progress.items()) if t == tenant}
 
 
-def _set_progress(filename, status, percent, message=""):
-    _progress[filename] = {"status": status, "percent": percent, "message": message}
+def _set_progress(key, status, percent, message="", stages=None):
+    """`key` is (tenant, filename). `stages`: per-stage detail while a
+    document is going through the indexing pipeline."""
+    entry = {"status": status, "percent": percent, "message": message}
+    if stages is not None:
+        entry["stages"] = stages
+    _progress[key] = entry
 
 
 # ---------------------------------------------------------------------------
 # Indexing
 # ---------------------------------------------------------------------------
-def remove_document(filename: str):
+def remove_document(filename: str, tenant=None):
     """Removes all chunks/vectors belonging to a file (used on delete and
     before re-indexing)."""
-    global _metadata
-    with _lock:
-        ids_to_remove = [int(cid) for cid, m in _metadata.items() if m["filename"] == filename]
-        if ids_to_remove:
-            _index.remove_ids(np.array(ids_to_remove, dtype=np.int64))
-            _metadata = {cid: m for cid, m in _metadata.items() if int(cid) not in ids_to_remove}
-        _manifest.pop(filename, None)
-        _save()
-        _rebuild_bm25()
-    _progress.pop(filename, None)
-
-
-def index_document(filename: str, raw_bytes: bytes):
-    """
-    Synchronous indexing of one file: extract page-aware text, chunk,
-    batch-embed, and add to FAISS + persist. Skips re-embedding if the
-    file's content hash hasn't changed since last time (handles server
-    restarts and duplicate uploads cheaply).
-    """
-    global _next_id
+    with _shards.use(tenant) as shard:
+        _remove_document(shard, filename)
+
+
+def _remove_document(shard, filename: str):
+    with shard.lock:
+        shard.versions.run_reclaimed()
+        current = shard.versions.current
+        if filename in current.vectors or filename in current.manifest:
+            _log_write(shard, {"op": "remove", "filename": filename})
+            shard.dirty.add(filename)
+            # The file's sub-index and BM25 segment just drop out of the
+            # next version - no remove_ids() shifting of a shared index,
+            # no posting-list edits. Its chunk rows are tombstoned in place
+            # once searches still holding the current version are done.
+            nxt = current.derive()
+            nxt.vectors.pop(filename, None)
+            nxt.bm25.pop(filename, None)
+            nxt.manifest.pop(filename, None)
+            file_chunks = nxt.files.pop(filename, None)
+            _publish(shard, nxt, file_chunks.ids if file_chunks is not None else None)
+    shard.discard_checkpoints(filename)
+    _progress.pop((shard.tenant, filename), None)
+
+
+# The pre-sharding store (tenant=None, directly under INDEX_DIR) isn't
+# searched by any request: every route passes the signed-in user's id. Its
+# files belong to no user in particular, and a document only ever reaches a
+# chat by being uploaded (the upload list lives in memory, so after a
+# restart every file is uploaded again). So it is migrated file by file, on
+# upload: when a user's upload has the same name and content hash as a file
+# in the old store - proof the user has those bytes - the old store's chunk
+# vectors are copied into the embedding cache, and indexing the file into
+# the user's shard embeds nothing. RAG_LEGACY_MIGRATION=0 turns this off.
+LEGACY_MIGRATION = os.environ.get("RAG_LEGACY_MIGRATION", "1") != "0"
+
+
+def _has_legacy_store() -> bool:
+    """Whether INDEX_DIR holds any pre-sharding data, without loading it."""
+    try:
+        gen_dir = _generation_dir(INDEX_DIR, _read_generation(INDEX_DIR))
+    except (OSError, ValueError, KeyError):
+        return True
+    paths = [os.path.join(gen_dir, name) for name in ("manifest.json", "faiss.index", "wal.log")]
+    return any(os.path.exists(p) and os.path.getsize(p) > 0 for p in paths)
+
+
+def _adopt_legacy_vectors(filename: str, file_hash: str) -> int:
+    """Copies `filename`'s vectors from the pre-sharding store into the
+    embedding cache if it holds exactly these bytes. Returns how many."""
+    if not LEGACY_MIGRATION or not _has_legacy_store():
+        return 0
+    with _shards.use(None) as legacy:
+        version = legacy.versions.current
+        sub = version.vectors.get(filename)
+        if version.manifest.get(filename, {}).get("hash") != file_hash or sub is None:
+            return 0
+        ids = sub.ids()
+        vectors = sub.vectors()
+        metas = version.chunks.get_many(ids)
+        del version
+    rows = [i for i, cid in enumerate(ids) if int(cid) in metas]
+    hashes = [metas[int(ids[i])]["hash"] or _norm_text_hash(metas[int(ids[i])]["text"]) for i in rows]
+    _embed_cache.put_many(hashes, vectors[rows])
+    return len(rows)
+
+
+def index_document(filename: str, raw_bytes: bytes, tenant=None):
+    """
+    Synchronous indexing of one file into `tenant`'s shard: extract
+    page-aware text, chunk, batch-embed, and add to FAISS + persist. Skips
+    re-embedding if the file's content hash hasn't changed since last time
+    (handles server restarts and duplicate uploads cheaply).
+    """
+    # The shard stays pinned (not evictable) for the whole upload.
+    with _shards.use(tenant) as shard:
+        _index_document(shard, filename, raw_bytes)
+
+
+def _index_document(shard, filename: str, raw_bytes: bytes):
+    progress_key = (shard.tenant, filename)
     file_hash = _file_hash(raw_bytes)
-    if _manifest.get(filename, {}).get("hash") == file_hash:
+    manifest = shard.versions.current.manifest
+    if manifest.get(filename, {}).get("hash") == file_hash:
         print(f"[RAG-STORE] '{filename}' unchanged (hash match) - skipping re-embedding. "
-              f"{_manifest[filename].get('num_chunks', 0)} chunks already indexed.")
-        _set_progress(filename, "done", 100, "Already indexed (unchanged).")
+              f"{manifest[filename].get('num_chunks', 0)} chunks already indexed.")
+        _set_progress(progress_key, "done", 100, "Already indexed (unchanged).")
+        shard.discard_checkpoints(filename)
         return
 
     print(f"[RAG-STORE] Indexing '{filename}' ({len(raw_bytes)} bytes)...")
-    _set_progress(filename, "indexing", 5, "Extracting text...")
-    extract_start = time.monotonic()
+    _set_progress(progress_key, "indexing", 5, "Extracting text...")
+    if shard.tenant is not None and filename not in manifest:
+        try:
+            adopted = _adopt_legacy_vectors(filename, file_hash)
+            if adopted:
+                print(f"[RAG-STORE] '{filename}': {adopted} chunk vector(s) carried over from the "
+                      f"pre-sharding store - nothing to re-embed.")
+        except Exception as e:
+            # Only a missed shortcut: the file is embedded as usual.
+            print(f"[RAG-STORE] '{filename}': reading the pre-sharding store FAILED: {e}")
+    checkpoint, claimed = None, False
+    directory = shard.checkpoint_dir(filename, file_hash)
+    if INDEX_CHECKPOINTS and len(raw_bytes) >= CHECKPOINT_MIN_BYTES:
+        with _checkpoints_lock:
+            claimed = directory not in _checkpoints_in_use
+            _checkpoints_in_use.add(directory)
+        if claimed:
+            # This upload supersedes checkpoints of other bytes under the
+            # same name (unless another run is still on one).
+            shard.discard_checkpoints(filename)
+            checkpoint = IndexCheckpoint(directory, engine.EMBED_MODEL_NAME, EMBED_DIM)
+        else:
+            print(f"[RAG-STORE] '{filename}': the same upload is already being indexed - "
+                  f"indexing this one without a checkpoint.")
+    if checkpoint is not None:
+        try:
+            if checkpoint.open(filename, shard.tenant, file_hash, raw_bytes):
+                print(f"[RAG-STORE] '{filename}': resuming from checkpoint (attempt "
+                      f"{checkpoint.meta['attempts']}) - {len(checkpoint.pages)} page(s) already extracted"
+                      f"{' (all)' if checkpoint.extracted else ''}, {len(checkpoint.vectors)} chunk(s) "
+                      f"already embedded.")
+        except OSError as e:
+            print(f"[RAG-STORE] '{filename}': indexing checkpoint unavailable ({e}) - indexing without one.")
+            checkpoint.discard()
+            checkpoint = None
     try:
-        pages = _call_with_timeout(engine.load_file_pages, EXTRACTION_TIMEOUT_SECONDS, raw_bytes, filename)
-    except concurrent.futures.TimeoutError:
-        print(f"[RAG-STORE] '{filename}' extraction TIMED OUT after "
-              f"{EXTRACTION_TIMEOUT_SECONDS}s (stuck extraction/OCR call) - marking failed.")
-        _set_progress(filename, "error", 0,
-                      f"Extraction timed out after {EXTRACTION_TIMEOUT_SECONDS}s.")
+        _index_pages(shard, filename, raw_bytes, file_hash, checkpoint)
+    finally:
+        if checkpoint is not None:
+            checkpoint.close()
+            if os.path.isdir(checkpoint.dir):
+                print(f"[RAG-STORE] '{filename}': checkpoint kept ({len(checkpoint.pages)} page(s), "
+                      f"{checkpoint.n_vectors} chunk vector(s)) - retrying this upload "
+                      f"resumes from it.")
+        if claimed:
+            with _checkpoints_lock:
+                _checkpoints_in_use.discard(directory)
+
+
+def _index_pages(shard, filename: str, raw_bytes: bytes, file_hash: str, checkpoint):
+    """The part of _index_document() a checkpoint can resume: everything
+    after the unchanged-upload check. Discards `checkpoint` once it is of
+    no further use (indexed, or failed in a way a retry wouldn't fix)."""
+    progress_key = (shard.tenant, filename)
+
+    # Re-upload of an indexed file: diff against the indexed version
+    # instead of removing it and starting over. Chunks with the same text
+    # hash on the same page keep their id, row, vector and BM25 postings;
+    # only the changed ones are embedded, appended and logged. The old
+    # version stays searchable until the new one is published in one swap.
+    old_version = shard.versions.current
+    old_chunks = old_version.files.get(filename)
+    pipeline = _IndexPipeline(filename, progress_key, old_chunks, old_version.vectors.get(filename), checkpoint)
+    del old_version
+
+    index_start = time.monotonic()
+    stop = threading.Event()
+    batch_sizes = []
+    # Extraction resumes after the last page the checkpoint has; an
+    # unpaginated document is a single page, so having it means done.
+    saved = checkpoint.pages if checkpoint is not None else []
+    if checkpoint is not None and (checkpoint.extracted or (saved and saved[-1][0] is None)):
+        pages = iter(())
+    else:
+        pages = _stream_pages(raw_bytes, filename, stop, after_page=saved[-1][0] if saved else 0)
+    try:
+        batches = pipeline.batches(pages)
+        for rows, emb, seconds in _embed_batches(pipeline.texts, batches):
+            pipeline.vectors[rows] = emb
+            _embed_cache.put_many([pipeline.hashes[i] for i in rows], emb)
+            pipeline.save_batch(rows, emb)
+            batch_sizes.append(len(rows))
+            pipeline.n_embedded += len(rows)
+            print(f"[RAG-STORE] '{filename}': embedded {pipeline.n_embedded}/{pipeline.n_todo}"
+                  f"{'' if pipeline.extracted else '+'} chunks - batch of {len(rows)} in {seconds:.2f}s "
+                  f"({len(rows) / max(seconds, 1e-6):.0f} chunks/s).")
+            pipeline.report()
+    except _ExtractionError as e:
+        if isinstance(e.cause, concurrent.futures.TimeoutError):
+            print(f"[RAG-STORE] '{filename}' extraction TIMED OUT: no page for "
+                  f"{EXTRACTION_TIMEOUT_SECONDS}s after page {pipeline.n_pages} "
+                  f"(stuck extraction/OCR call) - marking failed.")
+            _set_progress(progress_key, "error", 0,
+                          f"Extraction timed out after {EXTRACTION_TIMEOUT_SECONDS}s.")
+        elif isinstance(e.cause, engine.UnsupportedFileError):
+            print(f"[RAG-STORE] '{filename}' extraction unsupported: {e}")
+            _set_progress(progress_key, "error", 0, str(e))
+            if checkpoint is not None:
+                checkpoint.discard()
+        else:
+            print(f"[RAG-STORE] '{filename}' extraction FAILED: {e}\n"
+                  f"{''.join(traceback.format_exception(e.cause))}")
+            _set_progress(progress_key, "error", 0, f"Extraction failed: {e}")
         return
-    except engine.UnsupportedFileError as e:
-        print(f"[RAG-STORE] '{filename}' extraction unsupported: {e}")
-        _set_progress(filename, "error", 0, str(e))
+    except concurrent.futures.TimeoutError:
+        print(f"[RAG-STORE] '{filename}': embedding TIMED OUT after "
+              f"{EMBED_BATCH_TIMEOUT_SECONDS}s on batch after chunk {pipeline.n_embedded} "
+              f"(stuck embedding call, e.g. model download hanging) - marking failed.")
+        _set_progress(progress_key, "error", 0,
+                      f"Embedding timed out after {EMBED_BATCH_TIMEOUT_SECONDS}s "
+                      f"on batch after chunk {pipeline.n_embedded}.")
         return
     except Exception as e:
-        print(f"[RAG-STORE] '{filename}' extraction FAILED: {e}\n{traceback.format_exc()}")
-        _set_progress(filename, "error", 0, f"Extraction failed: {e}")
+        # Previously this exception would only be caught by the background
+        # wrapper's generic try/except with no detail printed anywhere,
+        # so a mid-document embedding failure looked identical to "0
+        # chunks indexed" with nothing in the server logs to explain why.
+        print(f"[RAG-STORE] '{filename}': embedding FAILED after {pipeline.n_embedded} chunk(s): "
+              f"{e}\n{traceback.format_exc()}")
+        _set_progress(progress_key, "error", 0, f"Embedding failed: {e}")
         return
-    print(f"[RAG-STORE] '{filename}': extraction took {time.monotonic() - extract_start:.1f}s.")
+    finally:
+        stop.set()
+    index_seconds = time.monotonic() - index_start
 
-    print(f"[RAG-STORE] '{filename}': extracted {len(pages)} page(s) total "
+    print(f"[RAG-STORE] '{filename}': extraction took {pipeline.extract_seconds:.1f}s, "
+          f"overlapped with chunking and embedding.")
+    print(f"[RAG-STORE] '{filename}': extracted {pipeline.n_pages} page(s) total "
           f"(pages with no extractable text are dropped upstream).")
-    if pages:
-        page_nums = [p for p, _ in pages if p is not None]
-        if page_nums:
-            print(f"[RAG-STORE] '{filename}': page numbers range {min(page_nums)}-{max(page_nums)}.")
-
-    # Remove any previous version of this file first (re-index case).
-    remove_document(filename)
+    if pipeline.page_nums:
+        print(f"[RAG-STORE] '{filename}': page numbers range "
+              f"{min(pipeline.page_nums)}-{max(pipeline.page_nums)}.")
 
-    chunks = _chunk_pages(pages, filename)
+    chunks = pipeline.chunks
     if not chunks:
+        # Nothing to index for the new version; drop the previous one.
+        if checkpoint is not None:
+            checkpoint.discard()
+        _remove_document(shard, filename)
         print(f"[RAG-STORE] '{filename}': 0 chunks produced (no extractable text) - aborting index.")
-        _set_progress(filename, "error", 0, "No extractable text found.")
+        _set_progress(progress_key, "error", 0, "No extractable text found.")
         return
 
     chunks_missing_page = sum(1 for c in chunks if c["page"] is None)
     print(f"[RAG-STORE] '{filename}': {len(chunks)} chunk(s) created "
           f"({len(chunks) - chunks_missing_page} with page numbers, {chunks_missing_page} without).")
-
-    _set_progress(filename, "indexing", 20, f"Embedding {len(chunks)} chunks...")
-    texts = [c["text"] for c in chunks]
-    vectors = np.zeros((len(texts), EMBED_DIM), dtype=np.float32)
-    embed_start = time.monotonic()
-    start = 0
-    try:
-        for start in range(0, len(texts), EMBED_BATCH_SIZE):
-            batch = texts[start:start + EMBED_BATCH_SIZE]
-            emb = _call_with_timeout(engine.embed_texts, EMBED_BATCH_TIMEOUT_SECONDS, batch).astype(np.float32)
-            # L2-normalize so FAISS inner product == cosine similarity.
-            norms = np.linalg.norm(emb, axis=1, keepdims=True)
-            norms[norms == 0] = 1e-8
-            vectors[start:start + len(batch)] = emb / norms
-            done = start + len(batch)
-            pct = 20 + int(70 * done / len(texts))
-            print(f"[RAG-STORE] '{filename}': embedded {done}/{len(texts)} chunks ({pct}%).")
-            _set_progress(filename, "indexing", pct, f"Embedding {done}/{len(texts)} chunks...")
-    except concurrent.futures.TimeoutError:
-        print(f"[RAG-STORE] '{filename}': embedding TIMED OUT after "
-              f"{EMBED_BATCH_TIMEOUT_SECONDS}s on batch starting at chunk {start} "
-              f"(stuck embedding call, e.g. model download hanging) - marking failed.")
-        _set_progress(filename, "error", 0,
-                      f"Embedding timed out after {EMBED_BATCH_TIMEOUT_SECONDS}s on batch starting {start}.")
-        return
-    except Exception as e:
-        # Previously this exception would only be caught by the background
-        # wrapper's generic try/except with no detail printed anywhere,
-        # so a mid-document embedding failure looked identical to "0
-        # chunks indexed" with nothing in the server logs to explain why.
-        print(f"[RAG-STORE] '{filename}': embedding FAILED at chunk batch starting {start}: "
-              f"{e}\n{traceback.format_exc()}")
-        _set_progress(filename, "error", 0, f"Embedding failed: {e}")
-        return
-    print(f"[RAG-STORE] '{filename}': embedding of {len(texts)} chunks took "
-          f"{time.monotonic() - embed_start:.1f}s.")
-
-    _set_progress(filename, "indexing", 92, "Saving to FAISS/BM25 index...")
+    keep = np.array(pipeline.keep, dtype=np.int64)
+    kept = keep >= 0
+    if old_chunks is not None:
+        print(f"[RAG-STORE] '{filename}': re-upload diff - {int(kept.sum())} unchanged chunk(s) kept, "
+              f"{int((~kept).sum())} new/changed, {len(old_chunks) - int(kept.sum())} removed.")
+    n_todo = pipeline.n_todo
+    print(f"[RAG-STORE] '{filename}': {len(chunks) - n_todo}/{len(chunks)} chunk embedding(s) "
+          f"reused (kept, cached or checkpointed), {n_todo} embedded.")
+    print(f"[RAG-STORE] '{filename}': extract+embed of {n_todo} chunks took {index_seconds:.1f}s"
+          + (f" ({n_todo / max(index_seconds, 1e-6):.0f} chunks/s; {len(batch_sizes)} batch(es) of "
+             f"{min(batch_sizes)}-{max(batch_sizes)}, median {int(np.median(batch_sizes))}; token budget now "
+             f"{_batch_sizer.token_budget()})." if batch_sizes else "."))
+    vectors = pipeline.vectors[:len(chunks)]
+    del pipeline
+
+    _set_progress(progress_key, "indexing", 92, "Saving to FAISS/BM25 index...")
     try:
-        with _lock:
-            ids = np.arange(_next_id, _next_id + len(chunks), dtype=np.int64)
-            _next_id += len(chunks)
-            _index.add_with_ids(vectors, ids)
-            for cid, c in zip(ids, chunks):
-                _metadata[str(int(cid))] = c
-            _manifest[filename] = {
-                "hash": file_hash,
-                "num_chunks": len(chunks),
-            }
-            _save()
-            _rebuild_bm25()
+        with shard.lock:
+            shard.versions.run_reclaimed()
+            current = shard.versions.current
+            prev_chunks = current.files.get(filename)
+            if prev_chunks is not old_chunks:
+                # Another upload/delete of this file committed while we
+                # were embedding - the diff base is gone, so index the
+                # whole new version fresh (vectors are all in hand).
+                keep[:] = -1
+            new_rows = np.flatnonzero(keep < 0)
+            ids = keep.copy()
+            ids[new_rows] = shard.chunks.append(filename, [chunks[i] for i in new_rows])
+            removed = prev_chunks.ids[~np.isin(prev_chunks.ids, ids)] if prev_chunks is not None else None
+            sub = vector_index.build(EMBED_DIM, vectors, ids, summary_k=ROUTE_SUMMARY_VECTORS)
+            if len(new_rows) < len(ids) and filename in current.bm25:
+                segment = current.bm25[filename].copy()
+                for cid in removed:
+                    segment.remove(int(cid))
+                for i in new_rows:
+                    segment.add(int(ids[i]), tokenize(chunks[i]["text"]))
+            else:
+                segment = _build_bm25(dict(zip(ids, chunks)))
+            entry = {"hash": file_hash, "num_chunks": len(chunks)}
+            # Commit point: once this record is fsynced the upload survives
+            # a crash; the sub-index file itself is written by the next
+            # background snapshot. A diff logs only the changed vectors.
+            if len(new_rows) < len(ids):
+                _log_write(shard, {"op": "update", "filename": filename, "entry": entry,
+                                   "n": len(ids), "n_new": len(new_rows)},
+                           _update_payload(ids, new_rows, vectors[new_rows]))
+            else:
+                _log_write(shard, {"op": "add", "filename": filename, "entry": entry, "n": len(ids)},
+                           _add_payload(ids, vectors))
+            shard.dirty.add(filename)
+            # Searches running now keep the version they started with;
+            # the next one sees this file complete (never half-added).
+            nxt = current.derive(chunks=shard.chunks.view())
+            nxt.vectors[filename] = sub
+            nxt.bm25[filename] = segment
+            nxt.files[filename] = nxt.chunks.file_chunks(ids)
+            nxt.manifest[filename] = dict(entry, index=vector_index.describe(sub))
+            _publish(shard, nxt, removed)
+            total = nxt.ntotal()
+            del current
     except Exception as e:
         print(f"[RAG-STORE] '{filename}': FAISS/BM25 save FAILED: {e}\n{traceback.format_exc()}")
-        _set_progress(filename, "error", 0, f"Failed to save index: {e}")
+        _set_progress(progress_key, "error", 0, f"Failed to save index: {e}")
         return
 
-    print(f"[RAG-STORE] '{filename}': FAISS save completed. {len(chunks)} vectors added "
-          f"(index.ntotal={_index.ntotal} total across all files). Saved to {FAISS_PATH}.")
-    _set_progress(filename, "done", 100, f"Indexed {len(chunks)} chunks.")
+    print(f"[RAG-STORE] '{filename}': FAISS save completed. {len(new_rows)} vectors added, "
+          f"{len(chunks) - len(new_rows)} kept "
+          f"({total} total across the shard's files). Logged to {shard.wal.path}; "
+          f"{shard.vector_path(filename)} is written by the next snapshot.")
+    _set_progress(progress_key, "done", 100, f"Indexed {len(chunks)} chunks.")
+    if checkpoint is not None:
+        checkpoint.discard()
 
 
-def index_document_background(filename: str, raw_bytes: bytes):
+def index_document_background(filename: str, raw_bytes: bytes, tenant=None):
     """Fire-and-forget background indexing so /upload doesn't block on
     embedding large documents. Progress is pollable via get_progress().
     Runs on a small bounded worker pool (not an unbounded thread-per-call)
     so many simultaneous uploads queue safely instead of spawning unlimited
     concurrent CPU-heavy embedding threads."""
-    _set_progress(filename, "queued", 0, "Queued for indexing.")
+    _set_progress((tenant, filename), "queued", 0, "Queued for indexing.")
 
     def _run():
         try:
-            index_document(filename, raw_bytes)
+            index_document(filename, raw_bytes, tenant)
         except Exception as e:
             # Defense-in-depth: index_document() now handles/logs every
             # known failure point (extraction, embedding, FAISS save)
@@ -369,25 +1649,194 @@ def index_document_background(filename: str, raw_bytes: bytes):
             # than left parked at "queued"/"indexing".
             print(f"[RAG-STORE] '{filename}': indexing FAILED with an unhandled "
                   f"error: {e}\n{traceback.format_exc()}")
-            _set_progress(filename, "error", 0, f"Indexing failed: {e}")
+            _set_progress((tenant, filename), "error", 0, f"Indexing failed: {e}")
 
     _index_executor.submit(_run)
 
 
-def clear_all():
-    global _index, _metadata, _manifest, _next_id, _bm25, _bm25_ids
-    with _lock:
-        _index = faiss.IndexIDMap2(faiss.IndexFlatIP(EMBED_DIM))
-        _metadata = {}
-        _manifest = {}
-        _next_id = 0
-        _bm25, _bm25_ids = None, []
-        _save()
-    _progress.clear()
+def resume_checkpoints():
+    """
+    Restarts, in the background, the uploads whose indexing a restart
+    interrupted (their checkpoints are still on disk, with the uploaded
+    bytes), across every tenant; each resumes where it stopped. One that
+    has already used up CHECKPOINT_MAX_ATTEMPTS attempts is dropped
+    instead - a retry-on-every-boot loop helps nobody. Returns how many
+    were restarted.
+    """
+    if not INDEX_CHECKPOINTS:
+        return 0
+    roots = [INDEX_DIR]
+    if os.path.isdir(TENANTS_DIR):
+        roots += [os.path.join(TENANTS_DIR, name) for name in sorted(os.listdir(TENANTS_DIR))]
+    resumed = 0
+    for root in roots:
+        checkpoints_dir = os.path.join(root, "checkpoints")
+        if not os.path.isdir(checkpoints_dir):
+            continue
+        for name in sorted(os.listdir(checkpoints_dir)):
+            directory = os.path.join(checkpoints_dir, name)
+            meta = IndexCheckpoint.read_meta(directory)
+            if meta is None or _tenant_dir(meta.get("tenant")) != root:
+                print(f"[RAG-STORE] Removing unreadable indexing checkpoint {directory}.")
+                shutil.rmtree(directory, ignore_errors=True)
+                continue
+            filename, tenant = meta["filename"], meta["tenant"]
+            if meta.get("attempts", 0) >= CHECKPOINT_MAX_ATTEMPTS:
+                print(f"[RAG-STORE] '{filename}' (tenant={tenant!r}): giving up on its indexing checkpoint "
+                      f"after {meta.get('attempts')} attempts - the document has to be uploaded again.")
+                shutil.rmtree(directory, ignore_errors=True)
+                continue
+            try:
+                with open(os.path.join(directory, "upload.bin"), "rb") as f:
+                    raw_bytes = f.read()
+            except OSError as e:
+                print(f"[RAG-STORE] Removing indexing checkpoint {directory} (upload unreadable: {e}).")
+                shutil.rmtree(directory, ignore_errors=True)
+                continue
+            print(f"[RAG-STORE] '{filename}' (tenant={tenant!r}): indexing was interrupted - resuming it.")
+            index_document_background(filename, raw_bytes, tenant)
+            resumed += 1
+    return resumed
+
+
+def clear_all(tenant=None):
+    with _shards.use(tenant) as shard, shard.lock:
+        shard.versions.run_reclaimed()
+        current = shard.versions.current
+        _log_write(shard, {"op": "clear"})
+        shard.dirty.update(current.vectors)
+        # Rows are tombstoned (deferred, like remove_document) rather than
+        # the table truncated: a search may still be reading them.
+        ids = [fc.ids for fc in current.files.values()]
+        _publish(shard, StoreVersion(chunks=current.chunks),
+                 np.concatenate(ids) if ids else None)
+        del current   # so the tombstones can be reclaimed by the snapshot woken below
+    _snapshot_wakeup.set()
+    shutil.rmtree(os.path.join(_tenant_dir(tenant), "checkpoints"), ignore_errors=True)
+    for key in [key for key in list(_progress) if key[0] == tenant]:
+        _progress.pop(key, None)
+
+
+def list_indexed(tenant=None):
+    return dict(_current(tenant)[1].manifest)
+
+
+def flush():
+    """Snapshots every loaded shard now (log records -> sub-index files +
+    manifest), e.g. before a process that made changes exits."""
+    for shard in _shards.loaded():
+        _snapshot(shard)
+
+
+# ---------------------------------------------------------------------------
+# Snapshot archives (rag_snapshot.py)
+# ---------------------------------------------------------------------------
+def export_snapshot(out, filenames=None, tenant=None) -> dict:
+    """
+    Streams a portable archive of `tenant`'s shard - or only `filenames`
+    of it - to the binary file object `out`. Reads one immutable version
+    (no lock), so uploads and searches carry on meanwhile and the archive
+    is consistent as of the moment it started.
+    """
+    version = _current(tenant)[1]
+    names = list(version.files) if filenames is None else [f for f in filenames if f in version.files]
+    missing = sorted(set(filenames or ()) - set(names))
+    if missing:
+        print(f"[RAG-STORE] export_snapshot: {missing} not indexed in shard tenant={tenant!r} - skipped.")
+    writer = SnapshotWriter(out, engine.EMBED_MODEL_NAME, EMBED_DIM, names)
+    n_chunks = 0
+    for filename in names:
+        sub = version.vectors[filename]
+        ids = sub.ids()
+        metas = version.chunks.get_many(ids)
+        entry = {k: v for k, v in version.manifest[filename].items() if k != "index"}
+        writer.write_file(filename, entry, [metas[int(cid)] for cid in ids], sub.vectors())
+        n_chunks += len(ids)
+    writer.close()
+    print(f"[RAG-STORE] Exported {len(names)} file(s), {n_chunks} chunk(s) from shard tenant={tenant!r}.")
+    return {"files": names, "chunks": n_chunks}
+
+
+def import_snapshot(src, tenant=None) -> dict:
+    """
+    Installs an archive written by export_snapshot() into `tenant`'s shard,
+    reading it as a stream (one document in memory at a time until
+    commit). Files already indexed under the same name are replaced, all
+    other files are left alone. The install is atomic: chunk rows are
+    appended as documents arrive, but nothing becomes visible - or
+    survives a crash - until the archive's checksum has been verified and
+    one "import" log record covering every file is committed. Raises
+    rag_snapshot.SnapshotError (nothing installed) on a bad archive.
+    """
+    with _shards.use(tenant) as shard:
+        return _import_snapshot(shard, src)
 
 
-def list_indexed():
-    return dict(_manifest)
+def _import_snapshot(shard, src) -> dict:
+    import_start = time.monotonic()
+    staged = {}           # filename -> (entry, ids, chunks, vectors, chunk table), archive order
+    appended = []
+    committed = False
+    try:
+        for item in read_snapshot(src, engine.EMBED_MODEL_NAME, EMBED_DIM):
+            if item[0] == "end":
+                break
+            _, filename, entry, chunks, vectors = item
+            if filename in staged:
+                raise SnapshotError(f"'{filename}' appears twice in the archive.")
+            with shard.lock:
+                table = shard.chunks
+                ids = table.append(filename, chunks)
+            appended.append((table, ids))
+            staged[filename] = (entry, ids, chunks, vectors, table)
+        # Everything below only builds unpublished structures; the log
+        # record is the commit point.
+        built = {}
+        for filename, (entry, ids, chunks, vectors, _) in staged.items():
+            sub = vector_index.build(EMBED_DIM, vectors, ids, summary_k=ROUTE_SUMMARY_VECTORS)
+            built[filename] = (entry, ids, sub, _build_bm25(dict(zip(ids, chunks))))
+            _embed_cache.put_many([c["hash"] for c in chunks], vectors)
+        with shard.lock:
+            shard.versions.run_reclaimed()
+            current = shard.versions.current
+            for filename, (entry, _, chunks, vectors, table) in staged.items():
+                if table is not shard.chunks:
+                    # A compaction swapped the shard's chunk table since
+                    # these rows were appended: append them again.
+                    ids = shard.chunks.append(filename, chunks)
+                    appended.append((shard.chunks, ids))
+                    sub = vector_index.build(EMBED_DIM, vectors, ids, summary_k=ROUTE_SUMMARY_VECTORS)
+                    built[filename] = (entry, ids, sub, _build_bm25(dict(zip(ids, chunks))))
+            _log_write(shard, {"op": "import",
+                               "files": [{"filename": f, "entry": b[0], "n": len(b[1])} for f, b in built.items()]},
+                       b"".join(_add_payload(ids, staged[f][3]) for f, (_, ids, _, _) in built.items()))
+            committed = True
+            nxt = current.derive(chunks=shard.chunks.view())
+            removed = []
+            for filename, (entry, ids, sub, segment) in built.items():
+                prev_chunks = current.files.get(filename)
+                if prev_chunks is not None:
+                    removed.append(prev_chunks.ids)
+                nxt.vectors[filename] = sub
+                nxt.bm25[filename] = segment
+                nxt.files[filename] = nxt.chunks.file_chunks(ids)
+                nxt.manifest[filename] = dict(entry, index=vector_index.describe(sub))
+                shard.dirty.add(filename)
+                _progress.pop((shard.tenant, filename), None)
+            _publish(shard, nxt, np.concatenate(removed) if removed else None)
+            del current
+    except BaseException:
+        # Rows of an import that never committed: tombstone them now
+        # (reconciliation on the next load would, too).
+        if appended and not committed:
+            with shard.lock:
+                for table, ids in appended:
+                    table.remove_ids(ids)
+        raise
+    n_chunks = sum(len(b[1]) for b in built.values())
+    print(f"[RAG-STORE] Imported {len(built)} file(s), {n_chunks} chunk(s) into shard "
+          f"tenant={shard.tenant!r} in {time.monotonic() - import_start:.1f}s (no re-embedding).")
+    return {"files": list(built), "chunks": n_chunks}
 
 
 # ---------------------------------------------------------------------------
@@ -404,22 +1853,133 @@ def _rrf_fuse(rank_lists, k=60):
     return scores
 
 
-def hybrid_search(filenames, query: str, top_k: int = 5):
+def _stored_vectors(version, ids, metas) -> np.ndarray:
+    """(len(ids), dim) stored (L2-normalized) vectors of chunks `ids`, read
+    back from their files' sub-indexes (vector_index.SubIndex.vectors())."""
+    out = np.zeros((len(ids), EMBED_DIM), dtype=np.float32)
+    by_file = {}
+    for row, cid in enumerate(ids):
+        by_file.setdefault(metas[cid]["filename"], []).append(row)
+    for filename, rows in by_file.items():
+        sub = version.vectors.get(filename)
+        if sub is not None:
+            out[rows] = sub.vectors(np.array([ids[r] for r in rows], dtype=np.int64))
+    return out
+
+
+def _mmr(ids, relevance, vectors, k: int, lam: float):
+    """
+    Maximal marginal relevance: greedily picks k of `ids`, each time the
+    one with the best lam * relevance - (1 - lam) * (its highest cosine
+    similarity to the ones already picked). `relevance` is scaled to the
+    best candidate's; the pairwise similarities are one matrix product.
+    """
+    rel = np.asarray(relevance, dtype=np.float64)
+    rel = rel / max(rel.max(), 1e-12)
+    sim = vectors @ vectors.T
+    max_sim = np.zeros(len(ids))
+    gain = lam * rel
+    picked = []
+    for _ in range(min(k, len(ids))):
+        i = int(np.argmax(gain - (1.0 - lam) * max_sim))
+        picked.append(ids[i])
+        gain[i] = -np.inf
+        max_sim = np.maximum(max_sim, sim[i])
+    return picked
+
+
+def _route_documents(version, filenames, q_mat, query_terms, lexical: bool):
+    """
+    First retrieval stage for searches over many files: for each query
+    (rows of q_mat), the ROUTE_TOP_DOCS files whose summary vectors
+    (vector_index.SubIndex.summary()) come closest to it - one matrix
+    product over every file's summaries - plus, when `lexical` (BM25
+    ready), any file holding a query term that at most ROUTE_TOP_DOCS of
+    the files contain, so a rare keyword (a name, an id) still reaches
+    the file it occurs in. A file without a summary yet (loaded from disk,
+    shard still warming up) is routed to every query - summaries are never
+    computed here, in the search path. Returns one set of filenames per
+    query.
+    """
+    summaries = [version.vectors[f].summary(ROUTE_SUMMARY_VECTORS) for f in filenames]
+    unsummarized = {f for f, s in zip(filenames, summaries) if s is None}
+    candidates = [i for i, s in enumerate(summaries) if s is not None and len(s)]
+    if not candidates:
+        return [set(unsummarized) for _ in q_mat]
+    offsets = np.cumsum([0] + [len(summaries[i]) for i in candidates[:-1]])
+    sims = q_mat @ np.concatenate([summaries[i] for i in candidates]).T
+    best = np.maximum.reduceat(sims, offsets, axis=1)       # (queries, files): closest summary vector
+    top = np.argsort(-best, axis=1, kind="stable")[:, :ROUTE_TOP_DOCS]
+    routes = [{filenames[candidates[c]] for c in row} | unsummarized for row in top]
+    if lexical:
+        for route, terms in zip(routes, query_terms):
+            for term in set(terms):
+                holders = [f for f in filenames if f in version.bm25 and version.bm25[f].doc_freq(term)]
+                if len(holders) <= ROUTE_TOP_DOCS:
+                    route.update(holders)
+    return routes
+
+
+def hybrid_search(filenames, query: str, top_k: int = 5, tenant=None, q_vec=None, mmr_lambda=None):
     """
     Returns up to top_k chunks most relevant to `query`, restricted to the
-    given filenames, fusing FAISS embedding search with BM25 keyword
-    search, then deduplicating near-identical results.
+    given filenames in `tenant`'s shard, fusing FAISS embedding search with
+    BM25 keyword search, then deduplicating near-identical results.
+    `q_vec`: the query's embedding (engine.embed_query()), if the caller
+    already has it - build_prompt() embeds once per request.
+    `mmr_lambda`: overrides MMR_LAMBDA for this search.
+
+    Output: list of dicts {text, filename, page, score}, best first (with
+    MMR on: in pick order, so `score` - the fused relevance - need not
+    decrease).
+    """
+    return hybrid_search_many(filenames, [query], top_k, tenant, None if q_vec is None else [q_vec],
+                              mmr_lambda)[0]
 
-    Output: list of dicts {text, filename, page, score}, best first.
+
+def hybrid_search_many(filenames, queries, top_k: int = 5, tenant=None, q_vecs=None, mmr_lambda=None):
     """
-    if not query.strip() or _index.ntotal == 0 or not _metadata:
-        print(f"[RAG-STORE] hybrid_search('{query[:60]}'): index empty "
-              f"(ntotal={_index.ntotal}, metadata={len(_metadata)}) - nothing to search.")
-        return []
+    hybrid_search() for several queries at once - the parts of a
+    multi-part question, a research-style fan-out, an evaluation run.
+    Returns one result list per query, each what hybrid_search() returns
+    for that query alone, but the per-search work is shared: the queries
+    are embedded in one model call (engine.embed_queries), each requested
+    file's sub-index is searched once with the whole query matrix, and
+    each BM25 segment scores every query in one pass
+    (BM25Index.score_many). `q_vecs`: the queries' embeddings, if the
+    caller already has them.
+    """
+    # One version for the whole search, taken without a lock: uploads and
+    # deletes committed meanwhile publish new versions and never touch
+    # this one. Only the caller's shard is involved - other tenants'
+    # documents are neither loaded nor scored.
+    shard, version = _current(tenant)
+    try:
+        return _search_version(shard, version, filenames, list(queries), top_k, tenant, q_vecs, mmr_lambda)
+    finally:
+        # Drop our reference first, so if this was the last search on a
+        # superseded version its deferred tombstones can run right here -
+        # whichever way the search ended (early return, cache hit, error).
+        del version
+        _try_reclaim(shard)
+
+
+def _search_version(shard, version, filenames, queries, top_k, tenant, q_vecs, mmr_lambda):
+    """hybrid_search_many() against one pinned version of `shard`."""
+    mmr_lambda = MMR_LAMBDA if mmr_lambda is None else mmr_lambda
+    pool = top_k * MMR_POOL_FACTOR if mmr_lambda < 1 else top_k
+    results = [[] for _ in queries]
+    label = (f"hybrid_search('{queries[0][:60]}')" if len(queries) == 1
+             else f"hybrid_search_many({len(queries)} queries)")
+
+    todo = [i for i, q in enumerate(queries) if q.strip()]
+    if not todo or not version.vectors:
+        print(f"[RAG-STORE] {label}: index empty or no query "
+              f"(ntotal={version.ntotal()}, files={len(version.vectors)}) - nothing to search.")
+        return results
 
     allowed = set(filenames)
-    files_available = {m["filename"] for m in _metadata.values()}
-    missing = allowed - files_available
+    missing = allowed - version.files.keys()
     if missing:
         # This is the exact symptom of "asked about a file that isn't
         # actually in the index yet" - e.g. background indexing hasn't
@@ -427,126 +1987,210 @@ def hybrid_search(filenames, query: str, top_k: int = 5):
         # it shows up in server logs instead of just as a vague "I don't
         # have that" from the LLM with no trace of why.
         print(f"[RAG-STORE] WARNING: hybrid_search requested file(s) {missing} "
-              f"not present in the index. Indexed files: {sorted(files_available)}. "
-              f"Progress: {_progress.get(next(iter(missing)))}")
-
-    # Over-fetch since FAISS has no native metadata filter here; we filter
-    # by filename after the ANN search. IMPORTANT: this search always runs
-    # against the FULL index (_index.search covers all _index.ntotal
-    # vectors, not just recently-added ones - FAISS has no concept of
-    # "recent"), so results are never limited to only the newest upload.
+              f"not present in the index. Indexed files: {sorted(version.files)}. "
+              f"Progress: {_progress.get((tenant, next(iter(missing))))}")
+
+    # Filename filter is pushed down into the ANN step: only the requested
+    # files' sub-indexes are searched, and their hits merged by score. This
+    # used to search the single global index with a fixed over-fetch and
+    # drop other files' hits afterwards, so a small file sitting next to
+    # large ones could have all of its true hits crowded out of fetch_k
+    # before the filter ever saw them. Merging per-file top-fetch_k lists
+    # gives the best fetch_k over the requested files (exactly, for flat
+    # uncompressed sub-indexes; to within the configured nprobe/efSearch/
+    # compression recall otherwise - scores are always exact cosine), so
+    # results are never limited to only the newest upload.
     #
-    # THREAD SAFETY: _index.search() and reading _bm25/_bm25_ids are done
-    # under the same _lock used by index_document()'s writes. FAISS index
-    # objects aren't safe for concurrent read-while-mutate, and _bm25 /
-    # _bm25_ids are two separate globals swapped together on rebuild - 
-    # reading them one at a time without a lock could observe a stale
-    # _bm25 paired with a just-updated _bm25_ids (or vice versa) if a
-    # concurrent upload's _rebuild_bm25() lands in between. embed_texts()
-    # (CPU-bound but touches no shared index state) stays outside the lock
-    # so it doesn't serialize concurrent searches against each other.
-    q_vec = engine.embed_texts([query]).astype(np.float32)
-    q_vec = q_vec / max(np.linalg.norm(q_vec), 1e-8)
-
-    with _lock:
-        fetch_k = min(max(top_k * 10, 50), _index.ntotal)
-        ann_scores, ann_ids = _index.search(q_vec, fetch_k)
-        emb_ranked = [
-            str(i) for i, score in zip(ann_ids[0], ann_scores[0])
-            if i != -1
-            and score >= MIN_EMBED_SIMILARITY
-            and _metadata.get(str(i), {}).get("filename") in allowed
-        ]
-
-        # --- BM25 search (snapshot taken inside the same lock) ---
-        bm25_ranked = []
-        bm25, bm25_ids = _bm25, _bm25_ids
-    if bm25 is not None:
-        scores = bm25.get_scores(query.lower().split())
-        order = np.argsort(scores)[::-1]
-        for idx in order:
-            if scores[idx] <= 0:
-                # Scores are sorted descending, so once we hit zero (no
-                # lexical term overlap with the query at all) everything
-                # after this is equally irrelevant - stop here.
-                break
-            cid = bm25_ids[idx]
-            if _metadata.get(cid, {}).get("filename") in allowed:
-                bm25_ranked.append(cid)
-            if len(bm25_ranked) >= fetch_k:
-                break
-
-    print(f"[RAG-STORE] hybrid_search('{query[:60]}'): searched full index "
-          f"(ntotal={_index.ntotal}, fetch_k={fetch_k}) restricted to {sorted(allowed)}, "
-          f"min_embed_sim={MIN_EMBED_SIMILARITY} -> "
-          f"{len(emb_ranked)} embedding hit(s), {len(bm25_ranked)} BM25 hit(s) after relevance + filename filter.")
-
-    fused = _rrf_fuse([emb_ranked, bm25_ranked])
-    ordered_ids = sorted(fused.keys(), key=lambda cid: fused[cid], reverse=True)
+    # THREAD SAFETY: nothing below locks. Every object reached through
+    # `version` is immutable once published (FAISS search on an index that
+    # is never written to again is thread-safe; BM25 segments are built
+    # before publication; the chunk view is pinned to rows that only get
+    # tombstoned after the last search holding this version finishes), so
+    # a burst of uploads never makes a chat request wait.
+    terms = {i: tokenize(queries[i]) for i in todo}
+    warm = shard.warm.is_set()
+    cache_keys = {}
+    if warm:
+        stats = bm25_index.corpus_stats(version.bm25.values(), {t for i in todo for t in terms[i]})
+    if warm and _result_cache.max_entries > 0:
+        # (Results from before the shard's warm-up are vector-only, and
+        # are not cached.)
+        file_versions = frozenset((f, version.file_versions.get(f, 0)) for f in allowed)
+        for i in list(todo):
+            key = (tenant, file_versions, " ".join(queries[i].split()), top_k, mmr_lambda,
+                   stats.n_docs, stats.total_len, frozenset((t, stats.df[t]) for t in terms[i]))
+            cached = _result_cache.get(key)
+            if cached is None:
+                cache_keys[i] = key
+            else:
+                results[i] = [dict(r) for r in cached]
+                todo.remove(i)
+                print(f"[RAG-STORE] hybrid_search('{queries[i][:60]}'): {len(cached)} result(s) "
+                      f"from the result cache.")
+        if not todo:
+            return results
+
+    # Cached/batched with other requests' query embeddings (engine.embed_queries).
+    if q_vecs is None:
+        q_mat = engine.embed_queries([queries[i] for i in todo])
+    else:
+        q_mat = np.stack([np.asarray(q_vecs[i], dtype=np.float32).reshape(-1) for i in todo])
+    q_mat = np.asarray(q_mat, dtype=np.float32)
+    q_mat = np.ascontiguousarray(q_mat / np.maximum(np.linalg.norm(q_mat, axis=1, keepdims=True), 1e-8))
+
+    # --- document routing (searches over many files only) ---
+    # Each query keeps only its most relevant files (_route_documents());
+    # `rows[f]` are the queries that search file f.
+    searched = sorted(f for f in allowed if f in version.vectors)
+    n_requested = len(searched)
+    routes = None
+    if ROUTE_TOP_DOCS > 0 and len(searched) > max(ROUTE_MIN_DOCS, ROUTE_TOP_DOCS):
+        routes = _route_documents(version, searched, q_mat, [terms[i] for i in todo], warm)
+        searched = sorted(set().union(*routes))
+    rows = {f: [j for j in range(len(todo)) if routes is None or f in routes[j]] for f in searched}
+
+    n_candidates = sum(version.vectors[f].ntotal for f in searched)
+    fetch_k = min(max(top_k * 10, 50), n_candidates)
+    ann_hits = [[] for _ in todo]
+    for f in searched:
+        ix = version.vectors[f]
+        ann_scores, ann_ids = ix.search(q_mat[rows[f]], min(fetch_k, ix.ntotal))
+        for j, ids, scores in zip(rows[f], ann_ids, ann_scores):
+            ann_hits[j].extend((float(score), int(i)) for i, score in zip(ids, scores)
+                               if i != -1 and score >= MIN_EMBED_SIMILARITY)
+    emb_ranked = []
+    for hits in ann_hits:
+        hits.sort(key=lambda hit: hit[0], reverse=True)
+        emb_ranked.append([i for _score, i in hits[:fetch_k]])
+
+    # --- BM25 search ---
+    # Only the requested files' segments are scored, and only the query
+    # terms' posting lists in them, so every id that comes back already
+    # has score > 0 (some lexical overlap with the query) - the relevance
+    # floor is implicit, and no filename filter is needed. IDF/avgdl are
+    # taken over every file (corpus_stats), same as a single index.
+    # Until the shard's warm-up has built its segments (just after a cold
+    # start) this is skipped and the search is vector-only.
+    total = version.ntotal()
+    bm25_ranked = [[] for _ in todo]
+    if warm:
+        scored = []
+        for f in searched:
+            if f in version.bm25:
+                ids, scores = version.bm25[f].score_many([terms[todo[j]] for j in rows[f]], stats=stats)
+                if len(rows[f]) < len(todo):
+                    scores_all = np.zeros((len(ids), len(todo)))
+                    scores_all[:, rows[f]] = scores
+                    scores = scores_all
+                scored.append((ids, scores))
+        if scored:
+            cand = np.concatenate([ids for ids, _scores in scored])
+            vals = np.concatenate([scores for _ids, scores in scored])
+            for j in range(len(todo)):
+                hit = np.flatnonzero(vals[:, j] > 0)
+                best = hit[np.argsort(-vals[hit, j], kind="stable")[:fetch_k]]
+                bm25_ranked[j] = [int(cid) for cid in cand[best]]
+
+    fused = [_rrf_fuse([emb, bm25]) for emb, bm25 in zip(emb_ranked, bm25_ranked)]
+    ordered_ids = [sorted(scores.keys(), key=lambda cid: scores[cid], reverse=True) for scores in fused]
+    # Fetch only the rows that can make it into the results.
+    metas = version.chunks.get_many(sorted({cid for ids in ordered_ids for cid in ids[:max(pool * 4, 50)]}))
 
     # --- dedupe near-identical chunks among the fused results ---
-    results = []
-    seen_hashes = set()
-    for cid in ordered_ids:
-        meta = _metadata.get(cid)
-        if not meta:
-            continue
-        h = _norm_text_hash(meta["text"])
-        if h in seen_hashes:
-            continue
-        seen_hashes.add(h)
-        results.append({
-            "text": meta["text"],
-            "filename": meta["filename"],
-            "page": meta["page"],
-            "score": fused[cid],
-        })
-        if len(results) >= top_k:
-            break
+    picked = []
+    for j in range(len(todo)):
+        seen_hashes = set()
+        cids = []
+        for cid in ordered_ids[j]:
+            meta = metas.get(cid)
+            if not meta:
+                continue
+            h = meta["hash"] or _norm_text_hash(meta["text"])
+            if h in seen_hashes:
+                continue
+            seen_hashes.add(h)
+            cids.append(cid)
+            if len(cids) >= pool:
+                break
+        if len(cids) > top_k:
+            cids = _mmr(cids, [fused[j][cid] for cid in cids], _stored_vectors(version, cids, metas),
+                        top_k, mmr_lambda)
+        picked.append(cids)
+
+    print(f"[RAG-STORE] {label}: searched {n_candidates} vector(s) in "
+          f"{len(searched)} file sub-index(es) (of {total} in the shard, fetch_k={fetch_k}) "
+          f"{f'routed from {n_requested} requested file(s), ' if routes is not None else ''}"
+          f"restricted to {sorted(allowed)}, "
+          f"min_embed_sim={MIN_EMBED_SIMILARITY} -> "
+          f"{sum(map(len, emb_ranked))} embedding hit(s), {sum(map(len, bm25_ranked))} BM25 hit(s) "
+          f"after relevance + filename filter"
+          f"{'' if warm else ' (shard still warming up - vector-only)'}"
+          f"{f', MMR lambda={mmr_lambda} over up to {pool} candidate(s)' if pool > top_k else ''}.")
+
+    for j, i in enumerate(todo):
+        results[i] = [{
+            "text": metas[cid]["text"],
+            "filename": metas[cid]["filename"],
+            "page": metas[cid]["page"],
+            "score": fused[j][cid],
+        } for cid in picked[j]]
+
+        debug_n = min(10 if len(queries) == 1 else 3, len(results[i]))
+        print(f"[RAG-STORE] hybrid_search('{queries[i][:60]}'): top {debug_n} of {len(results[i])} returned chunk(s):")
+        for n, r in enumerate(results[i][:debug_n], start=1):
+            print(f"    #{n}  file={r['filename']}  page={r['page']}  score={r['score']:.4f}  "
+                  f"text={r['text'][:80]!r}...")
+
+        if i in cache_keys:
+            _result_cache.put(cache_keys[i], [dict(r) for r in results[i]])
+    return results
 
-    debug_n = min(10, len(results))
-    print(f"[RAG-STORE] hybrid_search('{query[:60]}'): top {debug_n} of {len(results)} returned chunk(s):")
-    for i, r in enumerate(results[:debug_n], start=1):
-        print(f"    #{i}  file={r['filename']}  page={r['page']}  score={r['score']:.4f}  "
-              f"text={r['text'][:80]!r}...")
 
-    return results
+def result_cache_stats() -> dict:
+    """Hit/miss counters and size of the hybrid_search result cache."""
+    return _result_cache.stats()
 
 
-def get_chunks_by_page(filename: str, page_num: int):
+def get_chunks_by_page(filename: str, page_num: int, tenant=None):
     """
     Direct metadata lookup for 'what's on page N' style queries. These
     fail (or return unrelated content) under embedding/BM25 search
     because the literal page number rarely appears meaningfully inside
     the chunk text itself - this bypasses semantic search entirely and
-    just filters the store by (filename, page).
+    goes straight to the file's (page -> chunk ids) index.
     """
-    return [
-        {"text": m["text"], "filename": m["filename"], "page": m["page"]}
-        for m in _metadata.values()
-        if m["filename"] == filename and m["page"] == page_num
-    ]
+    version = _current(tenant)[1]
+    file_chunks = version.files.get(filename)
+    if file_chunks is None:
+        return []
+    ids = file_chunks.ids_for_page(page_num)
+    metas = version.chunks.get_many(ids)
+    return [{"text": metas[int(cid)]["text"], "filename": filename, "page": metas[int(cid)]["page"]}
+            for cid in ids if int(cid) in metas]
 
 
-def get_page_range(filename: str):
+def get_page_range(filename: str, tenant=None):
     """Returns (min_page, max_page) indexed for a file, or (None, None) if
     the file has no page-numbered chunks (e.g. non-paginated formats)."""
-    pages = [m["page"] for m in _metadata.values() if m["filename"] == filename and m["page"] is not None]
-    return (min(pages), max(pages)) if pages else (None, None)
+    file_chunks = _current(tenant)[1].files.get(filename)
+    return file_chunks.page_range if file_chunks is not None else (None, None)
 
 
-def sample_document_chunks(filename: str, max_chunks: int = 12):
+def sample_document_chunks(filename: str, max_chunks: int = 12, tenant=None):
     """Evenly-spaced sample of a document's chunks across its full length,
     used for summary/overview requests on large documents instead of
     blindly truncating to the first N characters (which misses everything
     past the cut-off in a 300-500 page PDF)."""
-    ids = [cid for cid, m in _metadata.items() if m["filename"] == filename]
-    if not ids:
+    version = _current(tenant)[1]
+    file_chunks = version.files.get(filename)
+    if file_chunks is None or not len(file_chunks):
         return []
-    ids.sort(key=lambda cid: int(cid))  # chunk ids were assigned in document order
+    ids = file_chunks.ids  # document order (FileChunks), not id order
     if len(ids) <= max_chunks:
         picked = ids
     else:
         step = len(ids) / max_chunks
         picked = [ids[int(i * step)] for i in range(max_chunks)]
-    return [{"text": _metadata[cid]["text"], "filename": filename, "page": _metadata[cid]["page"]} for cid in picked]
\ No newline at end of file
+    metas = version.chunks.get_many(picked)
+    return [{"text": metas[int(cid)]["text"], "filename": filename, "page": metas[int(cid)]["page"]}
+            for cid in picked]
@@ -0,0 +1,115 @@
+"""
+rag_versions.py
+===============
+Immutable, versioned views of rag_store's index state.
+
+hybrid_search() used to take the same lock as index_document() and
+remove_document(), so while an upload was being committed every chat
+request waited behind it. Readers now never lock:
+
+- A StoreVersion bundles everything a search reads - the per-file FAISS
+  sub-indexes, the per-file BM25 segments, the manifest, the per-file
+  secondary indexes (chunk_table.FileChunks) and a ChunkView of the chunk
+  table - and is never mutated once published.
+- Writers (still serialized among themselves by rag_store's lock) build
+  the next version with derive(): shallow copies of the per-file dicts,
+  in which only the changed file's entries are replaced, so publishing
+  costs O(files), not O(corpus) - then publish() swaps
+  VersionChain.current, a single attribute assignment (atomic under the
+  GIL). A reader does `v = chain.current` once and uses `v` throughout,
+  so it sees one consistent version even if several are published
+  meanwhile.
+- Some cleanup can't happen while an older version may still be read
+  (rag_store's chunk-table tombstones are written in place, and are
+  visible through every view). publish() takes an on_reclaim callback for
+  that; it becomes runnable once the version being replaced AND every
+  version before it are unreferenced - i.e. when their last reader
+  finishes - and rag_store runs it from a writer via run_reclaimed().
+
+Each version also carries a per-file version number (file_versions):
+publish() gives a file a new, never reused number whenever the version
+being published changed anything of it (sub-index, BM25 segment or chunk
+set). Caches of per-file results key on it (rag_store's hybrid_search
+result cache) and so never need expiring.
+
+Reclamation rides on CPython reference counting: each version owns a
+small token, each token keeps its successor's token alive, and the
+callback is attached to the token with weakref.finalize. A token can only
+be collected once its own version and all older tokens are gone.
+"""
+
+import collections
+import itertools
+import weakref
+
+
+class _Token:
+    __slots__ = ("next", "__weakref__")
+
+    def __init__(self):
+        self.next = None
+
+
+class StoreVersion:
+    _numbers = itertools.count()
+    _file_numbers = itertools.count(1)   # global, so numbers survive a shard being evicted and reloaded
+
+    def __init__(self, vectors=None, bm25=None, manifest=None, files=None, chunks=None):
+        self.number = next(StoreVersion._numbers)
+        self.vectors = vectors if vectors is not None else {}     # {filename: vector_index.SubIndex}
+        self.bm25 = bm25 if bm25 is not None else {}              # {filename: bm25_index.BM25Index}
+        self.manifest = manifest if manifest is not None else {}  # {filename: {"hash", "num_chunks", "index"}}
+        self.files = files if files is not None else {}           # {filename: chunk_table.FileChunks}
+        self.chunks = chunks                                      # chunk_table.ChunkView
+        self.file_versions = {}                                   # {filename: int}, set by publish()
+        self._token = _Token()
+
+    def derive(self, chunks=None) -> "StoreVersion":
+        """An unpublished copy for a writer to modify (per-file entries are
+        shared, the dicts holding them are not)."""
+        return StoreVersion(dict(self.vectors), dict(self.bm25), dict(self.manifest), dict(self.files),
+                            self.chunks if chunks is None else chunks)
+
+    def _number_files(self, previous):
+        """Keeps `previous`'s number for each file whose entries are the
+        same objects, gives the others a new one."""
+        numbers = {}
+        for filename in self.files.keys() | self.vectors.keys():
+            if previous is not None and filename in previous.file_versions and all(
+                    d.get(filename) is p.get(filename) for d, p in ((self.vectors, previous.vectors),
+                                                                    (self.bm25, previous.bm25),
+                                                                    (self.files, previous.files))):
+                numbers[filename] = previous.file_versions[filename]
+            else:
+                numbers[filename] = next(StoreVersion._file_numbers)
+        self.file_versions = numbers
+
+    def ntotal(self) -> int:
+        return sum(ix.ntotal for ix in self.vectors.values())
+
+
+class VersionChain:
+    def __init__(self, initial: StoreVersion):
+        initial._number_files(None)
+        self.current = initial
+        self._reclaimed = collections.deque()   # callbacks whose versions are gone
+
+    def publish(self, new: StoreVersion, on_reclaim=None):
+        """Makes `new` the version readers see. Callers serialize publish()."""
+        old = self.current
+        new._number_files(old)
+        old._token.next = new._token
+        if on_reclaim is not None:
+            # deque.append is atomic, so whichever thread drops the last
+            # reference (often a reader) only queues the callback.
+            weakref.finalize(old._token, self._reclaimed.append, on_reclaim)
+        self.current = new
+
+    def run_reclaimed(self) -> int:
+        """Runs the callbacks of versions no reader holds any more. Called
+        by a writer (under its lock). Returns how many ran."""
+        ran = 0
+        while self._reclaimed:
+            self._reclaimed.popleft()()
+            ran += 1
+        return ran
@@ -0,0 +1,146 @@
+"""
+rag_wal.py
+==========
+Append-only write-ahead log for rag_store.
+
+rag_store used to persist every upload/delete by rewriting its on-disk
+files while holding its lock, so a write cost O(what was rewritten) and a
+crash in the middle could leave files that no longer agreed with each
+other. Now every change is first appended here as one self-contained
+record and fsync-ed (the commit point - O(size of the change)), the
+in-memory index applies it immediately, and a background compactor
+periodically writes a fresh snapshot and drops the log records that
+snapshot covers.
+
+On-disk format: a sequence of frames
+
+    magic "RWAL" | u32 header_len | u64 payload_len | u32 crc32 | header | payload
+
+where header is a UTF-8 JSON object (the record) and payload is raw bytes
+(e.g. ids + vectors). A torn or corrupt frame (crash mid-append) fails the
+length/CRC check; replay stops there and the active log is truncated back
+to the last good frame, so a crash can lose at most the one uncommitted
+change - never corrupt earlier ones.
+
+Compaction never truncates the log in place (that would race with
+appends): rotate() renames the active log aside and starts a new one, the
+caller snapshots the state as of that moment, and discard() deletes the
+rotated logs once the snapshot is durable. Replay reads rotated logs
+(oldest first) before the active one, so a crash mid-snapshot just
+replays a little more.
+
+Not thread-safe on its own: rag_store appends/rotates under its lock.
+"""
+
+import json
+import os
+import struct
+import time
+import zlib
+
+_FRAME = struct.Struct("<4sIQI")
+_MAGIC = b"RWAL"
+
+
+def _fsync_dir(directory: str):
+    # Makes renames/creations in `directory` durable (no-op where
+    # directories can't be opened, e.g. Windows).
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def atomic_write(path: str, data: bytes):
+    """Write-to-temp + fsync + rename, so readers (and crash recovery) only
+    ever see the old or the new contents of `path`, never a partial file."""
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    _fsync_dir(os.path.dirname(path) or ".")
+
+
+class WriteAheadLog:
+    def __init__(self, directory: str, name: str = "wal.log"):
+        self.dir = directory
+        self.path = os.path.join(directory, name)
+        os.makedirs(directory, exist_ok=True)
+        self._f = open(self.path, "ab")
+
+    def append(self, record: dict, payload: bytes = b""):
+        """Appends one record and fsyncs - returns once it's durable."""
+        header = json.dumps(record, separators=(",", ":")).encode("utf-8")
+        crc = zlib.crc32(payload, zlib.crc32(header))
+        self._f.write(_FRAME.pack(_MAGIC, len(header), len(payload), crc) + header + payload)
+        self._f.flush()
+        os.fsync(self._f.fileno())
+
+    def close(self):
+        self._f.close()
+
+    def size(self) -> int:
+        return self._f.tell()
+
+    def _rotated(self):
+        prefix = os.path.basename(self.path) + "."
+        names = [n for n in os.listdir(self.dir) if n.startswith(prefix) and n[len(prefix):].isdigit()]
+        return [os.path.join(self.dir, n) for n in sorted(names, key=lambda n: int(n[len(prefix):]))]
+
+    def rotate(self):
+        """Moves the active log aside (if it has records) and starts a fresh
+        one for subsequent appends. Returns every rotated log on disk - what
+        a snapshot of the current state covers, to discard() once it's
+        durable (includes logs left rotated by an earlier failed/crashed
+        snapshot)."""
+        if self.size():
+            self._f.close()
+            os.replace(self.path, f"{self.path}.{time.time_ns()}")
+            self._f = open(self.path, "ab")
+            _fsync_dir(self.dir)
+        return self._rotated()
+
+    def discard(self, rotated_paths):
+        for path in rotated_paths:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def pending_bytes(self) -> int:
+        """Log bytes not yet covered by a snapshot (rotated + active)."""
+        return sum(os.path.getsize(p) for p in self._rotated()) + self.size()
+
+    def replay(self):
+        """Yields (record, payload) for every committed record, oldest
+        first. Truncates a torn tail off the active log."""
+        for path in self._rotated() + [self.path]:
+            good_end = 0
+            with open(path, "rb") as f:
+                data = f.read()
+            pos = 0
+            while pos + _FRAME.size <= len(data):
+                magic, header_len, payload_len, crc = _FRAME.unpack_from(data, pos)
+                start = pos + _FRAME.size
+                end = start + header_len + payload_len
+                if magic != _MAGIC or end > len(data):
+                    break
+                header = data[start:start + header_len]
+                payload = data[start + header_len:end]
+                if zlib.crc32(payload, zlib.crc32(header)) != crc:
+                    break
+                yield json.loads(header.decode("utf-8")), payload
+                pos = good_end = end
+            if path == self.path and good_end != len(data):
+                print(f"[RAG-WAL] Dropping {len(data) - good_end} byte(s) of torn/corrupt "
+                      f"log tail in {path} (crash mid-append).")
+                self._f.close()
+                with open(path, "r+b") as f:
+                    f.truncate(good_end)
+                    f.flush()
+                    os.fsync(f.fileno())
+                self._f = open(self.path, "ab")
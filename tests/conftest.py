@@ -0,0 +1,86 @@
+"""
+Shared fixtures for the rag_store tests.
+
+rag_store reads its settings and opens its index directory at import time,
+and what most of these tests check is what survives a process exiting
+(with or without a flush), so every scenario runs in a fresh Python
+process: the `store` fixture's run() executes a snippet there against the
+test's own RAG_INDEX_DIR, with the embedding model replaced by
+store_child.py's deterministic stub, and returns what the snippet
+report()ed. The pure modules (rag_versions, rag_shards) are tested
+in-process.
+"""
+
+import json
+import os
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULT_MARKER = "@@RESULT@@ "
+
+# The in-process tests import the repo's top-level modules.
+sys.path.insert(0, REPO_DIR)
+
+# Small, deterministic stores: no background snapshots (a test decides
+# when to flush), no embedding cache (so re-embedding counts only reflect
+# diffing and checkpoints), one bulk batch at a time.
+BASE_ENV = {
+    "RAG_SNAPSHOT_INTERVAL_SECONDS": "3600",
+    "RAG_EMBED_CACHE_MAX_ENTRIES": "0",
+    "RAG_EMBED_PARALLEL_BATCHES": "1",
+    "RAG_EMBED_MAX_BATCH": "16",
+    "RAG_RESULT_CACHE_MB": "0",
+    "PYTHONHASHSEED": "0",
+}
+
+PRELUDE = """\
+import os, sys, time
+import store_child
+from store_child import report, crash, wait_for
+store_child.install()
+import rag_store as rs
+"""
+
+
+class StoreProcess:
+    def __init__(self, directory):
+        self.dir = directory
+        self.index_dir = os.path.join(directory, "rag_index")
+
+    def run(self, code: str, setup: str = "", expect_exit: int = 0, **env):
+        """Runs `setup` + `code` (after PRELUDE) in a new interpreter, with
+        `env` added to its environment; returns the value it passed to
+        report() (None if it didn't)."""
+        proc_env = dict(os.environ, **BASE_ENV)
+        proc_env.update((key, str(value)) for key, value in env.items())
+        proc_env["RAG_INDEX_DIR"] = self.index_dir
+        proc_env["PYTHONPATH"] = os.pathsep.join([TESTS_DIR, REPO_DIR, proc_env.get("PYTHONPATH", "")])
+        source = PRELUDE + textwrap.dedent(setup) + textwrap.dedent(code)
+        proc = subprocess.run([sys.executable, "-c", source], cwd=self.dir, env=proc_env,
+                              capture_output=True, text=True, timeout=300)
+        if proc.returncode != expect_exit:
+            pytest.fail(f"child exited with {proc.returncode} (expected {expect_exit}):\n"
+                        f"{proc.stdout[-4000:]}\n{proc.stderr[-4000:]}")
+        results = [line[len(RESULT_MARKER):] for line in proc.stdout.splitlines()
+                   if line.startswith(RESULT_MARKER)]
+        return json.loads(results[-1]) if results else None
+
+    def checkpoint_dirs(self):
+        tenants = os.path.join(self.index_dir, "tenants")
+        found = []
+        for root in [self.index_dir] + ([os.path.join(tenants, t) for t in os.listdir(tenants)]
+                                        if os.path.isdir(tenants) else []):
+            directory = os.path.join(root, "checkpoints")
+            if os.path.isdir(directory):
+                found += [os.path.join(directory, name) for name in os.listdir(directory)]
+        return found
+
+
+@pytest.fixture
+def store(tmp_path):
+    return StoreProcess(str(tmp_path))
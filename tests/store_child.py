@@ -0,0 +1,101 @@
+"""
+Imported by the child processes conftest.StoreProcess runs: replaces the
+embedding model with a deterministic stub and gives the test snippets a
+few helpers.
+
+The stub is a hashed bag of words (each word adds +-1 at a position given
+by its hash, then the row is L2-normalized), so texts sharing words score
+higher and every test can recompute the exact vector a chunk must have.
+It counts the rows it embeds, and can be told to fail (FAIL_AT) or to
+kill the process (EXIT_AT) on its Nth call.
+"""
+
+import hashlib
+import json
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+import engine
+
+ROWS = [0]
+CALLS = [0]
+FAIL_AT = None
+EXIT_AT = None
+
+
+def stub_vectors(texts) -> np.ndarray:
+    out = np.zeros((len(texts), engine.EMBED_DIM), dtype=np.float32)
+    for row, text in enumerate(texts):
+        for word in text.lower().split():
+            h = int.from_bytes(hashlib.md5(word.encode("utf-8")).digest()[:8], "little")
+            out[row, h % engine.EMBED_DIM] += 1.0 if (h >> 32) & 1 else -1.0
+        if not out[row].any():
+            out[row, 0] = 1.0
+    return out / np.linalg.norm(out, axis=1, keepdims=True)
+
+
+def _embed_texts(texts, lane="interactive", concurrent=False):
+    CALLS[0] += 1
+    if CALLS[0] == FAIL_AT:
+        raise RuntimeError("stub embedder failure")
+    if CALLS[0] == EXIT_AT:
+        sys.stdout.flush()
+        os._exit(3)
+    ROWS[0] += len(texts)
+    return stub_vectors(list(texts))
+
+
+def install():
+    # engine.embed_query/embed_queries look embed_texts up at call time.
+    engine.embed_texts = _embed_texts
+
+
+def document(seed: int, paragraphs: int = 12, words_per_paragraph: int = 90) -> str:
+    """A plain-text document: paragraphs of words drawn mostly from the
+    document's own vocabulary, so each document has its own topic."""
+    rng = random.Random(seed)
+    own = [f"d{seed}w{i}" for i in range(60)]
+    shared = [f"common{i}" for i in range(40)]
+    return "\n\n".join(" ".join(rng.choice(own) if rng.random() < 0.8 else rng.choice(shared)
+                                for _ in range(words_per_paragraph))
+                       for _ in range(paragraphs))
+
+
+def vectors_match(rs, tenant) -> bool:
+    """Every stored vector is the stub's embedding of its chunk's text, and
+    each file's sub-index and chunk list hold the same ids."""
+    version = rs._current(tenant)[1]
+    for filename, sub in version.vectors.items():
+        ids = sub.ids()
+        if sorted(ids.tolist()) != sorted(version.files[filename].ids.tolist()):
+            return False
+        metas = version.chunks.get_many(ids)
+        if len(metas) != len(ids):
+            return False
+        expected = stub_vectors([metas[int(cid)]["text"] for cid in ids])
+        if not np.allclose(sub.vectors(), expected, atol=1e-5):
+            return False
+    return True
+
+
+def wait_for(predicate, timeout: float = 60.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            raise TimeoutError("condition not reached")
+        time.sleep(0.05)
+
+
+def report(value):
+    print("@@RESULT@@ " + json.dumps(value), flush=True)
+
+
+def crash():
+    """Exits without flushing anything rag_store buffers - what a killed
+    server process leaves behind."""
+    sys.stdout.flush()
+    os._exit(0)
@@ -0,0 +1,80 @@
+"""Resumable indexing (rag_checkpoint.py): an upload whose indexing failed or
+was cut short by a crash resumes from its checkpoint instead of starting
+over."""
+
+SETUP = """
+T = 1
+raw = store_child.document(1, paragraphs=120).encode()
+
+def indexed():
+    version = rs._current(T)[1]
+    return {
+        "status": rs.get_progress("big.txt", tenant=T).get("status"),
+        "chunks": len(version.files["big.txt"]) if "big.txt" in version.files else 0,
+        "vectors_ok": store_child.vectors_match(rs, T),
+        "rows_embedded": store_child.ROWS[0],
+    }
+"""
+
+
+def test_failed_upload_resumes_from_checkpoint(store):
+    out = store.run(setup=SETUP, code="""
+    store_child.FAIL_AT = 4
+    rs.index_document("big.txt", raw, tenant=T)
+    failed = rs.get_progress("big.txt", tenant=T)["status"]
+    first_rows = store_child.ROWS[0]
+    store_child.ROWS[0] = 0
+    rs.index_document("big.txt", raw, tenant=T)
+    report(dict(indexed(), failed=failed, first_rows=first_rows))
+    """, RAG_CHECKPOINT_MIN_KB=0)
+    assert out["failed"] == "error"
+    assert out["status"] == "done"
+    assert out["vectors_ok"]
+    # The three batches embedded before the failure came from the checkpoint.
+    assert out["first_rows"] > 0
+    assert out["rows_embedded"] == out["chunks"] - out["first_rows"]
+    assert store.checkpoint_dirs() == []
+
+
+def test_crashed_upload_resumes_on_restart(store):
+    store.run(setup=SETUP, code="""
+    store_child.EXIT_AT = 4
+    rs.index_document("big.txt", raw, tenant=T)
+    """, expect_exit=3, RAG_CHECKPOINT_MIN_KB=0)
+    assert len(store.checkpoint_dirs()) == 1
+
+    out = store.run(setup=SETUP, code="""
+    resumed = rs.resume_checkpoints()
+    wait_for(lambda: rs.get_progress("big.txt", tenant=T).get("status") in ("done", "error"))
+    report(dict(indexed(), resumed=resumed))
+    """, RAG_CHECKPOINT_MIN_KB=0)
+    assert out["resumed"] == 1
+    assert out["status"] == "done"
+    assert out["vectors_ok"]
+    assert 0 < out["rows_embedded"] < out["chunks"]
+    assert store.checkpoint_dirs() == []
+
+
+def test_checkpoint_given_up_after_max_attempts(store):
+    for _ in range(2):
+        store.run(setup=SETUP, code="""
+        store_child.EXIT_AT = 2
+        if not rs.resume_checkpoints():
+            rs.index_document("big.txt", raw, tenant=T)
+        wait_for(lambda: False)
+        """, expect_exit=3, RAG_CHECKPOINT_MIN_KB=0, RAG_CHECKPOINT_MAX_ATTEMPTS=2)
+    assert len(store.checkpoint_dirs()) == 1
+    out = store.run(setup=SETUP, code="report(rs.resume_checkpoints())",
+                    RAG_CHECKPOINT_MIN_KB=0, RAG_CHECKPOINT_MAX_ATTEMPTS=2)
+    assert out == 0
+    assert store.checkpoint_dirs() == []
+
+
+def test_small_uploads_are_not_checkpointed(store):
+    out = store.run(setup=SETUP, code="""
+    store_child.FAIL_AT = 2
+    rs.index_document("big.txt", raw, tenant=T)
+    report(rs.get_progress("big.txt", tenant=T)["status"])
+    """, RAG_CHECKPOINT_MIN_KB=1024)
+    assert out == "error"
+    assert store.checkpoint_dirs() == []
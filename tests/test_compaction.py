@@ -0,0 +1,100 @@
+"""Compaction of a shard into a new generation directory (rag_store._compact,
+root/CURRENT), searches against it and a restart from it."""
+
+import json
+import os
+
+STATE = """
+T = 1
+queries = ["d1w3 d1w7 common2", "d3w10 d3w11", "d5w1 d5w2", "d77w5 d77w6", "d7w4 common9"]
+
+def state():
+    shard, version = rs._current(T)
+    shard.warm.wait(30)
+    files = sorted(rs.list_indexed(T))
+    return {
+        "files": files,
+        "chunks": {f: len(version.files[f]) for f in files},
+        "ntotal": version.ntotal(),
+        "results": [[(r["filename"], r["page"], r["text"]) for r in rs.hybrid_search(files, q, 5, tenant=T)]
+                    for q in queries],
+        "pages": {f: rs.get_page_range(f, tenant=T) for f in files},
+    }
+"""
+
+
+def test_compaction_then_search_then_restart(store):
+    before, compacted = store.run(setup=STATE, code="""
+    for n in range(1, 7):
+        rs.index_document(f"f{n}.txt", store_child.document(n).encode(), tenant=T)
+    rs.flush()
+    rs.remove_document("f2.txt", tenant=T)
+    rs.remove_document("f4.txt", tenant=T)
+    f5 = store_child.document(5).split("\\n\\n")
+    f5[3] = store_child.document(77, paragraphs=1)
+    rs.index_document("f5.txt", "\\n\\n".join(f5).encode(), tenant=T)
+    before = state()
+    shard = rs._current(T)[0]
+    rows_before = len(shard.chunks._rows)
+    rs.compact(T)
+    wait_for(lambda: rs.get_compaction_progress(T)["status"] in ("done", "error"))
+    after = state()
+    report([before, dict(after, progress=rs.get_compaction_progress(T)["status"], generation=shard.generation,
+                         rows_before=rows_before, rows_after=len(shard.chunks._rows),
+                         max_id=int(shard.chunks._rows["id"].max()),
+                         vectors_ok=store_child.vectors_match(rs, T))])
+    # Written to the new generation's log only.
+    rs.index_document("f7.txt", store_child.document(7).encode(), tenant=T)
+    crash()
+    """)
+    assert compacted["progress"] == "done"
+    assert compacted["generation"] == 1
+    assert compacted["vectors_ok"]
+    # Dead rows (removed files, the replaced chunks of f5) are gone and ids
+    # are dense again.
+    assert compacted["rows_after"] == compacted["ntotal"] < compacted["rows_before"]
+    assert compacted["max_id"] == compacted["ntotal"] - 1
+    for key in ("files", "chunks", "ntotal", "results", "pages"):
+        assert compacted[key] == before[key], key
+
+    after = store.run(setup=STATE, code="""
+    shard = rs._current(T)[0]
+    report(dict(state(), generation=shard.generation, root=shard.root,
+                vectors_ok=store_child.vectors_match(rs, T)))
+    """)
+    assert after["generation"] == 1
+    assert after["vectors_ok"]
+    assert after["files"] == ["f1.txt", "f3.txt", "f5.txt", "f6.txt", "f7.txt"]
+    for filename in compacted["files"]:
+        assert after["chunks"][filename] == compacted["chunks"][filename]
+    assert after["results"][:4] == compacted["results"][:4]
+    assert "f7.txt" in {filename for filename, _, _ in after["results"][4]}
+    with open(os.path.join(after["root"], "CURRENT"), encoding="utf-8") as f:
+        assert json.load(f) == {"generation": 1}
+    # The old generation's files were discarded.
+    assert not os.path.exists(os.path.join(after["root"], "manifest.json"))
+    assert sorted(name for name in os.listdir(after["root"]) if name.startswith("gen-")) == ["gen-1"]
+
+
+def test_second_compaction_and_restart(store):
+    first = store.run(setup=STATE, code="""
+    for n in range(1, 5):
+        rs.index_document(f"f{n}.txt", store_child.document(n).encode(), tenant=T)
+    for generation in (1, 2):
+        rs.remove_document(f"f{generation}.txt", tenant=T)
+        rs.compact(T)
+        wait_for(lambda: rs.get_compaction_progress(T)["status"] in ("done", "error"))
+    report(dict(state(), generation=rs._current(T)[0].generation))
+    crash()
+    """)
+    assert first["generation"] == 2
+    after = store.run(setup=STATE, code="""
+    shard = rs._current(T)[0]
+    report(dict(state(), generation=shard.generation, root=shard.root,
+                vectors_ok=store_child.vectors_match(rs, T)))
+    """)
+    assert after["generation"] == 2
+    assert after["vectors_ok"]
+    for key in ("files", "chunks", "ntotal", "results"):
+        assert after[key] == first[key], key
+    assert sorted(name for name in os.listdir(after["root"]) if name.startswith("gen-")) == ["gen-2"]
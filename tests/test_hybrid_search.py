@@ -0,0 +1,53 @@
+"""hybrid_search_many() against one-query hybrid_search() calls."""
+
+SETUP = """
+T = 1
+files = [f"f{n}.txt" for n in range(16)]
+for n, filename in enumerate(files):
+    rs.index_document(filename, store_child.document(n, paragraphs=6).encode(), tenant=T)
+rs._current(T)[0].warm.wait(30)
+queries = [f"d{n}w{n} d{n}w{n + 1} common{n}" for n in range(16)]
+queries += ["", "   ", "common1 common2 common3", "d3w1", "nothing-matches-this", "d2w5 d9w5 d14w5"]
+
+def many_vs_single(filenames, **kwargs):
+    many = rs.hybrid_search_many(filenames, queries, 5, tenant=T, **kwargs)
+    single = [rs.hybrid_search(filenames, q, 5, tenant=T, **kwargs) for q in queries]
+    return many, single
+"""
+
+
+def test_many_matches_single_queries(store):
+    out = store.run(setup=SETUP, code="""
+    runs = {
+        "routed": many_vs_single(files),                      # > ROUTE_MIN_DOCS files
+        "few_files": many_vs_single(files[:3] + ["missing.txt"]),
+        "mmr": many_vs_single(files, mmr_lambda=0.5),
+    }
+    report({name: [many == single, [len(r) for r in many]] for name, (many, single) in runs.items()})
+    """)
+    for name, (same, lengths) in out.items():
+        assert same, name
+        assert lengths[16] == lengths[17] == 0, name          # blank queries
+        assert all(lengths[:16]), name
+
+
+def test_many_matches_single_queries_from_the_result_cache(store):
+    out = store.run(setup=SETUP, code="""
+    first = rs.hybrid_search_many(files, queries, 5, tenant=T)
+    hits = rs.result_cache_stats()["hits"]
+    many, single = many_vs_single(files)
+    report([first == many == single, rs.result_cache_stats()["hits"] - hits])
+    """, RAG_RESULT_CACHE_MB=16)
+    same, hits = out
+    assert same
+    assert hits > 0
+
+
+def test_precomputed_query_vectors(store):
+    out = store.run(setup=SETUP, code="""
+    import engine
+    q_vecs = [engine.embed_query(q) for q in queries]
+    report(rs.hybrid_search_many(files, queries, 5, tenant=T, q_vecs=q_vecs)
+           == rs.hybrid_search_many(files, queries, 5, tenant=T))
+    """)
+    assert out
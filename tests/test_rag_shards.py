@@ -0,0 +1,77 @@
+"""ShardRegistry: lazy loading, pinning and LRU eviction (rag_shards.py)."""
+
+import threading
+import time
+
+from rag_shards import ShardRegistry
+
+
+class _Shard:
+    def __init__(self, key, size):
+        self.key = key
+        self.size = size
+        self.closed = False
+
+
+def _registry(budget, size=10, load_delay=0.0):
+    log = []
+
+    def load(key):
+        time.sleep(load_delay)
+        log.append(("load", key))
+        return _Shard(key, size)
+
+    def close(shard):
+        log.append(("close", shard.key))
+        shard.closed = True
+
+    return ShardRegistry(load, close, lambda shard: shard.size, budget), log
+
+
+def test_least_recently_used_unpinned_shard_is_evicted():
+    registry, log = _registry(budget=25)
+    for key in ("a", "b"):
+        with registry.use(key):
+            pass
+    with registry.use("a"):                     # "b" is now least recently used
+        pass
+    with registry.use("c"):
+        pass
+    assert ("close", "b") in log and ("close", "a") not in log
+    assert {shard.key for shard in registry.loaded()} == {"a", "c"}
+    assert registry.evictions == 1
+
+
+def test_pinned_shards_are_never_evicted():
+    registry, log = _registry(budget=5)
+    a = registry.acquire("a")
+    with registry.use("b"):
+        assert registry.peek("a") is a          # over budget, but pinned
+    assert ("close", "a") not in log
+    registry.release("a")
+    assert a.closed
+    assert registry.loaded() == []
+
+
+def test_concurrent_acquires_load_once():
+    registry, log = _registry(budget=100, load_delay=0.2)
+    shards = []
+    threads = [threading.Thread(target=lambda: shards.append(registry.acquire("a"))) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert log.count(("load", "a")) == 1
+    assert len({id(shard) for shard in shards}) == 1
+
+
+def test_evicted_shard_is_reloaded_on_next_use():
+    registry, log = _registry(budget=15)
+    with registry.use("a") as first:
+        pass
+    with registry.use("b"):
+        pass
+    assert first.closed
+    with registry.use("a") as second:
+        assert second is not first and not second.closed
+    assert log.count(("load", "a")) == 2
@@ -0,0 +1,57 @@
+"""StoreVersion / VersionChain: deferred reclamation and per-file version
+numbers (rag_versions.py)."""
+
+import gc
+
+from rag_versions import StoreVersion, VersionChain
+
+
+def _publish_with_callback(chain, ran, label, **files):
+    nxt = chain.current.derive()
+    nxt.files.update(files)
+    chain.publish(nxt, lambda: ran.append(label))
+
+
+def test_reclaim_waits_for_the_last_reader():
+    chain = VersionChain(StoreVersion())
+    ran = []
+    reader = chain.current
+    _publish_with_callback(chain, ran, "first", a=object())
+    gc.collect()
+    assert chain.run_reclaimed() == 0          # `reader` still holds the replaced version
+    del reader
+    gc.collect()
+    assert chain.run_reclaimed() == 1
+    assert ran == ["first"]
+
+
+def test_reclaim_runs_in_publish_order_behind_an_older_reader():
+    chain = VersionChain(StoreVersion())
+    ran = []
+    oldest = chain.current
+    _publish_with_callback(chain, ran, "first", a=object())
+    _publish_with_callback(chain, ran, "second", b=object())
+    gc.collect()
+    # The second version is unreferenced, but its callback must not run
+    # before the first's: the oldest reader can still see both changes.
+    assert chain.run_reclaimed() == 0
+    del oldest
+    gc.collect()
+    assert chain.run_reclaimed() == 2
+    assert ran == ["first", "second"]
+
+
+def test_file_versions_change_only_for_changed_files():
+    chain = VersionChain(StoreVersion(files={"a": object(), "b": object()}))
+    first = dict(chain.current.file_versions)
+    nxt = chain.current.derive()
+    nxt.files["b"] = object()
+    chain.publish(nxt)
+    second = chain.current.file_versions
+    assert second["a"] == first["a"]
+    assert second["b"] != first["b"]
+    nxt = chain.current.derive()
+    del nxt.files["b"]
+    nxt.files["b"] = object()                  # removed and re-added: never reuses a number
+    chain.publish(nxt)
+    assert chain.current.file_versions["b"] not in (first["b"], second["b"])
@@ -0,0 +1,95 @@
+"""Crash recovery of a shard: snapshot + write-ahead log replay (rag_wal.py,
+rag_store._replay_wal / _write_snapshot)."""
+
+import pytest
+
+STATE = """
+T = 1
+queries = ["d1w3 d1w7 common2", "d3w10 d3w11", "d4w1 d4w2 d4w3", "d99w5 d99w6", "common1 common3"]
+
+def state():
+    shard, version = rs._current(T)
+    shard.warm.wait(30)
+    files = sorted(rs.list_indexed(T))
+    return {
+        "files": files,
+        "chunks": {f: len(version.files[f]) for f in files},
+        "ntotal": version.ntotal(),
+        "live_rows": len(version.chunks),
+        "results": [[(r["filename"], r["page"], r["text"]) for r in rs.hybrid_search(files, q, 5, tenant=T)]
+                    for q in queries],
+    }
+"""
+
+
+@pytest.mark.parametrize("flush_first", [True, False], ids=["log-on-snapshot", "log-only"])
+def test_replay_after_crash_without_flush(store, flush_first):
+    before = store.run(setup=STATE, code=f"""
+    rs.index_document("a.txt", store_child.document(1).encode(), tenant=T)
+    rs.index_document("b.txt", store_child.document(2).encode(), tenant=T)
+    c = store_child.document(3).split("\\n\\n")
+    rs.index_document("c.txt", "\\n\\n".join(c).encode(), tenant=T)
+    if {flush_first}:
+        rs.flush()
+    # Everything below is only in the log when the process dies.
+    rs.remove_document("b.txt", tenant=T)
+    c[5] = store_child.document(99, paragraphs=1)
+    rows = store_child.ROWS[0]
+    rs.index_document("c.txt", "\\n\\n".join(c).encode(), tenant=T)
+    reembedded = store_child.ROWS[0] - rows
+    rs.index_document("d.txt", store_child.document(4).encode(), tenant=T)
+    report(dict(state(), reembedded=reembedded, vectors_ok=store_child.vectors_match(rs, T)))
+    crash()
+    """)
+    assert before["files"] == ["a.txt", "c.txt", "d.txt"]
+    assert before["vectors_ok"]
+    # The re-upload was a diff: only the edited paragraph's chunks were embedded.
+    assert 0 < before["reembedded"] < before["chunks"]["c.txt"]
+
+    after = store.run(setup=STATE, code="""
+    rs._current(T)
+    loaded_rows = store_child.ROWS[0]
+    report(dict(state(), loaded_rows=loaded_rows, vectors_ok=store_child.vectors_match(rs, T)))
+    """)
+    assert after["loaded_rows"] == 0            # nothing re-embedded on load
+    assert after["vectors_ok"]
+    assert after["live_rows"] == after["ntotal"] == sum(after["chunks"].values())
+    for key in ("files", "chunks", "ntotal", "results"):
+        assert after[key] == before[key], key
+
+
+def test_replay_then_snapshot_then_restart(store):
+    """A replayed log is folded into the next snapshot and dropped; the
+    snapshot alone then reproduces the state."""
+    before = store.run(setup=STATE, code="""
+    for n in range(1, 4):
+        rs.index_document(f"f{n}.txt", store_child.document(n).encode(), tenant=T)
+    rs.remove_document("f2.txt", tenant=T)
+    report(state())
+    crash()
+    """)
+    pending = store.run(setup=STATE, code="""
+    rs._current(T)
+    rs.flush()
+    report(rs._current(T)[0].wal.pending_bytes())
+    """)
+    assert pending == 0
+    after = store.run(setup=STATE, code="report(state())")
+    assert after["files"] == ["f1.txt", "f3.txt"]
+    assert after["live_rows"] == after["ntotal"]
+    for key in ("files", "chunks", "ntotal", "results"):
+        assert after[key] == before[key], key
+
+
+def test_clear_is_replayed(store):
+    store.run(setup=STATE, code="""
+    rs.index_document("a.txt", store_child.document(1).encode(), tenant=T)
+    rs.flush()
+    rs.clear_all(T)
+    rs.index_document("b.txt", store_child.document(2).encode(), tenant=T)
+    crash()
+    """)
+    after = store.run(setup=STATE, code="report(dict(state(), vectors_ok=store_child.vectors_match(rs, T)))")
+    assert after["files"] == ["b.txt"]
+    assert after["vectors_ok"]
+    assert after["live_rows"] == after["ntotal"]
@@ -0,0 +1,88 @@
+"""
+ttl_cache.py
+============
+Small in-memory LRU cache with an entry limit and a time-to-live, for
+results that are cheap to keep and expensive to recompute (query
+embeddings, see engine.embed_query(); rag_store's hybrid_search results).
+
+- At most `max_entries` entries and, if `max_bytes` is set, at most that
+  many bytes as measured by `sizeof(value)`; putting more evicts the
+  least recently used.
+- An entry older than `ttl_seconds` is never returned (it is dropped on
+  the lookup that finds it). ttl_seconds <= 0 = no expiry.
+- max_entries <= 0 disables the cache: get() always misses, put() keeps
+  nothing.
+
+Thread-safe. Counts hits, misses, evictions and expirations; stats()
+returns them with the hit rate.
+"""
+
+import collections
+import threading
+import time
+
+
+class TTLCache:
+    def __init__(self, max_entries: int, ttl_seconds: float, max_bytes: int = 0, sizeof=None,
+                 clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof
+        self._clock = clock
+        self._entries = collections.OrderedDict()    # key -> (stored at, value, bytes), oldest use first
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """The cached value for `key`, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl_seconds > 0 and self._clock() - entry[0] > self.ttl_seconds:
+                del self._entries[key]
+                self.bytes -= entry[2]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        size = self._sizeof(value) if self._sizeof is not None else 0
+        if self.max_bytes and size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[2]
+            self._entries[key] = (self._clock(), value, size)
+            self.bytes += size
+            while len(self._entries) > self.max_entries or (self.max_bytes and self.bytes > self.max_bytes):
+                self.bytes -= self._entries.popitem(last=False)[1][2]
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"entries": len(self._entries), "max_entries": self.max_entries,
+                    "bytes": self.bytes, "max_bytes": self.max_bytes,
+                    "ttl_seconds": self.ttl_seconds, "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits / lookups if lookups else 0.0,
+                    "evictions": self.evictions, "expirations": self.expirations}
@@ -0,0 +1,414 @@
+"""
+vector_index.py
+===============
+FAISS index factory for rag_store's per-file vector sub-indexes.
+
+Every sub-index used to be a brute-force IndexFlatIP, so query latency grew
+linearly with the number of vectors searched. This picks the structure per
+sub-index from its size instead:
+
+- below ANN_THRESHOLD vectors -> "flat" (exact; at that size brute force is
+  as fast as any ANN structure and needs no training)
+- at/above it -> the configured RAG_INDEX_MODE: "ivf" (IVF, trained on the
+  file's own vectors) or "hnsw". "flat" disables ANN entirely.
+
+Independently of the structure, RAG_VECTOR_COMPRESSION (opt-in, default
+"none") stores the searchable codes compressed:
+
+- "sq8"  8-bit scalar quantization            (4x smaller than float32)
+- "pq"   product quantization, PQ_M bytes/vec  (16x at the default PQ_M=96)
+- "pca"  PCA down to PCA_DIM dims before search (4x at the default 96)
+
+In a compressed mode the full-precision float32 vectors are written to a
+side file next to the .index (<key>.f32) and memory-mapped, not loaded:
+the first pass over-fetches RERANK_FACTOR x k candidates from the
+compressed codes, then re-scores that shortlist exactly from the side file.
+Scores returned are therefore always exact cosine similarities (so
+rag_store's MIN_EMBED_SIMILARITY floor keeps its meaning), and resident
+memory is the compressed codes plus only the side-file pages actually
+touched by re-ranking. `rag_bench.py compression` measures the recall cost
+against the uncompressed baseline.
+
+Each SubIndex can also carry a summary of its file as a few unit vectors
+(summarize(): spherical k-means over the file's vectors), which rag_store
+uses to route a query to the most relevant files before searching chunks.
+It is computed by build(summary_k=...) or, for a loaded sub-index, into a
+copy (with_summary()) - never lazily on a published object.
+
+Everything is wrapped in IndexIDMap2 exactly as before, so callers keep
+using global chunk ids. Search-time knobs (nprobe for IVF, efSearch for
+HNSW) are passed per search, so changing them never requires a rebuild.
+See rag_bench.py for the recall-vs-latency report used to pick these
+settings.
+"""
+
+import math
+import os
+
+import faiss
+import numpy as np
+
+INDEX_MODE = os.environ.get("RAG_INDEX_MODE", "ivf").lower()   # "flat" | "ivf" | "hnsw"
+ANN_THRESHOLD = int(os.environ.get("RAG_ANN_THRESHOLD", "20000"))
+
+# IVF: nlist ~ 4*sqrt(n) is the usual FAISS starting point; nprobe trades
+# recall for latency at query time.
+IVF_NPROBE = int(os.environ.get("RAG_IVF_NPROBE", "16"))
+# HNSW: M = graph degree (memory/recall), efConstruction = build quality,
+# efSearch = query-time breadth (recall vs latency); never below k, since
+# HNSW can't return more results than its search breadth.
+HNSW_M = int(os.environ.get("RAG_HNSW_M", "32"))
+HNSW_EF_CONSTRUCTION = int(os.environ.get("RAG_HNSW_EF_CONSTRUCTION", "80"))
+HNSW_EF_SEARCH = int(os.environ.get("RAG_HNSW_EF_SEARCH", "64"))
+
+COMPRESSION = os.environ.get("RAG_VECTOR_COMPRESSION", "none").lower()   # "none" | "sq8" | "pq" | "pca"
+PQ_M = int(os.environ.get("RAG_PQ_M", "96"))            # sub-quantizers (bytes per vector); must divide the dim
+PCA_DIM = int(os.environ.get("RAG_PCA_DIM", "96"))
+RERANK_FACTOR = int(os.environ.get("RAG_RERANK_FACTOR", "4"))
+
+# Load saved sub-indexes memory-mapped instead of reading them into memory:
+# opening a large index costs page-table setup instead of a full read, and
+# only the pages searches touch become resident. Off = the old full read.
+MMAP_LOAD = os.environ.get("RAG_FAISS_MMAP", "1") != "0"
+
+INDEX_KINDS = ("flat", "ivf", "hnsw")
+COMPRESSIONS = ("none", "sq8", "pq", "pca")
+
+# PQ learns 256 centroids per sub-quantizer and FAISS wants ~39 training
+# points per centroid; below that it falls back to sq8 (which trains on
+# anything). Training itself is capped to a random sample so a huge file
+# doesn't spend minutes in k-means.
+PQ_MIN_TRAIN = 256 * 39
+TRAIN_SAMPLE_MAX = 50_000
+
+
+def choose_kind(n_vectors: int, mode: str | None = None) -> str:
+    mode = (mode or INDEX_MODE)
+    if mode not in INDEX_KINDS:
+        mode = "flat"
+    return "flat" if n_vectors < ANN_THRESHOLD else mode
+
+
+def choose_compression(n_vectors: int, compression: str | None = None) -> str:
+    compression = (compression or COMPRESSION)
+    if compression not in COMPRESSIONS:
+        return "none"
+    if compression == "pq" and n_vectors < PQ_MIN_TRAIN:
+        return "sq8"
+    if compression == "pca" and n_vectors < 4 * PCA_DIM:
+        return "sq8"
+    return compression
+
+
+def ivf_nlist(n_vectors: int) -> int:
+    # FAISS wants >= ~39 training points per centroid; stay well clear of
+    # that so training never warns/clusters poorly on smaller files.
+    return max(1, min(int(4 * math.sqrt(n_vectors)), n_vectors // 39))
+
+
+def _factory_string(dim: int, kind: str, compression: str, n_vectors: int) -> str:
+    codec = {"none": "Flat", "sq8": "SQ8", "pq": f"PQ{PQ_M}", "pca": "Flat"}[compression]
+    if kind == "ivf" and n_vectors >= 39:
+        body = f"IVF{ivf_nlist(n_vectors)},{codec}"
+    elif kind == "hnsw":
+        body = f"HNSW{HNSW_M}" if codec == "Flat" else f"HNSW{HNSW_M}_{codec}"
+    else:
+        body = codec
+    if compression == "pca":
+        body = f"PCA{min(PCA_DIM, dim)},{body}"
+    return body
+
+
+class SubIndex:
+    """
+    One file's vectors: the FAISS search structure (IndexIDMap2, global
+    chunk ids) plus, in a compressed mode, the full-precision vectors for
+    exact re-ranking - an in-memory array right after build(), a read-only
+    np.memmap of the side file once saved/loaded.
+    """
+
+    def __init__(self, index, exact=None):
+        self.index = index
+        self.exact = exact
+        self._row_lookup = None
+        self._summary = None
+
+    @property
+    def ntotal(self) -> int:
+        return int(self.index.ntotal)
+
+    @property
+    def d(self) -> int:
+        return int(self.index.d)
+
+    @property
+    def kind(self) -> str:
+        return kind_of(self.index)
+
+    @property
+    def compression(self) -> str:
+        return compression_of(self.index)
+
+    def ids(self) -> np.ndarray:
+        """Chunk ids in insertion order (== side-file row order)."""
+        return faiss.vector_to_array(self.index.id_map).astype(np.int64)
+
+    def _rows(self, ids: np.ndarray) -> np.ndarray:
+        if self._row_lookup is None:
+            all_ids = self.ids()
+            order = np.argsort(all_ids)
+            self._row_lookup = (all_ids[order], order)
+        sorted_ids, order = self._row_lookup
+        return order[np.searchsorted(sorted_ids, ids)]
+
+    def vectors(self, ids: np.ndarray | None = None) -> np.ndarray:
+        """Full-precision vectors for `ids` (default: all, insertion order)."""
+        if self.exact is not None:
+            if ids is None:
+                return np.asarray(self.exact, dtype=np.float32)
+            return np.asarray(self.exact[self._rows(np.asarray(ids, dtype=np.int64))], dtype=np.float32)
+        if ids is None:
+            if not self.ntotal:
+                return np.zeros((0, self.d), dtype=np.float32)
+            return self.index.index.reconstruct_n(0, self.ntotal).astype(np.float32)
+        return np.vstack([self.index.reconstruct(int(i)) for i in ids]).astype(np.float32)
+
+    def summary(self, k: int) -> np.ndarray | None:
+        """The file's k-vector summary (summarize()) if this sub-index was
+        built or copied with one, else None - never computed here, since a
+        SubIndex is never modified once built."""
+        if self._summary is not None and self._summary[0] == k:
+            return self._summary[1]
+        return None
+
+    def with_summary(self, k: int) -> "SubIndex":
+        """A copy sharing this sub-index's FAISS index and vectors, with its
+        k-vector summary computed."""
+        sub = SubIndex(self.index, self.exact)
+        sub._row_lookup = self._row_lookup
+        sub._summary = (k, summarize(self.vectors(), k))
+        return sub
+
+    def search(self, q_vecs: np.ndarray, k: int):
+        """Same (scores, ids) contract as faiss Index.search."""
+        if self.exact is None:
+            return _faiss_search(self.index, q_vecs, k)
+        k_first = min(self.ntotal, k * RERANK_FACTOR)
+        _, cand = _faiss_search(self.index, q_vecs, k_first)
+        out_scores = np.full((len(q_vecs), k), -np.inf, dtype=np.float32)
+        out_ids = np.full((len(q_vecs), k), -1, dtype=np.int64)
+        for qi in range(len(q_vecs)):
+            ids = cand[qi][cand[qi] != -1]
+            if not len(ids):
+                continue
+            exact_scores = self.vectors(ids) @ q_vecs[qi]
+            top = np.argsort(-exact_scores)[:k]
+            out_scores[qi, :len(top)] = exact_scores[top]
+            out_ids[qi, :len(top)] = ids[top]
+        return out_scores, out_ids
+
+
+def _faiss_search(index, q_vecs, k):
+    params = search_params(index, k)
+    if params is None:
+        return index.search(q_vecs, k)
+    return index.search(q_vecs, k, params=params)
+
+
+def summarize(vectors: np.ndarray, k: int, iterations: int = 5) -> np.ndarray:
+    """
+    (<= k, d) unit vectors summarizing a file's `vectors`: the centroids of
+    a spherical k-means, seeded with k evenly spaced rows (insertion order
+    == document order, so the seeds span the document). k=1 is the plain
+    normalized centroid.
+    """
+    n = len(vectors)
+    if not n:
+        return np.zeros((0, vectors.shape[1]), dtype=np.float32)
+    centroids = np.array(vectors[np.linspace(0, n - 1, min(k, n)).astype(np.int64)], dtype=np.float32)
+    for _ in range(iterations if len(centroids) > 1 else 1):
+        assign = np.argmax(vectors @ centroids.T, axis=1)
+        for c in range(len(centroids)):
+            members = vectors[assign == c]
+            if len(members):
+                centroids[c] = members.sum(axis=0)
+        centroids /= np.maximum(np.linalg.norm(centroids, axis=1, keepdims=True), 1e-8)
+    return centroids
+
+
+def build(dim: int, vectors: np.ndarray, ids: np.ndarray, kind: str | None = None,
+          compression: str | None = None, summary_k: int = 0) -> SubIndex:
+    """
+    Builds a SubIndex over `vectors` (L2-normalized float32, inner product
+    metric) with the given external `ids`. `kind`/`compression` default to
+    what choose_kind()/choose_compression() pick for len(vectors).
+    `summary_k` > 0 also computes its summary() (from `vectors`, in hand).
+    """
+    n = len(vectors)
+    kind = kind or choose_kind(n)
+    compression = choose_compression(n, compression)
+    inner = faiss.index_factory(dim, _factory_string(dim, kind, compression, n), faiss.METRIC_INNER_PRODUCT)
+    if not inner.is_trained:
+        train = vectors
+        if n > TRAIN_SAMPLE_MAX:
+            pick = np.random.default_rng(0).choice(n, TRAIN_SAMPLE_MAX, replace=False)
+            train = vectors[np.sort(pick)]
+        inner.train(train)
+    base = _base_index(inner)
+    if isinstance(base, faiss.IndexHNSW):
+        base.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+    if isinstance(base, faiss.IndexIVF):
+        # Keeps reconstruct() working (IndexIDMap2 relies on it), e.g. for
+        # migrating an uncompressed sub-index to another kind later.
+        base.make_direct_map()
+    index = faiss.IndexIDMap2(inner)
+    if n:
+        index.add_with_ids(vectors, ids)
+    exact = np.ascontiguousarray(vectors, dtype=np.float32) if compression != "none" else None
+    sub = SubIndex(index, exact)
+    if summary_k > 0:
+        sub._summary = (summary_k, summarize(np.asarray(vectors, dtype=np.float32), summary_k))
+    return sub
+
+
+def _base_index(index):
+    """Unwraps IndexIDMap2 / IndexPreTransform (PCA) down to the index that
+    actually holds the codes."""
+    index = faiss.downcast_index(index)
+    if isinstance(index, faiss.IndexIDMap2):
+        index = faiss.downcast_index(index.index)
+    if isinstance(index, faiss.IndexPreTransform):
+        index = faiss.downcast_index(index.index)
+    return index
+
+
+def kind_of(index) -> str:
+    base = _base_index(index)
+    if isinstance(base, faiss.IndexIVF):
+        return "ivf"
+    if isinstance(base, faiss.IndexHNSW):
+        return "hnsw"
+    return "flat"
+
+
+def compression_of(index) -> str:
+    outer = faiss.downcast_index(index)
+    if isinstance(outer, faiss.IndexIDMap2):
+        outer = faiss.downcast_index(outer.index)
+    if isinstance(outer, faiss.IndexPreTransform):
+        return "pca"
+    base = _base_index(outer)
+    if isinstance(base, faiss.IndexHNSW):
+        base = faiss.downcast_index(base.storage)
+    if isinstance(base, (faiss.IndexScalarQuantizer, faiss.IndexIVFScalarQuantizer)):
+        return "sq8"
+    if isinstance(base, (faiss.IndexPQ, faiss.IndexIVFPQ)):
+        return "pq"
+    return "none"
+
+
+def search_params(index, k: int):
+    """Per-search knobs for `index`'s kind (None for flat)."""
+    kind = kind_of(index)
+    if kind == "ivf":
+        return faiss.SearchParametersIVF(nprobe=IVF_NPROBE)
+    if kind == "hnsw":
+        return faiss.SearchParametersHNSW(efSearch=max(HNSW_EF_SEARCH, k))
+    return None
+
+
+# ---------------------------------------------------------------------------
+# Persistence: <key>.index (FAISS) + <key>.f32 (full-precision side file,
+# compressed modes only). Both are written to a temp name and renamed into
+# place, so a crash mid-write never leaves a truncated file behind.
+# ---------------------------------------------------------------------------
+def _side_path(index_path: str) -> str:
+    return os.path.splitext(index_path)[0] + ".f32"
+
+
+def _durable_replace(tmp: str, path: str):
+    # fsync before the rename, so after a crash `path` is either the old
+    # file or the complete new one - never a renamed-but-empty file.
+    with open(tmp, "rb") as f:
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def save(sub: SubIndex, path: str):
+    tmp = path + ".tmp"
+    faiss.write_index(sub.index, tmp)
+    _durable_replace(tmp, path)
+    side = _side_path(path)
+    if sub.exact is None:
+        if os.path.exists(side):
+            os.remove(side)
+        return
+    if not isinstance(sub.exact, np.memmap):
+        with open(side + ".tmp", "wb") as f:
+            f.write(np.ascontiguousarray(sub.exact, dtype=np.float32).tobytes())
+        _durable_replace(side + ".tmp", side)
+        # Swap the in-memory copy for the mapped file so the full-precision
+        # vectors stop counting against resident memory.
+        sub.exact = _map_side_file(side, sub.d)
+
+
+def _map_side_file(side: str, dim: int):
+    n = os.path.getsize(side) // (4 * dim)
+    if n == 0:
+        return np.zeros((0, dim), dtype=np.float32)
+    return np.memmap(side, dtype=np.float32, mode="r", shape=(n, dim))
+
+
+def _mmap_flags(kind: str | None) -> int:
+    # IO_FLAG_MMAP_IFC maps the codes of flat-coded indexes (flat, SQ, PQ,
+    # HNSW storage); IVF needs IO_FLAG_MMAP instead, which maps the
+    # inverted lists - FAISS rejects the two together on an IVF index.
+    # Loaded sub-indexes are never modified (rag_store builds new ones).
+    if not MMAP_LOAD:
+        return 0
+    if kind == "ivf":
+        return faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY
+    return getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+
+
+def load(path: str, kind: str | None = None) -> SubIndex:
+    """`kind` is the manifest's index_type for the file, if known; it
+    selects how the index is memory-mapped (unknown -> flat-style map,
+    which for an IVF index just reads it)."""
+    index = faiss.read_index(path, _mmap_flags(kind))
+    side = _side_path(path)
+    exact = _map_side_file(side, index.d) if os.path.exists(side) else None
+    return SubIndex(index, exact)
+
+
+def remove(path: str):
+    for p in (path, _side_path(path)):
+        if os.path.exists(p):
+            os.remove(p)
+
+
+def memory_bytes(sub: SubIndex) -> int:
+    """Rough resident size of a sub-index: its codes, the id map (an id and
+    a reverse-map entry per vector) and the HNSW graph links. A side file
+    is memory-mapped, so only an unsaved in-memory copy counts."""
+    base = _base_index(sub.index)
+    per_vector = 16
+    if isinstance(base, faiss.IndexHNSW):
+        per_vector += 2 * HNSW_M * 4
+        base = faiss.downcast_index(base.storage)
+    per_vector += int(getattr(base, "code_size", 4 * sub.d))
+    total = sub.ntotal * per_vector
+    if sub.exact is not None and not isinstance(sub.exact, np.memmap):
+        total += sub.exact.nbytes
+    return total
+
+
+def describe(sub: SubIndex) -> dict:
+    """What's persisted in the manifest next to the file's vectors."""
+    kind = sub.kind
+    info = {"index_type": kind, "compression": sub.compression, "ntotal": sub.ntotal}
+    if kind == "ivf":
+        info["nlist"] = int(_base_index(sub.index).nlist)
+    elif kind == "hnsw":
+        info["hnsw_m"] = HNSW_M
+    return info